@@ -0,0 +1,83 @@
+"""
+Size and CPU time of the encodings of a batch: JSON (the default) and columnar.
+
+Usage:
+
+    python benchmarks/encoding.py --points 1000
+"""
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_points(count: int) -> List[Any]:
+    """ A batch of typical points: the same few endpoints, some interactions and spans """
+    from howfast_apm.hook_requests import Interaction
+    from howfast_apm.point import Point
+
+    return [
+        Point(
+            time_request_started_ns=time.time_ns(),
+            time_elapsed_ns=40_000_000 + index,
+            method='GET',
+            uri=f'/records/{index}',
+            interactions=[Interaction('request', 'https://example.org/', 0.01, {'method': 'get'})] if index % 4 == 0 else [],
+            response_status='200 OK',
+            endpoint_name='records',
+            url_rule='/records/<int:id>',
+            is_not_found=False,
+            time_to_first_byte_ns=10_000_000 if index % 2 else None,
+            response_bytes=1234 if index % 2 else None,
+            spans=[('load', 1_000, 20_000_000, -1), ('query', 2_000, 5_000_000, 0)] if index % 3 == 0 else None,
+        )
+        for index in range(count)
+    ]
+
+
+def run_benchmark(points_count: int, repeat: int) -> Dict[str, Dict[str, Any]]:
+    from howfast_apm.queue import RingBuffer
+    from howfast_apm.runner import Runner
+
+    runner = Runner(queue=RingBuffer(), app_id='benchmark')
+    runner.current_batch = make_points(points_count)
+    results = {}
+    for wire_format in ('json', 'columnar'):
+        runner.wire_format = wire_format
+        # Best run, to limit the noise
+        encode_time = min(timeit.repeat(runner.encode_batch, number=1, repeat=repeat))
+        results[wire_format] = {
+            'bytes': len(runner.encode_batch()),
+            'encode_ms': encode_time * 1e3,
+        }
+    return results
+
+
+def format_results(results: Dict[str, Dict[str, Any]]) -> str:
+    json_result = results['json']
+    lines = [f"{'format':>10}  {'bytes':>10}  {'encode_ms':>10}  {'vs json':>8}"]
+    for wire_format, result in results.items():
+        ratio = result['encode_ms'] / json_result['encode_ms']
+        lines.append(f"{wire_format:>10}  {result['bytes']:>10}  {result['encode_ms']:>10.3f}  {ratio:>8.2f}")
+    return '\n'.join(lines)
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="Compare the size and CPU time of the encodings of a batch")
+    parser.add_argument('--points', type=int, default=1000, help="points per batch")
+    parser.add_argument('--repeat', type=int, default=20, help="encodings of each format, the best one is kept")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args(argv)
+    sys.path.insert(0, ROOT)
+
+    results = run_benchmark(args.points, args.repeat)
+    print(json.dumps(results, indent=2) if args.json else format_results(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Time to match a URI against the endpoints blacklist, with 1 to 500 patterns: the compiled matcher
+(EndpointMatcher) against the linear scan of one regex per pattern it replaced.
+
+Usage:
+
+    python benchmarks/endpoints.py
+    python benchmarks/endpoints.py --counts 1 10 100 500 1000 --json
+"""
+import os
+import re
+import sys
+import json
+import timeit
+import fnmatch
+import argparse
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Distinct URIs, so that the cache of the matcher is not used
+URIS = [f'/users/{i}/profile' for i in range(1000)] + [f'/static/bundle-{i}/app.js' for i in range(1000)]
+
+
+def generate_patterns(count: int) -> List[str]:
+    """ A realistic mix of health checks, static files and patterns with wildcards """
+    patterns = []
+    for i in range(count):
+        if i % 3 == 0:
+            patterns.append(f'/health/check-{i}')
+        elif i % 3 == 1:
+            patterns.append(f'/static/bundle-{i}/*')
+        else:
+            patterns.append(f'/api/v?/metrics-{i}')
+    return patterns
+
+
+def linear_scan(patterns: List[str]):
+    """ Matching as it was done before EndpointMatcher: one regex per pattern, tried in turn """
+    regexes = [re.compile(fnmatch.translate(pattern)) for pattern in patterns]
+
+    def match(uri: str) -> bool:
+        for regex in regexes:
+            if regex.match(uri):
+                return True
+        return False
+
+    return match
+
+
+def run_benchmark(counts: List[int], repeat: int) -> Dict[int, Dict[str, float]]:
+    from howfast_apm.utils import EndpointMatcher
+
+    results = {}
+    for count in counts:
+        patterns = generate_patterns(count)
+        matchers = {
+            'linear': linear_scan(patterns),
+            'compiled': EndpointMatcher(*patterns, cache_size=0).match,
+        }
+        results[count] = {}
+        for name, match in matchers.items():
+            # Best run, to limit the noise
+            elapsed = min(timeit.repeat(lambda: [match(uri) for uri in URIS], number=1, repeat=repeat))
+            results[count][f'{name}_us'] = elapsed / len(URIS) * 1e6
+    return results
+
+
+def format_results(results: Dict[int, Dict[str, float]]) -> str:
+    lines = [f"{'patterns':>8}  {'linear_us':>10}  {'compiled_us':>11}  {'speedup':>8}"]
+    for count, result in results.items():
+        speedup = result['linear_us'] / result['compiled_us']
+        lines.append(f"{count:>8}  {result['linear_us']:>10.3f}  {result['compiled_us']:>11.3f}  {speedup:>7.1f}x")
+    return '\n'.join(lines)
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="Compare the matching of the endpoints blacklist with many patterns")
+    parser.add_argument('--counts', type=int, nargs='+', default=[1, 10, 100, 500], help="numbers of patterns")
+    parser.add_argument('--repeat', type=int, default=5, help="runs of each measure, the best one is kept")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args(argv)
+    sys.path.insert(0, ROOT)
+
+    results = run_benchmark(args.counts, args.repeat)
+    print(json.dumps(results, indent=2) if args.json else format_results(results))
+
+
+if __name__ == '__main__':
+    main()
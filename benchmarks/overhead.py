@@ -0,0 +1,227 @@
+"""
+Overhead of the middleware under load.
+
+A Flask application is served by a threaded WSGI server and loaded by concurrent clients, without
+the middleware, with the middleware, and with the middleware recording the interactions. The data
+is sent to a local stand-in of the collector (tests/fake_collector.py), which can answer slowly or
+with errors. Each scenario runs in its own process, so that they don't share the hooks or the queue.
+
+Usage:
+
+    python benchmarks/overhead.py --requests 5000 --concurrency 8
+    python benchmarks/overhead.py --collector-latency 0.5 --collector-error-rate 0.2 --json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import subprocess
+from itertools import count
+from time import perf_counter_ns
+from typing import Any, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Environment of each scenario, on top of the collector URL
+SCENARIOS = {
+    'baseline': {},
+    'middleware': {'HOWFAST_APM_DSN': 'benchmark'},
+    'interactions': {'HOWFAST_APM_DSN': 'benchmark', 'HOWFAST_APM_RECORD_INTERACTIONS': '1'},
+}
+
+# Requests sent before measuring, to start the threads and fill the caches
+WARMUP_REQUESTS = 50
+
+
+def percentile(values: List[int], percentile: float) -> Optional[int]:
+    """
+    Nearest-rank percentile of the values
+
+    >>> percentile([4, 1, 3, 2], 50)
+    2
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, int(round(percentile / 100 * len(ordered))) - 1)]
+
+
+def thread_cpu_time(thread: Optional[threading.Thread]) -> Optional[float]:
+    """ CPU time used by a running thread, in seconds (None if it can't be measured) """
+    if thread is None or not thread.is_alive() or not hasattr(time, 'pthread_getcpuclockid'):
+        return None
+    return time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+
+
+def load(url: str, requests_count: int, concurrency: int) -> List[int]:
+    """ Send the requests from `concurrency` threads, returning their latencies in nanoseconds """
+    import requests
+    from howfast_apm.hook_http import without_interactions
+
+    latencies: List[int] = []
+    remaining = count(requests_count, -1)
+
+    def client():
+        # The requests of the clients are not part of the application
+        with without_interactions(), requests.Session() as session:
+            while next(remaining) > 0:
+                start = perf_counter_ns()
+                session.get(url).raise_for_status()
+                latencies.append(perf_counter_ns() - start)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+def run_scenario(requests_count: int, concurrency: int, calls: int) -> Dict[str, Any]:
+    """ Serve and load the application, in the process of the scenario """
+    import requests
+    from flask import Flask, jsonify
+    from werkzeug.serving import make_server
+    from howfast_apm.queue import queue
+
+    backend_url = os.environ['BENCHMARK_BACKEND_URL']
+    app = Flask('benchmark')
+
+    @app.route('/pets/<int:pet_id>')
+    def pet(pet_id):
+        for _ in range(calls):
+            requests.get(backend_url)
+        return jsonify(id=pet_id, name=f'pet {pet_id}')
+
+    middleware = None
+    if os.environ.get('HOWFAST_APM_DSN'):
+        from howfast_apm import HowFastFlaskMiddleware
+        middleware = HowFastFlaskMiddleware(app)
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/pets/42'
+    try:
+        load(url, WARMUP_REQUESTS, concurrency)
+        start = perf_counter_ns()
+        latencies = load(url, requests_count, concurrency)
+        wall = (perf_counter_ns() - start) / 1e9
+    finally:
+        server.shutdown()
+
+    result = {
+        'requests': len(latencies),
+        'throughput': len(latencies) / wall,
+        'p50_ms': percentile(latencies, 50) / 1e6,
+        'p99_ms': percentile(latencies, 99) / 1e6,
+        'runner_cpu_s': None,
+        'dropped': queue.dropped,
+        'overhead_p50_ms': None,
+        'overhead_p99_ms': None,
+    }
+    if middleware is not None:
+        result['runner_cpu_s'] = thread_cpu_time(middleware.runner)
+        overhead = middleware.get_overhead()
+        for name, value in (('overhead_p50_ms', overhead.percentile(50)), ('overhead_p99_ms', overhead.percentile(99))):
+            result[name] = value / 1e6 if value is not None else None
+        # Send the remaining points, so that the collector receives everything
+        middleware.shutdown()
+    return result
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Dict[str, Any]]:
+    """ Run each scenario in its own process, against the same collector """
+    sys.path[:0] = [ROOT, os.path.join(ROOT, 'tests')]
+    from fake_collector import FakeCollector
+
+    collector = FakeCollector(latency=args.collector_latency, error_rate=args.collector_error_rate).start()
+    results = {}
+    try:
+        for name in args.scenarios:
+            env = dict(
+                os.environ,
+                PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]),
+                HOWFAST_APM_COLLECTOR_URL=collector.url,
+                BENCHMARK_BACKEND_URL=collector.url,
+                **SCENARIOS[name],
+            )
+            bytes_received, points, errors = collector.bytes_received, len(collector.points), collector.errors
+            output = subprocess.run(
+                [
+                    sys.executable, os.path.abspath(__file__), '--run-scenario',
+                    '--requests', str(args.requests),
+                    '--concurrency', str(args.concurrency),
+                    '--calls', str(args.calls),
+                ],
+                env=env,
+                check=True,
+                stdout=subprocess.PIPE,
+            ).stdout
+            result = json.loads(output.decode().splitlines()[-1])
+            result['upload_bytes'] = collector.bytes_received - bytes_received
+            result['points_received'] = len(collector.points) - points
+            result['collector_errors'] = collector.errors - errors
+            results[name] = result
+    finally:
+        collector.stop()
+    return results
+
+
+def format_results(results: Dict[str, Dict[str, Any]]) -> str:
+    baseline = results.get('baseline')
+    columns = [
+        ('scenario', '{}'),
+        ('p50_ms', '{:.3f}'),
+        ('p99_ms', '{:.3f}'),
+        ('added_p50_ms', '{:+.3f}'),
+        ('added_p99_ms', '{:+.3f}'),
+        ('throughput', '{:.0f}/s'),
+        ('throughput_delta', '{:+.1%}'),
+        ('overhead_p99_ms', '{:.3f}'),
+        ('runner_cpu_s', '{:.3f}'),
+        ('dropped', '{}'),
+        ('upload_bytes', '{}'),
+        ('points_received', '{}'),
+        ('collector_errors', '{}'),
+    ]
+    rows = []
+    for name, result in results.items():
+        row = dict(result, scenario=name)
+        if baseline is not None:
+            row['added_p50_ms'] = result['p50_ms'] - baseline['p50_ms']
+            row['added_p99_ms'] = result['p99_ms'] - baseline['p99_ms']
+            row['throughput_delta'] = result['throughput'] / baseline['throughput'] - 1
+        rows.append([template.format(row[column]) if row.get(column) is not None else '-' for column, template in columns])
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, (column, _) in enumerate(columns)]
+    lines = ['  '.join(column.rjust(width) for (column, _), width in zip(columns, widths))]
+    lines.extend('  '.join(value.rjust(width) for value, width in zip(row, widths)) for row in rows)
+    return '\n'.join(lines)
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="Measure the overhead of the HowFast APM middleware under load")
+    parser.add_argument('--requests', type=int, default=2000, help="requests per scenario")
+    parser.add_argument('--concurrency', type=int, default=8, help="number of concurrent clients")
+    parser.add_argument('--calls', type=int, default=1, help="outgoing HTTP calls made by each request")
+    parser.add_argument('--collector-latency', type=float, default=0, help="time taken by the collector to answer, in seconds")
+    parser.add_argument('--collector-error-rate', type=float, default=0, help="probability for the collector to answer with a 503")
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    parser.add_argument('--run-scenario', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    # Don't log every request of the servers
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    if args.run_scenario:
+        print(json.dumps(run_scenario(args.requests, args.concurrency, args.calls)))
+        return
+
+    results = run_benchmark(args)
+    print(json.dumps(results, indent=2) if args.json else format_results(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Cost of the timestamps of a point, with datetime objects (as the middleware used to do) and with
+integer nanoseconds (time.time_ns() and time.perf_counter_ns(), formatted per batch):
+* capture: on the request path, when the request starts and ends;
+* format: in the background thread, when the batch is serialized.
+
+Usage:
+
+    python benchmarks/timestamps.py --points 1000
+"""
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+from datetime import datetime, timezone
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def capture_with_datetime():
+    """ What the middleware used to do on every request """
+    started = datetime.now(timezone.utc)
+    start = timeit.default_timer()
+    end = timeit.default_timer()
+    return started, end - start
+
+
+def capture_with_integers():
+    started = time.time_ns()
+    start = time.perf_counter_ns()
+    end = time.perf_counter_ns()
+    return started, end - start
+
+
+def run_benchmark(points_count: int, repeat: int) -> Dict[str, Dict[str, float]]:
+    from howfast_apm.utils import format_timestamps
+
+    # Points of a batch, one millisecond apart
+    timestamps_ns = [time.time_ns() + i * 1_000_000 for i in range(points_count)]
+    datetimes = [datetime.fromtimestamp(timestamp // 1000 / 1e6, timezone.utc) for timestamp in timestamps_ns]
+
+    def best(func, number: int) -> float:
+        """ Best time of one call, in nanoseconds """
+        return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e9
+
+    return {
+        'datetime': {
+            'capture_ns': best(capture_with_datetime, 10_000),
+            'format_ns': best(lambda: [value.isoformat() for value in datetimes], 10) / points_count,
+        },
+        'integers': {
+            'capture_ns': best(capture_with_integers, 10_000),
+            'format_ns': best(lambda: format_timestamps(timestamps_ns), 10) / points_count,
+        },
+    }
+
+
+def format_results(results: Dict[str, Dict[str, float]]) -> str:
+    lines = [f"{'timestamps':>10}  {'capture_ns':>10}  {'format_ns':>10}"]
+    for name, result in results.items():
+        lines.append(f"{name:>10}  {result['capture_ns']:>10.0f}  {result['format_ns']:>10.0f}")
+    return '\n'.join(lines)
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="Compare the cost of the timestamps of the points")
+    parser.add_argument('--points', type=int, default=1000, help="points per batch, for the formatting")
+    parser.add_argument('--repeat', type=int, default=5, help="runs of each measure, the best one is kept")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args(argv)
+    sys.path.insert(0, ROOT)
+
+    results = run_benchmark(args.points, args.repeat)
+    print(json.dumps(results, indent=2) if args.json else format_results(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,8 @@
-from .flask import HowFastFlaskMiddleware
+from .asgi import HowFastASGIMiddleware
+from .wsgi import HowFastWSGIMiddleware
+
+try:
+    from .flask import HowFastFlaskMiddleware
+except ModuleNotFoundError:
+    # Flask is an optional dependency (the "flask" extra)
+    pass
@@ -0,0 +1,315 @@
+"""
+Per-host agent: the worker processes send their points to a local Unix datagram socket, and a
+single agent process (`howfast-apm-agent`) batches and uploads them on behalf of all the workers.
+"""
+import os
+import json
+import stat
+import time
+import socket
+import select
+import signal
+import struct
+import logging
+import argparse
+from threading import Event
+from typing import Dict, List, Optional, Tuple
+
+from .config import HOWFAST_APM_AGENT_SOCKET, HOWFAST_APM_SHUTDOWN_TIMEOUT
+from .hook_requests import Interaction
+from .point import Point
+from .queue import RingBuffer
+from .runner import Runner
+
+logger = logging.getLogger('howfast_apm')
+
+# Where the agent listens when HOWFAST_APM_AGENT_SOCKET is not set
+DEFAULT_SOCKET_PATH = '/tmp/howfast-apm.sock'
+
+RECORD_VERSION = 1
+# Version, time_request_started_ns, time_elapsed_ns, time_to_first_byte_ns, response_bytes,
+# gc_pause_ns and stall_ns (-1 for None), is_not_found (0: None, 1: False, 2: True), number of
+# interactions, number of spans
+RECORD_HEADER = struct.Struct('<BqqqqqqBHH')
+# Followed by the strings: DSN, method, uri, response_status, endpoint_name, url_rule, profile
+RECORD_STRINGS = 7
+# Then, for each interaction, the elapsed time (seconds) followed by the strings: type, name, extra
+INTERACTION_HEADER = struct.Struct('<d')
+# Then, for each span, its start, duration and parent (-1 for None) followed by its name
+SPAN_HEADER = struct.Struct('<qqi')
+# Each string is prefixed by its length in bytes, NULL_STRING standing for None
+STRING_LENGTH = struct.Struct('<H')
+NULL_STRING = 0xFFFF
+MAX_STRING_BYTES = NULL_STRING - 1
+
+# Keep the datagrams well below the default socket buffer size
+MAX_INTERACTIONS = 200
+
+
+def _pack_string(value: Optional[str]) -> bytes:
+    if value is None:
+        return STRING_LENGTH.pack(NULL_STRING)
+    encoded = value.encode('utf-8', 'replace')[:MAX_STRING_BYTES]
+    return STRING_LENGTH.pack(len(encoded)) + encoded
+
+
+def _unpack_string(data: bytes, offset: int) -> Tuple[Optional[str], int]:
+    (length, ) = STRING_LENGTH.unpack_from(data, offset)
+    offset += STRING_LENGTH.size
+    if length == NULL_STRING:
+        return None, offset
+    return data[offset:offset + length].decode('utf-8', 'replace'), offset + length
+
+
+def encode_point(app_id: str, point: Point) -> bytes:
+    """ Compact binary record of a point, sent to the agent in a single datagram """
+    interactions = point.interactions[:MAX_INTERACTIONS]
+    is_not_found = 0 if point.is_not_found is None else 1 + bool(point.is_not_found)
+    parts = [
+        RECORD_HEADER.pack(
+            RECORD_VERSION,
+            point.time_request_started_ns,
+            point.time_elapsed_ns,
+            -1 if point.time_to_first_byte_ns is None else point.time_to_first_byte_ns,
+            -1 if point.response_bytes is None else point.response_bytes,
+            -1 if point.gc_pause_ns is None else point.gc_pause_ns,
+            -1 if point.stall_ns is None else point.stall_ns,
+            is_not_found,
+            len(interactions),
+            len(point.spans),
+        ),
+        _pack_string(app_id),
+        _pack_string(point.method),
+        _pack_string(point.uri),
+        _pack_string(point.response_status),
+        _pack_string(point.endpoint_name),
+        _pack_string(point.url_rule),
+        _pack_string(point.profile),
+    ]
+    for interaction in interactions:
+        parts.append(INTERACTION_HEADER.pack(interaction.elapsed))
+        parts.append(_pack_string(interaction.interaction_type))
+        parts.append(_pack_string(interaction.name))
+        parts.append(_pack_string(json.dumps(interaction.extra) if interaction.extra else None))
+    for name, start, duration, parent in point.spans:
+        parts.append(SPAN_HEADER.pack(start, duration, parent))
+        parts.append(_pack_string(name))
+    return b''.join(parts)
+
+
+def decode_point(data: bytes) -> Tuple[str, Point]:
+    """ Inverse of encode_point: return the DSN and the point """
+    version, started_ns, elapsed_ns, first_byte_ns, response_bytes, gc_pause_ns, stall_ns, is_not_found, interactions_count, spans_count = RECORD_HEADER.unpack_from(data)
+    if version != RECORD_VERSION:
+        raise ValueError(f"Unsupported record version {version}")
+    offset = RECORD_HEADER.size
+    strings = []
+    for _ in range(RECORD_STRINGS):
+        value, offset = _unpack_string(data, offset)
+        strings.append(value)
+    app_id, method, uri, response_status, endpoint_name, url_rule, profile = strings
+
+    interactions = []
+    for _ in range(interactions_count):
+        (elapsed, ) = INTERACTION_HEADER.unpack_from(data, offset)
+        offset += INTERACTION_HEADER.size
+        interaction_type, offset = _unpack_string(data, offset)
+        name, offset = _unpack_string(data, offset)
+        extra, offset = _unpack_string(data, offset)
+        interactions.append(Interaction(interaction_type, name, elapsed, json.loads(extra) if extra else None))
+
+    spans = []
+    for _ in range(spans_count):
+        start, duration, parent = SPAN_HEADER.unpack_from(data, offset)
+        offset += SPAN_HEADER.size
+        name, offset = _unpack_string(data, offset)
+        spans.append((name, start, duration, parent))
+
+    return app_id, Point(
+        time_request_started_ns=started_ns,
+        time_elapsed_ns=elapsed_ns,
+        method=method,
+        uri=uri,
+        interactions=interactions,
+        response_status=response_status,
+        endpoint_name=endpoint_name,
+        url_rule=url_rule,
+        is_not_found=None if is_not_found == 0 else is_not_found == 2,
+        time_to_first_byte_ns=None if first_byte_ns < 0 else first_byte_ns,
+        response_bytes=None if response_bytes < 0 else response_bytes,
+        spans=spans,
+        profile=profile,
+        gc_pause_ns=None if gc_pause_ns < 0 else gc_pause_ns,
+        stall_ns=None if stall_ns < 0 else stall_ns,
+    )
+
+
+class AgentSink:
+    """
+    Send the points of a worker process to the agent, in place of the queue and the background
+    thread. Sending never blocks: if the agent is not running or can't keep up, the point is dropped.
+    """
+
+    socket_path: str
+    app_id: str
+    # Number of points that could not be sent to the agent
+    dropped: int
+
+    def __init__(self, socket_path: str, app_id: str):
+        self.socket_path = socket_path
+        self.app_id = app_id
+        self.dropped = 0
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def push(self, point: Point) -> None:
+        try:
+            self._socket.sendto(encode_point(self.app_id, point), self.socket_path)
+        except OSError as exception:
+            # Agent not running (ENOENT, ECONNREFUSED), its buffer is full (EAGAIN) or the record is
+            # too big (EMSGSIZE)
+            if not self.dropped:
+                logger.warning("Unable to send the point to the agent at %s: %s", self.socket_path, exception)
+            self.dropped += 1
+
+    def close(self) -> None:
+        self._socket.close()
+
+
+class Agent:
+    """
+    Receive the points of all the worker processes of the host, and upload them with one Runner per
+    application (DSN).
+    """
+
+    socket_path: str
+    # Size of the queue of each application
+    queue_size: int
+    # Options of the runners (aggregate, compression, spool_dir...)
+    runner_options: dict
+
+    queues: Dict[str, RingBuffer]
+    runners: Dict[str, Runner]
+
+    # Largest datagram accepted by recv()
+    max_record_bytes = 256 * 1024
+
+    # Wake up every X seconds to check whether the agent should stop
+    poll_interval = 0.5
+
+    # Datagrams returned by one call to receive(), so that the agent handles them and checks
+    # whether it should stop even under steady traffic
+    max_records_per_receive = 1000
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH, queue_size: int = 10000, **runner_options):
+        self.socket_path = socket_path
+        self.queue_size = queue_size
+        self.runner_options = runner_options
+        self.queues = {}
+        self.runners = {}
+        self.stopping = Event()
+        self._socket: Optional[socket.socket] = None
+
+    def bind(self) -> None:
+        """ Listen on the socket, replacing the socket left behind by a previous agent """
+        try:
+            if stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+                os.remove(self.socket_path)
+        except FileNotFoundError:
+            pass
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self.socket_path)
+        self._socket.setblocking(False)
+        logger.info("HowFast APM agent listening on %s", self.socket_path)
+
+    def handle(self, data: bytes) -> None:
+        """ Queue the point received from a worker """
+        try:
+            app_id, point = decode_point(data)
+        except (ValueError, struct.error, UnicodeDecodeError):
+            logger.warning("Invalid record received by the agent (%d bytes)", len(data), exc_info=True)
+            return
+        if not app_id:
+            return
+        queue = self.queues.get(app_id)
+        if queue is None:
+            queue = self.queues[app_id] = RingBuffer(maxsize=self.queue_size)
+            self.runners[app_id] = self.start_runner(queue, app_id)
+        queue.push(point)
+
+    def start_runner(self, queue: RingBuffer, app_id: str) -> Runner:
+        logger.info("Reporting the performance data of DSN %s", app_id)
+        runner = Runner(queue=queue, app_id=app_id, **self.runner_options)
+        runner.start()
+        return runner
+
+    def receive(self) -> List[bytes]:
+        """
+        Wait up to poll_interval for the next datagram, then return it along with the ones already
+        received, without waiting for more
+        """
+        records = []
+        readable, _, _ = select.select([self._socket], [], [], self.poll_interval)
+        if not readable:
+            return records
+        try:
+            while len(records) < self.max_records_per_receive:
+                records.append(self._socket.recv(self.max_record_bytes))
+        except BlockingIOError:
+            pass
+        return records
+
+    def serve_forever(self) -> None:
+        while not self.stopping.is_set():
+            for data in self.receive():
+                self.handle(data)
+
+    def stop(self) -> None:
+        self.stopping.set()
+
+    def close(self, timeout: float = HOWFAST_APM_SHUTDOWN_TIMEOUT) -> None:
+        """ Stop listening, then send the remaining points of every application """
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+            try:
+                os.remove(self.socket_path)
+            except FileNotFoundError:
+                pass
+        # Flush all the applications in parallel, within the same deadline
+        deadline = time.monotonic() + timeout
+        for runner in self.runners.values():
+            runner.deadline = deadline
+            runner.stopping.set()
+        for runner in self.runners.values():
+            runner.shutdown(max(0, deadline - time.monotonic()))
+
+
+def main(argv: List[str] = None) -> None:
+    """ Entry point of the howfast-apm-agent command """
+    parser = argparse.ArgumentParser(
+        prog='howfast-apm-agent',
+        description="Collect the performance data of the local worker processes and send it to HowFast APM.",
+    )
+    parser.add_argument(
+        '--socket',
+        default=HOWFAST_APM_AGENT_SOCKET or DEFAULT_SOCKET_PATH,
+        help="Unix socket to listen on (default: HOWFAST_APM_AGENT_SOCKET, or %(default)s)",
+    )
+    parser.add_argument('--queue-size', type=int, default=10000, help="Maximum number of points queued per application")
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    agent = Agent(socket_path=args.socket, queue_size=args.queue_size)
+    signal.signal(signal.SIGTERM, lambda signum, frame: agent.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: agent.stop())
+    agent.bind()
+    try:
+        agent.serve_forever()
+    finally:
+        agent.close()
+
+
+if __name__ == '__main__':  # pragma: nocover
+    main()
@@ -0,0 +1,197 @@
+import heapq
+import math
+import time
+from itertools import count
+from typing import Dict, List, Optional, Tuple, Union
+
+from .interactions import normalize_url
+from .point import Point
+from .utils import format_timestamps
+
+
+class LatencySketch:
+    """
+    Distribution of durations with a bounded relative error, in the spirit of DDSketch.
+
+    Values are counted in logarithmic buckets: bucket `k` holds the values between gamma^(k-1) and
+    gamma^k. Any quantile can then be estimated with a relative error of at most
+    `relative_accuracy`, whatever the number of values, while only storing one counter per bucket.
+    """
+
+    relative_accuracy: float
+    gamma: float
+    # Number of values per bucket index
+    bins: Dict[int, int]
+    # Values <= 0 can't be bucketed on a log scale
+    zero_count: int
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0
+
+    def add(self, value: float) -> None:
+        if value <= 0:
+            self.zero_count += 1
+            return
+        key = math.ceil(math.log(value) / self._log_gamma)
+        self.bins[key] = self.bins.get(key, 0) + 1
+
+    def quantile(self, quantile: float) -> Optional[float]:
+        """ Estimate the value at the given quantile (between 0 and 1) """
+        total = self.zero_count + sum(self.bins.values())
+        if not total:
+            return None
+        rank = quantile * (total - 1)
+        if rank < self.zero_count:
+            return 0
+        cumulated = self.zero_count
+        for key in sorted(self.bins):
+            cumulated += self.bins[key]
+            if cumulated > rank:
+                # Middle of the bucket (in relative terms)
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return None  # pragma: nocover
+
+    def serialize(self) -> dict:
+        keys = sorted(self.bins)
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'zero_count': self.zero_count,
+            'keys': keys,
+            'counts': [self.bins[key] for key in keys],
+        }
+
+
+class Aggregate:
+    """ Performance information of all the requests with the same method, endpoint and status """
+
+    __slots__ = (
+        'method',
+        'url_rule',
+        'endpoint_name',
+        'uri',
+        'response_status',
+        'count',
+        'total_ns',
+        'min_ns',
+        'max_ns',
+        'sketch',
+        'time_window_started_ns',
+        'time_window_ended_ns',
+    )
+
+    def __init__(self, point: Point, relative_accuracy: float, time_window_started_ns: int):
+        self.method = point.method
+        self.url_rule = point.url_rule
+        self.endpoint_name = point.endpoint_name
+        # Without a route (plain WSGI applications), the requests are grouped by normalized URI
+        self.uri = normalize_url(point.uri) if not (point.url_rule or point.endpoint_name) else None
+        self.response_status = point.response_status
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = point.time_elapsed_ns
+        self.max_ns = point.time_elapsed_ns
+        # The sketch holds durations in nanoseconds
+        self.sketch = LatencySketch(relative_accuracy)
+        self.time_window_started_ns = time_window_started_ns
+        self.time_window_ended_ns: Optional[int] = None
+
+    def add(self, point: Point) -> None:
+        elapsed = point.time_elapsed_ns
+        self.count += 1
+        self.total_ns += elapsed
+        if elapsed < self.min_ns:
+            self.min_ns = elapsed
+        if elapsed > self.max_ns:
+            self.max_ns = elapsed
+        self.sketch.add(elapsed)
+
+    def serialize(self) -> dict:
+        """ JSON-serialize the Aggregate. Durations are sent in seconds, like the points. """
+        time_window_started, time_window_ended = format_timestamps(
+            [self.time_window_started_ns, self.time_window_ended_ns or time.time_ns()],
+        )
+        serialized = {
+            'method': self.method,
+            'response_status': self.response_status,
+            'endpoint_name': self.endpoint_name,
+            'time_window_started': time_window_started,
+            'time_window_ended': time_window_ended,
+            'count': self.count,
+            'time_elapsed_sum': self.total_ns / 1e9,
+            'time_elapsed_min': self.min_ns / 1e9,
+            'time_elapsed_max': self.max_ns / 1e9,
+            'sketch': self.sketch.serialize(),
+        }
+        if self.url_rule:
+            serialized['url_rule'] = self.url_rule
+        if self.uri:
+            serialized['uri'] = self.uri
+        return serialized
+
+
+AggregateKey = Tuple[Optional[str], Optional[str], Optional[str]]
+
+
+class Aggregator:
+    """
+    Fold points into one Aggregate per (method, url_rule or endpoint_name or normalized uri,
+    response_status) over a time window, keeping the slowest points of each aggregate as exemplars.
+    """
+
+    relative_accuracy: float
+    # Number of raw points kept per aggregate (the slowest ones)
+    max_exemplars: int
+
+    aggregates: Dict[AggregateKey, Aggregate]
+    # Min-heaps of (elapsed, sequence, point) per aggregate
+    exemplars: Dict[AggregateKey, List[Tuple[int, int, Point]]]
+
+    def __init__(self, relative_accuracy: float = 0.01, max_exemplars: int = 1):
+        self.relative_accuracy = relative_accuracy
+        self.max_exemplars = max_exemplars
+        # Tie-breaker for points with the same duration, since points are not comparable
+        self._sequence = count()
+        self._reset()
+
+    def _reset(self) -> None:
+        self.aggregates = {}
+        self.exemplars = {}
+        self.time_window_started_ns = time.time_ns()
+        self._window_started = time.monotonic()
+
+    @property
+    def window_elapsed(self) -> float:
+        """ Seconds since the window started """
+        return time.monotonic() - self._window_started
+
+    def add(self, point: Point) -> None:
+        key = (point.method, point.url_rule or point.endpoint_name or normalize_url(point.uri), point.response_status)
+        aggregate = self.aggregates.get(key)
+        if aggregate is None:
+            aggregate = self.aggregates[key] = Aggregate(point, self.relative_accuracy, self.time_window_started_ns)
+        aggregate.add(point)
+
+        if self.max_exemplars > 0:
+            exemplars = self.exemplars.setdefault(key, [])
+            item = (point.time_elapsed_ns, next(self._sequence), point)
+            if len(exemplars) < self.max_exemplars:
+                heapq.heappush(exemplars, item)
+            elif item[0] > exemplars[0][0]:
+                heapq.heapreplace(exemplars, item)
+
+    def flush(self) -> List[Union[Aggregate, Point]]:
+        """ Return the aggregates of the window followed by the exemplars, and start a new window """
+        time_window_ended_ns = time.time_ns()
+        aggregates = list(self.aggregates.values())
+        for aggregate in aggregates:
+            aggregate.time_window_ended_ns = time_window_ended_ns
+        exemplars = [point for heap in self.exemplars.values() for _, _, point in sorted(heap)]
+        self._reset()
+        return aggregates + exemplars
+
+    def __len__(self) -> int:
+        return len(self.aggregates)
@@ -0,0 +1,165 @@
+import time
+import logging
+from functools import lru_cache
+from http import HTTPStatus
+from time import perf_counter_ns
+from typing import Any, Awaitable, Callable, List, MutableMapping, Optional
+
+from .async_runner import AsyncRunner
+from .core import CoreAPM
+from .queue import queue
+from .utils import is_in_blacklist, compile_endpoints
+
+logger = logging.getLogger('howfast_apm')
+
+Scope = MutableMapping[str, Any]
+Message = MutableMapping[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+ASGIApp = Callable[[Scope, Receive, Send], Awaitable[None]]
+
+
+@lru_cache(maxsize=128)
+def status_line(status: int) -> str:
+    """ Status line of the response, as reported by the WSGI middleware ("404 NOT FOUND") """
+    try:
+        return f"{status} {HTTPStatus(status).phrase.upper()}"
+    except ValueError:
+        return str(status)
+
+
+class HowFastASGIMiddleware(CoreAPM):
+    """
+    ASGI middleware to measure how much time is spent per endpoint, for Starlette, FastAPI, Quart...
+
+    The points are sent by an asyncio task running on the event loop of the application (see
+    AsyncRunner), instead of a background thread.
+    """
+
+    runner: Optional[AsyncRunner] = None
+
+    def __init__(
+            self,
+            # The ASGI application to analyze
+            app: ASGIApp,
+            # The HowFast app ID to use
+            app_id: str = None,
+            # Endpoints not to monitor
+            endpoints_blacklist: List[str] = None,
+            # Only monitor these endpoints (all of them by default)
+            endpoints_allowlist: List[str] = None,
+            # Other configuration parameters passed to the CoreAPM constructor
+            **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.app = app
+        self.endpoints_blacklist = compile_endpoints(*(endpoints_blacklist or []))
+        self.endpoints_allowlist = compile_endpoints(*endpoints_allowlist) if endpoints_allowlist is not None else None
+        self.setup(app_id)
+
+    def start_background_thread(self):
+        """ Start the task that will consume points from the queue, on the running event loop """
+        self.runner = AsyncRunner(queue=queue, app_id=self.app_id, overhead=self.overhead)
+        self.runner.start()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if not self.app_id:
+            # HF APM not configured
+            return await self.app(scope, receive, send)
+        if scope['type'] == 'lifespan':
+            return await self.app(scope, receive, self._wrap_lifespan_send(send))
+        if scope['type'] != 'http':
+            # Websockets are not reported
+            return await self.app(scope, receive, send)
+
+        uri = scope.get('path')
+        if is_in_blacklist(uri, self.endpoints_blacklist):
+            return await self.app(scope, receive, send)
+        if self.endpoints_allowlist is not None and not is_in_blacklist(uri, self.endpoints_allowlist):
+            return await self.app(scope, receive, send)
+
+        method = scope.get('method')
+        sampled = self.sampler.sample() if self.sampler.enabled else True
+        # Each request runs in its own task, with its own copy of the context
+        self.reset_interactions(record=sampled)
+
+        response_status: Optional[str] = None
+        first_byte: Optional[int] = None
+        response_bytes = 0
+        end: Optional[int] = None
+
+        async def _send_wrapped(message: Message) -> None:
+            nonlocal response_status, first_byte, response_bytes, end
+            if message['type'] == 'http.response.start':
+                response_status = status_line(message['status'])
+            elif message['type'] == 'http.response.body':
+                body = message.get('body')
+                if body:
+                    if first_byte is None:
+                        first_byte = perf_counter_ns()
+                    response_bytes += len(body)
+            await send(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                # The last part of the body was handed to the server: the response is complete
+                end = perf_counter_ns()
+
+        stalls = self.stall_monitor.snapshot() if self.stall_monitor is not None else None
+        time_request_started_ns = time.time_ns()
+        start = perf_counter_ns()
+        try:
+            await self.app(scope, receive, _send_wrapped)
+        except BaseException:
+            if response_status is None:
+                # The server will answer with an error, since the application didn't
+                response_status = "500 INTERNAL SERVER ERROR"
+            raise
+        finally:
+            if end is None:
+                end = perf_counter_ns()
+            url_rule, endpoint_name = self._route_metadata(scope)
+            if not self.sampler.enabled or self.sampler.keep(sampled, url_rule or endpoint_name, end - start, response_status):
+                gc_pause_ns, stall_ns = self.stall_monitor.since(stalls) if stalls is not None else (None, None)
+                self.save_point(
+                    time_request_started_ns=time_request_started_ns,
+                    time_elapsed_ns=end - start,
+                    method=method,
+                    uri=uri,
+                    response_status=response_status,
+                    endpoint_name=endpoint_name,
+                    url_rule=url_rule,
+                    is_not_found=self._is_not_found(endpoint_name, response_status),
+                    time_to_first_byte_ns=first_byte - start if first_byte is not None else None,
+                    response_bytes=response_bytes,
+                    gc_pause_ns=gc_pause_ns,
+                    stall_ns=stall_ns,
+                )
+                self.overhead.observe(perf_counter_ns() - end)
+
+    @staticmethod
+    def _route_metadata(scope: Scope):
+        """ Route pattern and endpoint name, as set in the scope by the router of the framework """
+        # Starlette and FastAPI store the matched route and endpoint in the scope
+        route = scope.get('route')
+        endpoint = scope.get('endpoint')
+        url_rule = getattr(route, 'path', None)
+        endpoint_name = getattr(endpoint, '__name__', None)
+        return url_rule, endpoint_name
+
+    @staticmethod
+    def _is_not_found(endpoint_name: Optional[str], response_status: Optional[str]) -> Optional[bool]:
+        """ Tell the difference between a "real" 404 and a 404 returned by an existing endpoint """
+        if endpoint_name is not None:
+            return False
+        if response_status is not None and response_status.startswith('404'):
+            return True
+        return None
+
+    def _wrap_lifespan_send(self, send: Send) -> Send:
+        """ Send the remaining points once the application has shut down """
+
+        async def _send_wrapped(message: Message) -> None:
+            if message['type'] == 'lifespan.shutdown.complete' and self.runner is not None:
+                await self.runner.stop(self.shutdown_timeout)
+            await send(message)
+
+        return _send_wrapped
@@ -0,0 +1,261 @@
+import time
+import asyncio
+import logging
+from functools import partial
+from itertools import count
+from threading import Event
+from typing import Optional, Tuple
+
+import requests
+
+from .hook_http import without_interactions
+from .queue import RingBuffer
+from .runner import COMPRESSORS, BaseRunner, estimate_size
+
+try:
+    import httpx
+except ModuleNotFoundError:
+    # httpx is an optional dependency: without it, the batches are posted with requests from the
+    # default executor of the event loop
+    httpx = None
+
+logger = logging.getLogger('howfast_apm')
+
+
+class AsyncRunner(BaseRunner):
+    """
+    asyncio task dedicated to sending the points stored in the queue to the API, for ASGI
+    applications. It runs on the event loop of the application, and never blocks it: the points are
+    taken from the queue without waiting, and the batches are posted with httpx when it is installed.
+    """
+
+    # Set by shutdown() or stop(): the task flushes the remaining points and exits
+    stopping: Event
+
+    def __init__(self, queue: RingBuffer, app_id: str, **kwargs):
+        super().__init__(queue, app_id, **kwargs)
+        self.stopping = Event()
+        self._task: Optional[asyncio.Task] = None
+        # Wakes up the task when it is waiting for points. Created on the event loop.
+        self._wakeup: Optional[asyncio.Event] = None
+        # The httpx client is bound to the event loop it was created in
+        self._client = None
+        self._client_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.session = requests.Session() if httpx is None else None
+
+    def start(self) -> None:
+        """ Start the task on the running event loop """
+        self._wakeup = asyncio.Event()
+        # Keep a reference to the task, otherwise it could be garbage-collected while it runs
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self) -> None:
+        while not self.stopping.is_set():
+            await self.run_once()
+        await self.flush()
+
+    async def stop(self, timeout: float) -> None:
+        """ Stop the task and wait for it to send the remaining points, for up to `timeout` seconds """
+        self.deadline = time.monotonic() + timeout
+        self.stopping.set()
+        if self._task is None or self._task.done():
+            return
+        self._wakeup.set()
+        try:
+            # Shielded, so that the flush goes on if the caller is cancelled
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("APM task did not stop within %.1fs, some points may be lost", timeout)
+
+    def shutdown(self, timeout: float) -> None:
+        """
+        Stop the task, from outside of the event loop (when the process exits, or from a signal
+        handler). If the event loop is not running anymore, send the remaining points from here.
+        """
+        self.deadline = time.monotonic() + timeout
+        self.stopping.set()
+        if self._task is None or self._task.done():
+            return
+        loop = self._task.get_loop()
+        if loop.is_running():
+            # The task flushes the remaining points on its own loop
+            loop.call_soon_threadsafe(self._wakeup.set)
+            return
+        try:
+            asyncio.run(asyncio.wait_for(self.flush(), timeout))
+        except Exception:
+            logger.error("Runner was unable to send the last batch", exc_info=True)
+
+    async def flush(self) -> None:
+        """ Send everything that is left in the queue, in a single batch and without retrying """
+        try:
+            self._batch_remaining_points()
+            if self.current_batch:
+                await self.send_batch()
+                # The API is reachable: don't wait for the end of the backoff delay
+                self.backoff.reset()
+            # The batches that failed before would be lost with the memory spool
+            await self._send_spooled_batches(until_deadline=True)
+        except Exception:
+            logger.error("Runner was unable to send the last batch", exc_info=True)
+            self._spool_current_batch()
+        finally:
+            self.spool.close()
+            await self._close_client()
+
+    async def run_once(self) -> None:
+        try:
+            if self.aggregator is not None:
+                await self._aggregate_points()
+            else:
+                await self._collect_points()
+        except Exception:
+            logger.error("Runner crashed:", exc_info=True)
+            return
+
+        if self.current_batch:
+            await self._send_batch_robust()
+
+        await self._send_spooled_batches()
+
+        if self.overhead is not None and self.summary_interval > 0:
+            if time.monotonic() - self._last_summary_time >= self.summary_interval:
+                self.log_overhead_summary()
+
+    async def _wait(self, delay: float) -> None:
+        """ Wait for `delay` seconds, or until the task is stopped """
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _collect_points(self) -> None:
+        """ Same as Runner._collect_points, waiting asynchronously """
+        batch_bytes = sum(map(estimate_size, self.current_batch))
+        batch_started = time.monotonic()
+        # Start with the points that didn't fit in the previous batch
+        points, self._overflow = self._overflow, []
+        batch_bytes = self._add_to_batch(points, batch_bytes)
+        while not self._overflow and len(self.current_batch) < self.batch_size and batch_bytes < self.max_batch_bytes:
+            points = self.queue.drain(self.batch_size - len(self.current_batch))
+            if points:
+                if not self.current_batch:
+                    batch_started = time.monotonic()
+                batch_bytes = self._add_to_batch(points, batch_bytes)
+                continue
+
+            if self.stopping.is_set():
+                break
+            if not self.current_batch:
+                # Nothing to send yet: wait for new points
+                await self._wait(self.sleep_delay)
+                if self.queue.empty():
+                    break
+                continue
+
+            lingered = time.monotonic() - batch_started
+            if lingered >= self.max_linger:
+                break
+            # Wait for more points, but don't make the first point of the batch wait too long
+            await self._wait(min(self.sleep_delay, self.max_linger - lingered))
+
+    async def _aggregate_points(self) -> None:
+        """ Fold the points from the queue in the aggregates, and batch them at the end of the window """
+        points = self.queue.drain()
+        for point in points:
+            self.aggregator.add(point)
+        if not points:
+            await self._wait(self.sleep_delay)
+        if self.aggregator.window_elapsed >= self.aggregation_window:
+            self.current_batch.extend(self.aggregator.flush())
+
+    async def _send_batch_robust(self) -> None:
+        """ Send the batch, or keep it to send it again later if the API can't be reached """
+        if self.backoff.failures and not self.backoff.ready():
+            self._spool_current_batch()
+            return
+        try:
+            await self.send_batch()
+            self.backoff.reset()
+        except Exception:
+            delay = self.backoff.failure()
+            logger.error("Runner was unable to send performance data, trying again in %.1fs", delay, exc_info=True)
+            self._spool_current_batch()
+
+    async def _send_spooled_batches(self, until_deadline: bool = False) -> None:
+        """
+        Send the batches that previously failed, oldest first, if the backoff delay is over: up to
+        max_replayed_batches, or as many as possible before the shutdown deadline (`until_deadline`)
+        """
+        if not self.backoff.ready():
+            return
+        unbounded = until_deadline and self.deadline is not None
+        for _ in count() if unbounded else range(self.max_replayed_batches):
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                return
+            body = self.spool.peek()
+            if body is None:
+                return
+            try:
+                await self.send_payload(body)
+            except Exception:
+                delay = self.backoff.failure()
+                logger.error("Runner was unable to send a previous batch, trying again in %.1fs", delay, exc_info=True)
+                return
+            self.spool.pop()
+            self.backoff.reset()
+
+    async def send_batch(self) -> None:
+        """ Send the current batch to the API, and empty it if it was sent """
+        logger.debug("Posting %d point(s) to the server", len(self.current_batch))
+        await self.send_payload(self.encode_batch())
+        self.current_batch = []
+
+    async def send_payload(self, body: bytes) -> None:
+        """ Send a serialized batch to the API. Raises UploadError if it should be sent again later. """
+        status_code, content = await self._post(body)
+        while status_code == 415:
+            body = self._fallback_encoding(body)
+            if body is None:
+                break
+            status_code, content = await self._post(body)
+        self._check_response(status_code, content)
+
+    async def _post(self, body: bytes) -> Tuple[int, bytes]:
+        """ Compress the serialized batch and post it to the API, returning the status and the content """
+        data = COMPRESSORS[self.compression](body)
+        if httpx is not None:
+            response = await self._get_client().post(
+                self.collector_url,
+                content=data,
+                headers=self._request_headers(body),
+                timeout=self._request_timeout(),
+            )
+        else:
+            response = await asyncio.get_running_loop().run_in_executor(None, partial(
+                self._post_in_executor,
+                data=data,
+                headers=self._request_headers(body),
+                timeout=self._request_timeout(),
+            ))
+        return response.status_code, response.content
+
+    def _post_in_executor(self, **kwargs) -> requests.Response:
+        # The threads of the executor are shared with the application: the batches must not be
+        # recorded as its interactions
+        with without_interactions():
+            return self.session.post(self.collector_url, **kwargs)
+
+    def _get_client(self):
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            self._client = httpx.AsyncClient()
+            self._client_loop = loop
+        return self._client
+
+    async def _close_client(self) -> None:
+        if self._client is not None and self._client_loop is asyncio.get_running_loop():
+            await self._client.aclose()
+        self._client = self._client_loop = None
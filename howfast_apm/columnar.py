@@ -0,0 +1,221 @@
+"""
+Columnar encoding of the batches: a table of the distinct strings of the batch, followed by one
+array per field of the points. Much smaller and cheaper to build than the JSON encoding, since the
+method, endpoint and status of the points are only written once, and the timestamps are integers.
+
+Layout (little-endian), after the MAGIC bytes:
+* number of points, number of interactions, number of strings (3 x uint32)
+* the strings: lengths (uint32 array), then the concatenated UTF-8 bytes. The DSN is the first one.
+* the columns of the points: time_request_started_ns, time_elapsed_ns, time_to_first_byte_ns,
+  response_bytes, gc_pause_ns and stall_ns (int64 arrays, -1 for None); method, uri, response_status, endpoint_name,
+  url_rule and profile (int32 arrays of string indexes, -1 for None); is_not_found (int8 array, -1 for None);
+  number of interactions and number of spans (int32 arrays)
+* the columns of the interactions: interaction_type, name, extra as JSON (int32 arrays of string
+  indexes), elapsed (float64 array, seconds)
+* the columns of the spans: name (int32 array of string indexes), start and duration (int64 arrays,
+  nanoseconds since the start of the request), parent (int32 array of indexes in the spans of the
+  point, -1 for None)
+* the aggregates, as JSON (length as uint32, then the UTF-8 bytes), empty when not aggregating
+"""
+import json
+import struct
+from itertools import count
+from operator import attrgetter
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .point import Point
+from .utils import format_timestamps
+
+CONTENT_TYPE = 'application/vnd.howfast.apm-columnar'
+MAGIC = b'HFC\x01'
+
+COUNTS = struct.Struct('<III')
+UINT32 = struct.Struct('<I')
+
+INT64_COLUMNS = ('time_request_started_ns', 'time_elapsed_ns', 'time_to_first_byte_ns', 'response_bytes', 'gc_pause_ns', 'stall_ns')
+STRING_COLUMNS = ('method', 'uri', 'response_status', 'endpoint_name', 'url_rule', 'profile')
+# Attributes of the points, in the order of their columns
+POINT_COLUMNS = (*INT64_COLUMNS, *STRING_COLUMNS, 'is_not_found', 'interactions', 'spans')
+INTERACTION_STRING_COLUMNS = ('interaction_type', 'name', 'extra')
+
+
+def _pack(typecode: str, values: List) -> bytes:
+    """ Pack a column of values (struct format character), little-endian """
+    return struct.pack(f'<{len(values)}{typecode}', *values)
+
+
+def _unpack(typecode: str, data: memoryview, offset: int, count: int) -> Tuple[Tuple, int]:
+    column_format = struct.Struct(f'<{count}{typecode}')
+    return column_format.unpack_from(data, offset), offset + column_format.size
+
+
+def encode_columnar(app_id: str, points: List[Point], aggregates: List[Dict[str, Any]] = None) -> bytes:
+    """ Encode a batch of points (and serialized aggregates) """
+    # Index of each string in the table. Dicts keep the insertion order, which is the order of the
+    # indexes. None is not part of the table.
+    indexes: Dict[Optional[str], int] = {None: -1, app_id: 0}
+
+    def string_column(values: Iterable[Optional[str]]) -> bytes:
+        values = list(values)
+        # Set operations, to avoid a Python loop over the values
+        new_strings = set(values) - indexes.keys()
+        indexes.update(zip(new_strings, count(len(indexes) - 1)))
+        return _pack('i', list(map(indexes.__getitem__, values)))
+
+    def extra_column(extras: Iterable[dict]) -> bytes:
+        # Most interactions have the same extra information: only serialize it once
+        serialized: Dict[Any, str] = {}
+        values = []
+        for extra in extras:
+            try:
+                key = tuple(extra.items())
+                value = serialized.get(key)
+                if value is None:
+                    value = serialized[key] = json.dumps(extra)
+            except TypeError:
+                # Nested values (the example of a rollup) are not hashable, and are unique anyway
+                value = json.dumps(extra)
+            values.append(value)
+        return string_column(values)
+
+    def int64_column(values: Sequence[Optional[int]]) -> bytes:
+        if None in values:
+            values = [-1 if value is None else value for value in values]
+        return _pack('q', values)
+
+    # One tuple per point, then one tuple per field
+    columns = list(zip(*map(attrgetter(*POINT_COLUMNS), points))) or [()] * len(POINT_COLUMNS)
+    parts = [int64_column(column) for column in columns[:len(INT64_COLUMNS)]]
+    parts.extend(string_column(column) for column in columns[len(INT64_COLUMNS):-3])
+    parts.append(_pack('b', [-1 if value is None else value for value in columns[-3]]))
+    parts.append(_pack('i', list(map(len, columns[-2]))))
+    parts.append(_pack('i', list(map(len, columns[-1]))))
+
+    interactions = [interaction for point_interactions in columns[-2] for interaction in point_interactions]
+    parts.append(string_column(interaction.interaction_type for interaction in interactions))
+    parts.append(string_column(interaction.name for interaction in interactions))
+    parts.append(extra_column(interaction.extra for interaction in interactions))
+    parts.append(_pack('d', [interaction.elapsed for interaction in interactions]))
+
+    spans = [span for point_spans in columns[-1] for span in point_spans]
+    span_columns = list(zip(*spans)) or [()] * 4
+    parts.append(string_column(span_columns[0]))
+    parts.append(_pack('q', span_columns[1]))
+    parts.append(_pack('q', span_columns[2]))
+    parts.append(_pack('i', span_columns[3]))
+
+    encoded_aggregates = json.dumps(aggregates).encode('utf-8') if aggregates is not None else b''
+    parts.append(UINT32.pack(len(encoded_aggregates)))
+    parts.append(encoded_aggregates)
+
+    del indexes[None]
+    encoded_strings = [value.encode('utf-8') for value in indexes]
+    return b''.join([
+        MAGIC,
+        COUNTS.pack(len(points), len(interactions), len(encoded_strings)),
+        _pack('I', list(map(len, encoded_strings))),
+        *encoded_strings,
+        *parts,
+    ])
+
+
+def is_columnar(body: bytes) -> bool:
+    return body[:len(MAGIC)] == MAGIC
+
+
+def decode_columnar(body: bytes) -> Dict[str, Any]:
+    """ Decode a batch into the same payload as the JSON encoding """
+    if not is_columnar(body):
+        raise ValueError("Not a columnar batch")
+    data = memoryview(body)
+    offset = len(MAGIC)
+    points_count, interactions_count, strings_count = COUNTS.unpack_from(data, offset)
+    offset += COUNTS.size
+
+    lengths, offset = _unpack('I', data, offset, strings_count)
+    strings = []
+    for length in lengths:
+        strings.append(bytes(data[offset:offset + length]).decode('utf-8'))
+        offset += length
+
+    columns = {}
+    for field in INT64_COLUMNS:
+        columns[field], offset = _unpack('q', data, offset, points_count)
+    for field in STRING_COLUMNS:
+        columns[field], offset = _unpack('i', data, offset, points_count)
+    columns['is_not_found'], offset = _unpack('b', data, offset, points_count)
+    columns['interactions'], offset = _unpack('i', data, offset, points_count)
+    columns['spans'], offset = _unpack('i', data, offset, points_count)
+    for field in INTERACTION_STRING_COLUMNS:
+        columns[field], offset = _unpack('i', data, offset, interactions_count)
+    columns['elapsed'], offset = _unpack('d', data, offset, interactions_count)
+    spans_count = sum(columns['spans'])
+    columns['span_name'], offset = _unpack('i', data, offset, spans_count)
+    columns['span_start'], offset = _unpack('q', data, offset, spans_count)
+    columns['span_duration'], offset = _unpack('q', data, offset, spans_count)
+    columns['span_parent'], offset = _unpack('i', data, offset, spans_count)
+    (aggregates_length, ) = UINT32.unpack_from(data, offset)
+    offset += UINT32.size
+    aggregates = json.loads(bytes(data[offset:offset + aggregates_length])) if aggregates_length else None
+
+    def string(position: int) -> Optional[str]:
+        return strings[position] if position >= 0 else None
+
+    timestamps = format_timestamps(columns['time_request_started_ns'])
+    perf = []
+    interaction_index = 0
+    span_index = 0
+    for row in range(points_count):
+        interactions = []
+        for _ in range(columns['interactions'][row]):
+            interactions.append({
+                'interaction_type': string(columns['interaction_type'][interaction_index]),
+                'name': string(columns['name'][interaction_index]),
+                'elapsed': columns['elapsed'][interaction_index],
+                'extra': json.loads(string(columns['extra'][interaction_index])),
+            })
+            interaction_index += 1
+        point = {
+            'method': string(columns['method'][row]),
+            'uri': string(columns['uri'][row]),
+            'time_request_started': timestamps[row],
+            'time_elapsed': columns['time_elapsed_ns'][row] / 1e9,
+            'interactions': interactions,
+            'response_status': string(columns['response_status'][row]),
+            'endpoint_name': string(columns['endpoint_name'][row]),
+        }
+        # Same optional fields as Runner.serialize_point
+        url_rule = string(columns['url_rule'][row])
+        if url_rule:
+            point['url_rule'] = url_rule
+        if columns['is_not_found'][row] >= 0:
+            point['is_not_found'] = bool(columns['is_not_found'][row])
+        if columns['time_to_first_byte_ns'][row] >= 0:
+            point['time_to_first_byte'] = columns['time_to_first_byte_ns'][row] / 1e9
+        if columns['response_bytes'][row] >= 0:
+            point['response_bytes'] = columns['response_bytes'][row]
+        if columns['spans'][row]:
+            spans = []
+            for _ in range(columns['spans'][row]):
+                parent = columns['span_parent'][span_index]
+                spans.append({
+                    'name': string(columns['span_name'][span_index]),
+                    'start': columns['span_start'][span_index] / 1e9,
+                    'elapsed': columns['span_duration'][span_index] / 1e9,
+                    'parent': parent if parent >= 0 else None,
+                })
+                span_index += 1
+            point['spans'] = spans
+        profile = string(columns['profile'][row])
+        if profile:
+            point['profile'] = profile
+        if columns['gc_pause_ns'][row] >= 0:
+            point['gc_pause'] = columns['gc_pause_ns'][row] / 1e9
+        if columns['stall_ns'][row] >= 0:
+            point['stall'] = columns['stall_ns'][row] / 1e9
+        perf.append(point)
+
+    payload = {'dsn': strings[0], 'perf': perf}
+    if aggregates is not None:
+        payload['aggregates'] = aggregates
+    return payload
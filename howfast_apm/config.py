@@ -11,3 +11,114 @@ HOWFAST_APM_RECORD_INTERACTIONS = os.environ.get(
     'HOWFAST_APM_RECORD_INTERACTIONS',
     False,
 )
+
+# Also record the queries sent by SQLAlchemy and redis-py (requires HOWFAST_APM_RECORD_INTERACTIONS)
+HOWFAST_APM_RECORD_DB_INTERACTIONS = os.environ.get('HOWFAST_APM_RECORD_DB_INTERACTIONS', '').lower() in ('1', 'true', 'yes')
+
+# Number of interactions kept individually per request: the other ones are rolled up per type, name
+# and method (count, total and maximum elapsed time, and the slowest one)
+HOWFAST_APM_MAX_INTERACTIONS = int(os.environ.get(
+    'HOWFAST_APM_MAX_INTERACTIONS',
+    100,
+))
+
+# Sample the stacks of the requests that take longer than X seconds (0 to disable)
+HOWFAST_APM_PROFILE_THRESHOLD = float(os.environ.get(
+    'HOWFAST_APM_PROFILE_THRESHOLD',
+    0,
+))
+
+# Time between two samples of the slow requests, in seconds
+HOWFAST_APM_PROFILE_INTERVAL = float(os.environ.get(
+    'HOWFAST_APM_PROFILE_INTERVAL',
+    0.02,
+))
+
+# Share of a CPU that the profiler may use: the sampling interval grows if sampling costs more
+HOWFAST_APM_PROFILE_CPU_BUDGET = float(os.environ.get(
+    'HOWFAST_APM_PROFILE_CPU_BUDGET',
+    0.01,
+))
+
+# Time the garbage collections, and report the time each request spent paused by them
+HOWFAST_APM_RECORD_STALLS = os.environ.get('HOWFAST_APM_RECORD_STALLS', '').lower() in ('1', 'true', 'yes')
+
+# Run a watchdog thread waking up every X seconds, to measure the stalls of the interpreter (time
+# waiting for the GIL or for a CPU). Disabled by default (0).
+HOWFAST_APM_STALL_WATCHDOG_INTERVAL = float(os.environ.get(
+    'HOWFAST_APM_STALL_WATCHDOG_INTERVAL',
+    0,
+))
+
+# Content-Encoding used to compress the batches sent to the collector: "gzip", "zstd" (requires the
+# `zstandard` package) or "identity" to disable compression
+HOWFAST_APM_COMPRESSION = os.environ.get(
+    'HOWFAST_APM_COMPRESSION',
+    'gzip',
+)
+
+# Encoding of the batches sent to the collector: "json", or "columnar" (much smaller and cheaper to
+# encode, see howfast_apm/columnar.py)
+HOWFAST_APM_WIRE_FORMAT = os.environ.get(
+    'HOWFAST_APM_WIRE_FORMAT',
+    'json',
+)
+
+# Log a summary of the overhead of the APM every X seconds (0 to disable)
+HOWFAST_APM_OVERHEAD_SUMMARY_INTERVAL = float(os.environ.get(
+    'HOWFAST_APM_OVERHEAD_SUMMARY_INTERVAL',
+    0,
+))
+
+# Send aggregated statistics per endpoint instead of one point per request
+HOWFAST_APM_AGGREGATE = os.environ.get('HOWFAST_APM_AGGREGATE', '').lower() in ('1', 'true', 'yes')
+
+# When aggregating, send the statistics every X seconds
+HOWFAST_APM_AGGREGATION_WINDOW = float(os.environ.get(
+    'HOWFAST_APM_AGGREGATION_WINDOW',
+    60,
+))
+
+# Probability for a request to be reported (between 0 and 1)
+HOWFAST_APM_SAMPLE_RATE = float(os.environ.get(
+    'HOWFAST_APM_SAMPLE_RATE',
+    1.0,
+))
+
+# Report at most X requests per second and per endpoint (0 for no limit)
+HOWFAST_APM_ENDPOINT_RATE_LIMIT = float(os.environ.get(
+    'HOWFAST_APM_ENDPOINT_RATE_LIMIT',
+    0,
+))
+
+# Lower the sampling rate when the queue of points fills up
+HOWFAST_APM_ADAPTIVE_SAMPLING = os.environ.get('HOWFAST_APM_ADAPTIVE_SAMPLING', '').lower() in ('1', 'true', 'yes')
+
+# Requests slower than X seconds are always reported, even if they were not sampled
+HOWFAST_APM_SLOW_THRESHOLD = float(os.environ.get(
+    'HOWFAST_APM_SLOW_THRESHOLD',
+    1.0,
+))
+
+# When the process exits, wait up to X seconds for the remaining points to be sent
+HOWFAST_APM_SHUTDOWN_TIMEOUT = float(os.environ.get(
+    'HOWFAST_APM_SHUTDOWN_TIMEOUT',
+    5,
+))
+
+# Flush the remaining points when the process receives SIGTERM, before the previous handler runs
+HOWFAST_APM_HANDLE_SIGTERM = os.environ.get('HOWFAST_APM_HANDLE_SIGTERM', '').lower() in ('1', 'true', 'yes')
+
+# Directory where the batches that could not be sent are stored until the API is reachable again.
+# By default, they are only kept in memory.
+HOWFAST_APM_SPOOL_DIR = os.environ.get('HOWFAST_APM_SPOOL_DIR')
+
+# Maximum size of the spool directory, in bytes: the oldest batches are dropped past this size
+HOWFAST_APM_SPOOL_MAX_BYTES = int(os.environ.get(
+    'HOWFAST_APM_SPOOL_MAX_BYTES',
+    64 * 1024 * 1024,
+))
+
+# Send the points to the per-host agent (howfast-apm-agent) listening on this Unix socket, instead of
+# sending them to the API from a background thread in each process
+HOWFAST_APM_AGENT_SOCKET = os.environ.get('HOWFAST_APM_AGENT_SOCKET')
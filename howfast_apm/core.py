@@ -1,16 +1,46 @@
 import os
+import atexit
+import signal
 import logging
-from typing import Optional, List
-from datetime import datetime
-from queue import Full, Empty
+import threading
+from time import perf_counter_ns
+from contextvars import ContextVar
+from typing import Dict, Optional, Sequence
 
-from .config import HOWFAST_APM_RECORD_INTERACTIONS
+from .agent import AgentSink
+from .config import (
+    HOWFAST_APM_ADAPTIVE_SAMPLING,
+    HOWFAST_APM_AGENT_SOCKET,
+    HOWFAST_APM_ENDPOINT_RATE_LIMIT,
+    HOWFAST_APM_HANDLE_SIGTERM,
+    HOWFAST_APM_MAX_INTERACTIONS,
+    HOWFAST_APM_PROFILE_THRESHOLD,
+    HOWFAST_APM_RECORD_DB_INTERACTIONS,
+    HOWFAST_APM_RECORD_INTERACTIONS,
+    HOWFAST_APM_RECORD_STALLS,
+    HOWFAST_APM_SAMPLE_RATE,
+    HOWFAST_APM_SHUTDOWN_TIMEOUT,
+    HOWFAST_APM_SLOW_THRESHOLD,
+    HOWFAST_APM_STALL_WATCHDOG_INTERVAL,
+)
+from .metrics import Histogram, HistogramSnapshot
+from .point import Point
+from .profiler import Profiler
 from .queue import queue
 from .runner import Runner
+from .sampling import Sampler
+from .spans import Span, SpanRecorder
+from .stalls import StallMonitor, stall_monitor
+from .hook_db import TracedConnection, install_db_hooks
+from .hook_http import install_http_hooks
 from .hook_requests import install_hooks, Interaction
+from .interactions import InteractionBuffer
 
 logger = logging.getLogger('howfast_apm')
 
+# Stored in place of the list of interactions for requests that are not sampled
+NOT_RECORDING: Sequence[Interaction] = ()
+
 
 class CoreAPM:
     """
@@ -20,17 +50,88 @@ class CoreAPM:
     * storing external interactions
     """
 
-    app_id: Optional[str]
+    app_id: Optional[str] = None
+
+    # Started on the first request, so that each process (e.g. forked worker) has its own
+    runner: Optional[Runner] = None
 
-    runner: Optional[Runner]
+    # Unix socket of the per-host agent. When set, the points are sent to the agent by the sink and
+    # no background thread is started.
+    agent_socket: Optional[str]
+    sink: Optional[AgentSink] = None
 
     record_interactions: bool
-    interactions: List[Interaction] = []
+    # Also record the queries of SQLAlchemy and redis-py
+    record_db_interactions: bool
+    # Number of interactions kept individually per request, the other ones are rolled up
+    max_interactions: int
+    # Interactions of the current request. Using a context variable means that each thread (or
+    # greenlet, or asyncio task) records its interactions in its own list.
+    _interactions: ContextVar[Optional[Sequence[Interaction]]]
+    # Spans of the current request, None outside of a request or if the request is not sampled
+    _spans: ContextVar[Optional[SpanRecorder]]
+
+    # Time spent by the middleware to save each point, in nanoseconds
+    overhead: Histogram
+
+    # Decides which requests are reported
+    sampler: Sampler
+
+    # Samples the stacks of the slow requests, if enabled
+    profiler: Optional[Profiler]
 
-    def __init__(self, record_interactions=HOWFAST_APM_RECORD_INTERACTIONS):
+    # Times the garbage collections and the stalls of the interpreter, once set up and if enabled
+    stall_monitor: Optional[StallMonitor] = None
+
+    def __init__(
+            self,
+            record_interactions=HOWFAST_APM_RECORD_INTERACTIONS,
+            # Also record the queries sent by SQLAlchemy and redis-py
+            record_db_interactions: bool = HOWFAST_APM_RECORD_DB_INTERACTIONS,
+            # Interactions kept individually per request, the other ones are rolled up
+            max_interactions: int = HOWFAST_APM_MAX_INTERACTIONS,
+            # Probability for a request to be reported
+            sample_rate: float = HOWFAST_APM_SAMPLE_RATE,
+            # Maximum number of requests reported per second and per endpoint
+            endpoint_rate_limit: float = HOWFAST_APM_ENDPOINT_RATE_LIMIT,
+            # Lower the sampling rate when the queue fills up
+            adaptive_sampling: bool = HOWFAST_APM_ADAPTIVE_SAMPLING,
+            # Requests slower than this (in seconds) are always reported
+            slow_threshold: float = HOWFAST_APM_SLOW_THRESHOLD,
+            # When the process exits, wait up to X seconds for the remaining points to be sent
+            shutdown_timeout: float = HOWFAST_APM_SHUTDOWN_TIMEOUT,
+            # Send the remaining points when the process receives SIGTERM
+            handle_sigterm: bool = HOWFAST_APM_HANDLE_SIGTERM,
+            # Send the points to the per-host agent listening on this Unix socket
+            agent_socket: str = HOWFAST_APM_AGENT_SOCKET,
+            # Sample the stacks of the requests slower than this (in seconds)
+            profile_threshold: float = HOWFAST_APM_PROFILE_THRESHOLD,
+            # Report the time each request was paused by the garbage collector
+            record_stalls: bool = HOWFAST_APM_RECORD_STALLS,
+            # Also measure the stalls of the interpreter with a watchdog thread waking up every X seconds
+            stall_watchdog_interval: float = HOWFAST_APM_STALL_WATCHDOG_INTERVAL,
+    ):
         self.record_interactions = bool(record_interactions)
         logger.debug("Interactions will %s", 'be enabled' if self.record_interactions else 'NOT be enabled')
-        self.interactions = []
+        self.record_db_interactions = bool(record_db_interactions)
+        self.max_interactions = max_interactions
+        self._interactions = ContextVar(f'howfast_apm_interactions_{id(self)}', default=None)
+        self._spans = ContextVar(f'howfast_apm_spans_{id(self)}', default=None)
+        self.overhead = Histogram()
+        self.sampler = Sampler(
+            rate=sample_rate,
+            endpoint_rate_limit=endpoint_rate_limit,
+            adaptive=adaptive_sampling,
+            slow_threshold=slow_threshold,
+            queue=queue,
+        )
+        self.shutdown_timeout = shutdown_timeout
+        self.handle_sigterm = handle_sigterm
+        self.agent_socket = agent_socket
+        self.profiler = Profiler(profile_threshold) if profile_threshold else None
+        self.record_stalls = bool(record_stalls or stall_watchdog_interval)
+        self.stall_watchdog_interval = stall_watchdog_interval
+        self._runner_lock = threading.Lock()
 
     def setup(
             self,
@@ -44,81 +145,191 @@ class CoreAPM:
 
         if self.app_id:
             logger.info(f"HowFast APM configured with DSN {self.app_id}")
-            self.start_background_thread()
+            if self.agent_socket:
+                logger.info(f"Sending the performance data to the agent at {self.agent_socket}")
+                self.sink = AgentSink(self.agent_socket, self.app_id)
+            else:
+                # The background thread is only started on the first request. With pre-fork servers
+                # (gunicorn --preload, uWSGI), the application is set up in the master process and
+                # threads don't survive the fork: each worker starts its own thread.
+                os.register_at_fork(after_in_child=self._after_fork_in_child)
+                # Send the remaining points when the process exits
+                atexit.register(self.shutdown)
+                if self.handle_sigterm:
+                    self._install_sigterm_handler()
             if self.record_interactions:
                 self.setup_hooks()
+            if self.record_stalls:
+                self.stall_monitor = stall_monitor.install(self.stall_watchdog_interval)
         else:
             logger.warning("HowFast APM initialized with no DSN, reporting will be disabled.")
 
     def start_background_thread(self):
         """ Start the thread that will consume points from the queue and send them to the API """
-        self.runner = Runner(queue=queue, app_id=self.app_id)
+        self.runner = Runner(queue=queue, app_id=self.app_id, overhead=self.overhead)
         self.runner.start()
-        # TODO: stop the thread at some point?
+
+    def _ensure_background_thread(self) -> None:
+        """ Start the background thread if it isn't running in this process yet """
+        with self._runner_lock:
+            if self.runner is None:
+                self.start_background_thread()
+
+    def _after_fork_in_child(self) -> None:
+        """ Reset the state inherited from the parent process """
+        # The parent's thread doesn't exist in the child, and the lock may have been held
+        self.runner = None
+        self._runner_lock = threading.Lock()
+        # The points in the queue belong to the parent, which will send them
+        queue.reset()
+        self.overhead = Histogram()
+        self.sampler.reset()
+        if self.profiler is not None:
+            self.profiler.reset()
+
+    def shutdown(self, timeout: float = None) -> None:
+        """
+        Stop the background thread, after sending the points that are still in the queue. Blocks
+        for up to `timeout` seconds (shutdown_timeout by default).
+
+        This is called automatically when the process exits normally. It can also be called from
+        the server's hooks, for example from gunicorn's `worker_exit`.
+        """
+        if self.runner is None or self.runner.stopping.is_set():
+            return
+        self.runner.shutdown(self.shutdown_timeout if timeout is None else timeout)
+
+    def _install_sigterm_handler(self) -> None:
+        """ Call shutdown() when SIGTERM is received, then the handler that was installed before """
+        if threading.current_thread() is not threading.main_thread():
+            logger.warning("SIGTERM handler can only be installed from the main thread, skipping")
+            return
+        previous_handler = signal.getsignal(signal.SIGTERM)
+
+        def handle_sigterm(signum, frame):
+            self.shutdown()
+            if callable(previous_handler):
+                previous_handler(signum, frame)
+            elif previous_handler == signal.SIG_DFL:
+                # Let the default behavior terminate the process
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+
+        signal.signal(signal.SIGTERM, handle_sigterm)
+
+    def get_overhead(self) -> HistogramSnapshot:
+        """ Distribution of the time spent by the middleware to save the points """
+        return self.overhead.snapshot()
+
+    def get_gc_pauses(self) -> Optional[Dict[int, HistogramSnapshot]]:
+        """ Distribution of the GC pauses per generation, if the stalls are recorded """
+        if self.stall_monitor is None:
+            return None
+        return self.stall_monitor.get_gc_pauses()
 
     def setup_hooks(self) -> None:
         """ Install hooks to register what is slow """
         install_hooks(self.record_interaction)
+        install_http_hooks(self.record_interaction)
+        if self.record_db_interactions:
+            install_db_hooks(self.record_interaction)
+
+    def trace_connection(self, connection) -> TracedConnection:
+        """
+        Wrap a DB-API connection (psycopg, sqlite3, mysqlclient...), so that the statements executed
+        with its cursors are recorded as interactions
+        """
+        return TracedConnection(connection, self.record_interaction)
+
+    @property
+    def interactions(self) -> Sequence[Interaction]:
+        """ Interactions recorded so far in the current context (request) """
+        interactions = self._interactions.get()
+        if interactions is None:
+            interactions = InteractionBuffer(self.max_interactions)
+            self._interactions.set(interactions)
+        return interactions
 
     def record_interaction(self, interaction: Interaction) -> None:
         """ Save the interaction """
-        self.interactions.append(interaction)
+        interactions = self.interactions
+        if interactions is not NOT_RECORDING:
+            interactions.record(interaction)
+
+    def reset_interactions(self, record: bool = True):
+        """ Start a new list of interactions (and spans) in the current context, or stop recording them """
+        self._interactions.set(InteractionBuffer(self.max_interactions) if record else NOT_RECORDING)
+        self._spans.set(SpanRecorder(perf_counter_ns()) if record else None)
 
-    def reset_interactions(self):
-        self.interactions = []
+    def span(self, name: str = None) -> Span:
+        """
+        Time a segment of the current request, reported with its point. Used as a context manager
+        (`with middleware.span('render_pdf'):`) or as a decorator, where the name of the function
+        is used by default, including `async def` functions. Spans can be nested.
+
+        A span is entered once at a time: create a new one for each `with` block, instead of sharing
+        one between threads or nesting it in itself. A decorated function can be called from anywhere.
+        """
+        return Span(self._spans, name)
 
     def save_point(
             self,
-            time_request_started: datetime,
-            time_elapsed: float,  # seconds
+            time_request_started_ns: int,  # nanoseconds since the epoch
+            time_elapsed_ns: int,  # nanoseconds
             method: str,
             uri: str,
             response_status: str = None,  # HTTP response status (200 OK, etc)
             endpoint_name: str = None,  # function name handling the request
             url_rule: str = None,  # Route pattern matched for this endpoint (/pet/<int:id>)
             is_not_found: bool = None,  # If the request did not match any route
+            time_to_first_byte_ns: int = None,  # nanoseconds
+            response_bytes: int = None,  # Size of the response body
+            profile: str = None,  # Stacks sampled while the request was slow
+            gc_pause_ns: int = None,  # Time paused by the garbage collector
+            stall_ns: int = None,  # Time the interpreter stalled
     ) -> None:
         """
         Save a request/response performance information.
 
         This method is called by subclasses with their framework-specific information. We then add
-        the core-level collected performance data (interactions) and call self._save_point().
+        the core-level collected performance data (interactions) and call self._save_point(), or
+        send the point to the agent.
         """
-        self._save_point(
-            time_request_started=time_request_started,
-            time_elapsed=time_elapsed,
+        interactions = self.interactions
+        if interactions is not NOT_RECORDING:
+            interactions = interactions.finish()
+        span_recorder = self._spans.get()
+        spans = span_recorder.finish(perf_counter_ns()) if span_recorder is not None else None
+        # Reset the list of interactions, since it's specific to a request/point
+        self.reset_interactions()
+        # Spans are only recorded during requests
+        self._spans.set(None)
+        point = Point(
+            time_request_started_ns=time_request_started_ns,
+            time_elapsed_ns=time_elapsed_ns,
             method=method,
             uri=uri,
-            interactions=self.interactions,
+            interactions=interactions,
             response_status=response_status,
             endpoint_name=endpoint_name,
             url_rule=url_rule,
             is_not_found=is_not_found,
+            time_to_first_byte_ns=time_to_first_byte_ns,
+            response_bytes=response_bytes,
+            spans=spans,
+            profile=profile,
+            gc_pause_ns=gc_pause_ns,
+            stall_ns=stall_ns,
         )
-        # Reset the list of interactions, since it's specific to a request/point
-        self.reset_interactions()
+        if self.sink is not None:
+            self.sink.push(point)
+            return
+        if self.runner is None and self.app_id:
+            self._ensure_background_thread()
+        self._save_point(point)
 
     @staticmethod
-    def _save_point(**kwargs) -> None:
+    def _save_point(point: Point) -> None:
         """ Save a request/response performance information """
-
-        interaction_list = []
-        interactions = kwargs.get('interactions', [])
-        while interactions:
-            interaction_list.append(interactions.pop().serialize())
-
-        # Forward the arguments to the queue
-        item = kwargs
-
-        # Capped queue
-        pushed = False
-        while pushed is False:
-            try:
-                queue.put_nowait(item)
-                pushed = True
-            except Full:
-                # The queue is full - let's pop the oldest element and discard it, and try again
-                try:
-                    queue.get_nowait()
-                except Empty:
-                    pass
+        # The queue is capped: if it is full, the oldest point is discarded
+        queue.push(point)
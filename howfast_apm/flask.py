@@ -1,23 +1,29 @@
+import inspect
 import logging
-from typing import List
-from datetime import datetime, timezone
-from timeit import default_timer as timer
-from flask.signals import request_started
-from flask import Flask, request
-from werkzeug import local, exceptions
+import threading
+from functools import wraps
+from time import perf_counter_ns
+from typing import Callable, List
+from flask.signals import before_render_template, got_request_exception, request_started, template_rendered
+from flask import Flask, g, request
+from werkzeug import exceptions
 
-from .core import CoreAPM
-from .utils import is_in_blacklist, compile_endpoints
+from .wsgi import HowFastWSGIMiddleware, METADATA_ENVIRON_KEY
 
 logger = logging.getLogger('howfast_apm')
 
 
-class HowFastFlaskMiddleware(CoreAPM):
+def _function_name(func: Callable) -> str:
+    return getattr(func, '__qualname__', None) or getattr(func, '__name__', None) or repr(func)
+
+
+class HowFastFlaskMiddleware(HowFastWSGIMiddleware):
     """
     Flask middleware to measure how much time is spent per endpoint.
 
-    This implementation is purposedly naive and potentially slow, but its goal is to validate the
-    PoC. It should be replaced/improved in the future, based on the results of the PoC.
+    This is the WSGI middleware, with the Flask endpoint and route of each request. The phases of
+    the request (routing, before_request functions, view, error handlers, after_request functions,
+    teardown functions and template rendering) are reported as spans.
     """
 
     def __init__(
@@ -28,102 +34,140 @@ class HowFastFlaskMiddleware(CoreAPM):
             app_id: str = None,
             # Endpoints not to monitor
             endpoints_blacklist: List[str] = None,
+            # Only monitor these endpoints (all of them by default)
+            endpoints_allowlist: List[str] = None,
+            # Report the time spent in each phase of the request, as spans
+            record_phases: bool = True,
             # Other configuration parameters passed to the CoreAPM constructor
             **kwargs,
     ):
-        super().__init__(**kwargs)
-
         self.app = app
-        self.wsgi_app = app.wsgi_app
-
-        # We need to store thread local information, let's use Werkzeug's context locals
-        # (see https://werkzeug.palletsprojects.com/en/1.0.x/local/)
-        self.local = local.Local()
-        self.local_manager = local.LocalManager([self.local])
+        self.record_phases = record_phases
+        # The functions of the application are wrapped on the first request, once they are all
+        # registered
+        self._phases_installed = False
+        self._phases_lock = threading.Lock()
+        super().__init__(
+            app.wsgi_app,
+            app_id=app_id,
+            endpoints_blacklist=endpoints_blacklist,
+            endpoints_allowlist=endpoints_allowlist,
+            **kwargs,
+        )
 
         # Overwrite the passed WSGI application
-        app.wsgi_app = self.local_manager.make_middleware(self)
-
-        if endpoints_blacklist:
-            self.endpoints_blacklist = compile_endpoints(*endpoints_blacklist)
-        else:
-            self.endpoints_blacklist = []
-
-        # Setup the queue and the background thread
-        self.setup(app_id)
+        app.wsgi_app = self
 
         request_started.connect(self._request_started)
-
-    def __call__(self, environ, start_response):
-        if not self.app_id:
-            # HF APM not configured, return early to save some time
-            # TODO: wouldn't it be better to just not replace the WSGI app?
-            return self.wsgi_app(environ, start_response)
-
-        uri = environ.get('PATH_INFO')
-
-        if is_in_blacklist(uri, self.endpoints_blacklist):
-            # Endpoint blacklist, return now
-            return self.wsgi_app(environ, start_response)
-
-        method = environ.get('REQUEST_METHOD')
-
-        response_status: str = None
-
-        def _start_response_wrapped(status, *args, **kwargs):
-            nonlocal response_status
-            # We wrap the start_response callback to access the response status line (eg "200 OK")
-            response_status = status
-            return start_response(status, *args, **kwargs)
-
-        time_request_started = datetime.now(timezone.utc)
-
-        try:
-            # Time the function execution
-            start = timer()
-            return_value = self.wsgi_app(environ, _start_response_wrapped)
-            # Stop the timer as soon as possible to get the best measure of the function's execution time
-            end = timer()
-        except BaseException:
-            # The WSGI app raised an exception, let's still save the point before raising the
-            # exception again
-            # First, "stop" the timer now to get the good measure of the function's execution time
-            end = timer()
-            # The real response status will actually be set by the server that interacts with the
-            # WSGI app, but we cannot instrument it from here, so we just assume a common string.
-            response_status = "500 INTERNAL SERVER ERROR"
-            raise
-        finally:
-            elapsed = end - start
-
-            self.save_point(
-                time_request_started=time_request_started,
-                time_elapsed=elapsed,
-                method=method,
-                uri=uri,
-                response_status=response_status,
-                # Request metadata
-                endpoint_name=getattr(self.local, 'endpoint_name', None),
-                url_rule=getattr(self.local, 'url_rule', None),
-                is_not_found=getattr(self.local, 'is_not_found', None),
-            )
-            # TODO: remove this once overhead has been measured in production
-            logger.info("overhead when saving the point: %.3fms", (timer() - end) * 1000)
-
-        return return_value
+        if record_phases:
+            before_render_template.connect(self._before_render_template, app)
+            template_rendered.connect(self._template_rendered, app)
+            got_request_exception.connect(self._close_templates, app)
 
     def _request_started(self, sender, **kwargs):
         with sender.app_context():
             self._save_request_metadata()
+        if self.record_phases and sender is self.app:
+            # The request context was pushed: the URL was matched and the session opened
+            recorder = self._spans.get()
+            if recorder is not None:
+                recorder.add('routing', recorder.start, perf_counter_ns())
+            if not self._phases_installed:
+                self._install_phase_hooks()
 
     def _save_request_metadata(self):
-        """ Extract and save request metadata in the context local """
-        # This will yield strings like:
-        # * "monitor" (when the endpoint is defined using a resource)
-        # * "apm-collection.store_points" (when the endpoint is defined with a blueprint)
-        # The endpoint name will always be lowercase
-        self.local.endpoint_name = request.endpoint
-        # This will yield strings like "/v1.1/apm/<int:apm_id>/endpoint"
-        self.local.url_rule = request.url_rule.rule if request.url_rule is not None else None
-        # We want to tell the difference between a "real" 404 and a 404 returned by an existing view
-        self.local.is_not_found = isinstance(request.routing_exception, exceptions.NotFound)
+        """ Extract and save request metadata in the WSGI environ, for the WSGI middleware """
+        request.environ[METADATA_ENVIRON_KEY] = {
+            # This will yield strings like:
+            # * "monitor" (when the endpoint is defined using a resource)
+            # * "apm-collection.store_points" (when the endpoint is defined with a blueprint)
+            # The endpoint name will always be lowercase
+            'endpoint_name': request.endpoint,
+            # This will yield strings like "/v1.1/apm/<int:apm_id>/endpoint"
+            'url_rule': request.url_rule.rule if request.url_rule is not None else None,
+            # We want to tell the difference between a "real" 404 and a 404 returned by an existing view
+            'is_not_found': isinstance(request.routing_exception, exceptions.NotFound),
+        }
+
+    def _timed(self, func: Callable, name: str, after_view: bool = False) -> Callable:
+        """
+        Wrap a function of the application, to report each call as a span. Functions called after
+        the view (`after_view`) first close the spans of the templates whose rendering failed.
+        """
+        if getattr(func, '_howfast_apm_phase', False):
+            return func
+        spans = self._spans
+
+        if inspect.iscoroutinefunction(func):
+            # Flask only runs the async views and hooks in an event loop if they are coroutine
+            # functions (app.ensure_sync)
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                recorder = spans.get()
+                if recorder is None:
+                    return await func(*args, **kwargs)
+                if after_view:
+                    self._close_templates()
+                with self.span(name):
+                    return await func(*args, **kwargs)
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                recorder = spans.get()
+                if recorder is None:
+                    return func(*args, **kwargs)
+                if after_view:
+                    self._close_templates()
+                with self.span(name):
+                    return func(*args, **kwargs)
+
+        wrapper._howfast_apm_phase = True
+        return wrapper
+
+    def _install_phase_hooks(self) -> None:
+        """ Wrap the view functions and the request hooks of the application and its blueprints """
+        with self._phases_lock:
+            if self._phases_installed:
+                return
+            app = self.app
+            for phase, functions_per_blueprint in (
+                    ('before_request', app.before_request_funcs),
+                    ('after_request', app.after_request_funcs),
+                    ('teardown_request', app.teardown_request_funcs),
+            ):
+                after_view = phase != 'before_request'
+                for functions in functions_per_blueprint.values():
+                    functions[:] = [self._timed(func, f'{phase}:{_function_name(func)}', after_view) for func in functions]
+            for endpoint, view in list(app.view_functions.items()):
+                app.view_functions[endpoint] = self._timed(view, f'view:{endpoint}')
+            for handlers_per_code in app.error_handler_spec.values():
+                for handlers in handlers_per_code.values():
+                    for exception_class, handler in handlers.items():
+                        handlers[exception_class] = self._timed(handler, f'errorhandler:{_function_name(handler)}', True)
+            self._phases_installed = True
+
+    def _before_render_template(self, sender, template, context, **kwargs):
+        span = self.span(f'render_template:{template.name or "<string>"}')
+        span.__enter__()
+        g.setdefault('_howfast_apm_templates', []).append(span)
+
+    def _template_rendered(self, sender, template, context, **kwargs):
+        templates = g.get('_howfast_apm_templates')
+        if templates:
+            templates.pop().__exit__(None, None, None)
+
+    def _close_templates(self, *args, **kwargs) -> None:
+        """
+        End the spans of the templates whose rendering raised an exception (template_rendered was
+        not sent), so that they don't become the parents of the next spans
+        """
+        templates = g.get('_howfast_apm_templates')
+        if not templates:
+            return
+        recorder = self._spans.get()
+        # The exception already left the spans that enclosed the templates (the view)
+        current = recorder.current if recorder is not None else -1
+        while templates:
+            templates.pop().__exit__(None, None, None)
+        if recorder is not None:
+            recorder.current = current
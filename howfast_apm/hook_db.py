@@ -0,0 +1,251 @@
+"""
+Hooks recording the database and cache queries as interactions:
+* DB-API connections (psycopg, sqlite3, mysqlclient...), wrapped with TracedConnection
+* SQLAlchemy engines, through the cursor execution events
+* redis-py clients and pipelines
+
+The SQL statements are normalized (literals and placeholders replaced by "?") and fingerprinted, so
+that the queries with the same shape are reported under the same name.
+"""
+import re
+import hashlib
+import logging
+from functools import lru_cache
+from time import perf_counter
+from typing import Any, Callable, Optional, Tuple
+
+from .hook_requests import Interaction
+
+logger = logging.getLogger('howfast_apm')
+
+RecordInteraction = Callable[[Interaction], Any]
+
+# Function receiving the interactions of SQLAlchemy and redis, set by install_db_hooks()
+_record_interaction: Optional[RecordInteraction] = None
+_installed = False
+
+# Applied in this order
+SQL_NORMALIZATIONS = [
+    # Comments
+    (re.compile(r'--[^\n]*|/\*.*?\*/', re.DOTALL), ' '),
+    # String literals, with escaped quotes
+    (re.compile(r"'(?:[^'\\]|''|\\.)*'"), '?'),
+    # Placeholders of the drivers: %s, %(name)s, $1, :name
+    (re.compile(r'%(?:\(\w+\))?s|\$\d+|(?<!:):\w+'), '?'),
+    # Numbers, but not the digits inside identifiers (table_2)
+    (re.compile(r'(?<![\w.])(?:0x[0-9a-f]+|\d+(?:\.\d+)?(?:e[-+]?\d+)?)\b', re.IGNORECASE), '?'),
+    # Lists of values, whose length depends on the parameters: IN (?, ?, ?)
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)'), '(?)'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+@lru_cache(maxsize=2048)
+def normalize_sql(statement: str) -> Tuple[str, str]:
+    """
+    Statement without its literals, and its fingerprint (a short hash of the normalized statement).
+
+    >>> normalize_sql("SELECT * FROM pet WHERE id IN (1, 2, 3) AND name = 'O''Malley'")[0]
+    'SELECT * FROM pet WHERE id IN (?) AND name = ?'
+    """
+    for pattern, replacement in SQL_NORMALIZATIONS:
+        statement = pattern.sub(replacement, statement)
+    normalized = statement.strip()
+    fingerprint = hashlib.blake2b(normalized.encode('utf-8'), digest_size=8).hexdigest()
+    return normalized, fingerprint
+
+
+def record_statement(record_interaction: Optional[RecordInteraction], statement: Any, elapsed: float, **extra) -> None:
+    """ Record a SQL statement """
+    if record_interaction is None:
+        return
+    try:
+        if isinstance(statement, bytes):
+            statement = statement.decode('utf-8', 'replace')
+        name, fingerprint = normalize_sql(str(statement))
+        record_interaction(Interaction(
+            interaction_type="sql",
+            name=name,
+            elapsed=elapsed,
+            extra={'fingerprint': fingerprint, **extra},
+        ))
+    # Catch any exception because we don't want it to bubble up to the real app
+    except Exception:
+        logger.error("Unable to record interaction", exc_info=True)  # pragma: nocover
+
+
+def _count_rows(parameters) -> Optional[int]:
+    """ Number of parameter sets given to executemany(), None for iterators (they are not consumed) """
+    return len(parameters) if hasattr(parameters, '__len__') else None
+
+
+class TracedCursor:
+    """ DB-API cursor recording the statements it executes """
+
+    def __init__(self, cursor, record_interaction: RecordInteraction):
+        self._cursor = cursor
+        self._record_interaction = record_interaction
+
+    def execute(self, statement, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return self._cursor.execute(statement, *args, **kwargs)
+        finally:
+            record_statement(self._record_interaction, statement, perf_counter() - start)
+
+    def executemany(self, statement, parameters, *args, **kwargs):
+        rows = _count_rows(parameters)
+        start = perf_counter()
+        try:
+            return self._cursor.executemany(statement, parameters, *args, **kwargs)
+        finally:
+            record_statement(self._record_interaction, statement, perf_counter() - start, rows=rows)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._cursor.__exit__(*exc_info)
+
+
+class TracedConnection:
+    """
+    DB-API connection whose cursors record the statements they execute, as well as the execute()
+    and executemany() shortcuts of the connections that have them (sqlite3, psycopg 3)
+    """
+
+    def __init__(self, connection, record_interaction: RecordInteraction):
+        self._connection = connection
+        self._record_interaction = record_interaction
+
+    def cursor(self, *args, **kwargs) -> TracedCursor:
+        return TracedCursor(self._connection.cursor(*args, **kwargs), self._record_interaction)
+
+    def execute(self, statement, *args, **kwargs):
+        # AttributeError if the connection doesn't have the shortcut, without recording anything
+        execute = self._connection.execute
+        start = perf_counter()
+        try:
+            return execute(statement, *args, **kwargs)
+        finally:
+            record_statement(self._record_interaction, statement, perf_counter() - start)
+
+    def executemany(self, statement, parameters, *args, **kwargs):
+        executemany = self._connection.executemany
+        rows = _count_rows(parameters)
+        start = perf_counter()
+        try:
+            return executemany(statement, parameters, *args, **kwargs)
+        finally:
+            record_statement(self._record_interaction, statement, perf_counter() - start, rows=rows)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __enter__(self):
+        self._connection.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._connection.__exit__(*exc_info)
+
+
+def _install_sqlalchemy_hooks() -> bool:
+    """ Record the statements executed by all the SQLAlchemy engines """
+    try:
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+    except ModuleNotFoundError:
+        return False
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('howfast_apm_start', []).append(perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('howfast_apm_start')
+        if not starts:
+            return
+        elapsed = perf_counter() - starts.pop()
+        if executemany:
+            record_statement(_record_interaction, statement, elapsed, rows=_count_rows(parameters))
+        else:
+            record_statement(_record_interaction, statement, elapsed)
+
+    def handle_error(exception_context):
+        # after_cursor_execute is not called when the statement fails
+        connection = exception_context.connection
+        starts = connection.info.get('howfast_apm_start') if connection is not None else None
+        if starts and exception_context.statement is not None:
+            record_statement(_record_interaction, exception_context.statement, perf_counter() - starts.pop())
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(Engine, 'handle_error', handle_error)
+    return True
+
+
+def _install_redis_hooks() -> bool:
+    """ Record the commands sent by the redis-py clients, and their pipelines """
+    try:
+        import redis.client
+    except ModuleNotFoundError:
+        return False
+
+    def record(name: str, elapsed: float, extra: dict) -> None:
+        if _record_interaction is None:
+            return
+        try:
+            _record_interaction(Interaction(interaction_type="redis", name=name, elapsed=elapsed, extra=extra))
+        # Catch any exception because we don't want it to bubble up to the real app
+        except Exception:
+            logger.error("Unable to record interaction", exc_info=True)  # pragma: nocover
+
+    execute_command = redis.client.Redis.execute_command
+    pipeline_execute = redis.client.Pipeline.execute
+
+    def patched_execute_command(self, *args, **options):
+        start = perf_counter()
+        try:
+            return execute_command(self, *args, **options)
+        finally:
+            # Only the name of the command: the keys are specific to each call
+            name = args[0] if args else None
+            if isinstance(name, bytes):
+                name = name.decode('utf-8', 'replace')
+            record(str(name).upper(), perf_counter() - start, {})
+
+    def patched_pipeline_execute(self, *args, **kwargs):
+        commands = len(self.command_stack)
+        start = perf_counter()
+        try:
+            return pipeline_execute(self, *args, **kwargs)
+        finally:
+            record('PIPELINE', perf_counter() - start, {'commands': commands})
+
+    redis.client.Redis.execute_command = patched_execute_command
+    redis.client.Pipeline.execute = patched_pipeline_execute
+    return True
+
+
+def install_db_hooks(record_interaction: RecordInteraction) -> None:
+    """
+    Install the hooks of the database and cache libraries that are installed (SQLAlchemy, redis).
+
+    The libraries are only patched once: the interactions are passed to the last function given.
+    """
+    global _record_interaction, _installed
+    _record_interaction = record_interaction
+    if _installed:
+        return
+    _installed = True
+    if _install_sqlalchemy_hooks():
+        logger.debug("SQLAlchemy queries will be recorded")
+    if _install_redis_hooks():
+        logger.debug("Redis commands will be recorded")
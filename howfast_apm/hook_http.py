@@ -0,0 +1,200 @@
+"""
+Hooks at the connection level of http.client, which is also used by urllib3 (and so by requests
+sessions, boto...) and by urllib.request.
+
+Each request/response exchange on a connection is timed from the request line until the response
+headers are received, with the time spent opening the connection (TCP and TLS handshakes) reported
+separately, and whether the connection was reused from a previous exchange (connection pooling).
+"""
+import logging
+import http.client
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter_ns
+from typing import Any, Callable, Iterator, List, Optional
+
+from .hook_requests import Interaction, current_interaction
+
+logger = logging.getLogger('howfast_apm')
+
+# Set in the contexts where the HTTP requests must not be recorded (the requests of the Runner)
+_disabled: ContextVar[bool] = ContextVar('howfast_apm_http_hooks_disabled', default=False)
+
+# Function receiving the interactions, set by install_http_hooks()
+_record_interaction: Optional[Callable[[Interaction], Any]] = None
+
+# Attributes set on the connections
+EXCHANGE_ATTRIBUTE = '_howfast_apm_exchange'
+PENDING_CONNECT_ATTRIBUTE = '_howfast_apm_pending_connect'
+CONNECTING_ATTRIBUTE = '_howfast_apm_connecting'
+
+
+class Exchange:
+    """ A request sent on a connection, until its response headers are received """
+
+    __slots__ = ('method', 'url', 'start', 'connect_ns', 'reused')
+
+    def __init__(self, method: str, url: str, start: int, connect_ns: int, reused: bool):
+        self.method = method
+        self.url = url
+        # perf_counter_ns() when the exchange started (or when the connection was opened for it)
+        self.start = start
+        # Time spent opening the connection
+        self.connect_ns = connect_ns
+        # If the connection was already open, from a previous exchange
+        self.reused = reused
+
+
+@contextmanager
+def without_interactions() -> Iterator[None]:
+    """ Don't record the HTTP requests made in this block """
+    token = _disabled.set(True)
+    try:
+        yield
+    finally:
+        _disabled.reset(token)
+
+
+def _connection_classes() -> List[type]:
+    """ Connection classes that open their connection in their own connect() method """
+    classes = [http.client.HTTPConnection, http.client.HTTPSConnection]
+    try:
+        import urllib3.connection
+    except ModuleNotFoundError:
+        pass
+    else:
+        classes.extend([urllib3.connection.HTTPConnection, urllib3.connection.HTTPSConnection])
+    return [cls for cls in classes if 'connect' in cls.__dict__]
+
+
+def _patch_connect(connect: Callable) -> Callable:
+
+    def patched_connect(self):
+        # Subclasses call the connect() method of their parent: only time the outermost call
+        if self.__dict__.get(CONNECTING_ATTRIBUTE):
+            return connect(self)
+        self.__dict__[CONNECTING_ATTRIBUTE] = True
+        start = perf_counter_ns()
+        try:
+            return connect(self)
+        finally:
+            elapsed = perf_counter_ns() - start
+            self.__dict__[CONNECTING_ATTRIBUTE] = False
+            exchange = self.__dict__.get(EXCHANGE_ATTRIBUTE)
+            if exchange is not None:
+                # http.client opens the connection when the request is sent
+                exchange.connect_ns += elapsed
+                exchange.reused = False
+            else:
+                # urllib3 opens the connection before the request line is sent
+                self.__dict__[PENDING_CONNECT_ATTRIBUTE] = (start, elapsed)
+
+    patched_connect._howfast_apm_patched = True
+    return patched_connect
+
+
+def _patch_putrequest(putrequest: Callable) -> Callable:
+
+    def patched_putrequest(self, method, url, *args, **kwargs):
+        if not _disabled.get():
+            pending = self.__dict__.pop(PENDING_CONNECT_ATTRIBUTE, None)
+            if pending is not None:
+                start, connect_ns = pending
+                reused = False
+            else:
+                start, connect_ns = perf_counter_ns(), 0
+                reused = self.sock is not None
+            self.__dict__[EXCHANGE_ATTRIBUTE] = Exchange(method, url, start, connect_ns, reused)
+        return putrequest(self, method, url, *args, **kwargs)
+
+    patched_putrequest._howfast_apm_patched = True
+    return patched_putrequest
+
+
+def _patch_getresponse(getresponse: Callable) -> Callable:
+
+    def patched_getresponse(self, *args, **kwargs):
+        exchange = self.__dict__.pop(EXCHANGE_ATTRIBUTE, None)
+        if exchange is None:
+            return getresponse(self, *args, **kwargs)
+        try:
+            response = getresponse(self, *args, **kwargs)
+        except Exception as exception:
+            _record_exchange(self, exchange, perf_counter_ns(), None, error=type(exception).__name__)
+            raise
+        _record_exchange(self, exchange, perf_counter_ns(), response)
+        return response
+
+    patched_getresponse._howfast_apm_patched = True
+    return patched_getresponse
+
+
+def _exchange_url(connection: http.client.HTTPConnection, url: str) -> str:
+    """ Full URL of the request, since the request line only has the path (unless using a proxy) """
+    if not url.startswith('/'):
+        return url
+    scheme = 'https' if connection.default_port == 443 else 'http'
+    if connection.port == connection.default_port:
+        return f'{scheme}://{connection.host}{url}'
+    return f'{scheme}://{connection.host}:{connection.port}{url}'
+
+
+def _record_exchange(
+        connection: http.client.HTTPConnection,
+        exchange: Exchange,
+        end: int,
+        response: Optional[http.client.HTTPResponse],
+        error: str = None,
+) -> None:
+    try:
+        elapsed_ns = end - exchange.start
+        extra = {
+            'host': connection.host,
+            'status': response.status if response is not None else None,
+            # Size of the body, unknown if the response is chunked
+            'response_bytes': response.length if response is not None else None,
+            'connect_time': exchange.connect_ns / 1e9,
+            'response_time': (elapsed_ns - exchange.connect_ns) / 1e9,
+            'reused': exchange.reused,
+        }
+        if error is not None:
+            extra['error'] = error
+
+        interaction = current_interaction.get()
+        if interaction is not None:
+            # Made by a hooked function (requests.get...), that records the interaction itself: add
+            # the details of the connection to it. Redirects and retries use several connections.
+            connect_time = interaction.extra.get('connect_time', 0)
+            interaction.extra.update(extra)
+            interaction.extra['connect_time'] = connect_time + extra['connect_time']
+            return
+
+        if _record_interaction is not None:
+            extra['method'] = exchange.method.lower()
+            _record_interaction(Interaction(
+                interaction_type="request",
+                name=_exchange_url(connection, exchange.url),
+                elapsed=elapsed_ns / 1e9,
+                extra=extra,
+            ))
+    # Catch any exception because we don't want it to bubble up to the real app
+    except Exception:
+        logger.error("Unable to record interaction", exc_info=True)  # pragma: nocover
+
+
+def install_http_hooks(record_interaction: Callable[[Interaction], Any]) -> None:
+    """
+    Record the HTTP requests made with http.client, urllib3 and the libraries built on them.
+
+    The classes are only patched once: the interactions are passed to the last function given.
+    """
+    global _record_interaction
+    _record_interaction = record_interaction
+
+    for cls in _connection_classes():
+        if not getattr(cls.connect, '_howfast_apm_patched', False):
+            cls.connect = _patch_connect(cls.__dict__['connect'])
+    base = http.client.HTTPConnection
+    if not getattr(base.putrequest, '_howfast_apm_patched', False):
+        base.putrequest = _patch_putrequest(base.putrequest)
+        base.getresponse = _patch_getresponse(base.getresponse)
@@ -1,7 +1,8 @@
 import sys
 import logging
 
-from typing import Callable, Any
+from contextvars import ContextVar
+from typing import Callable, Any, Optional
 from timeit import default_timer as timer
 
 logger = logging.getLogger('howfast_apm')
@@ -9,9 +10,10 @@ logger = logging.getLogger('howfast_apm')
 
 class Interaction:
     """ An external interaction with other services """
-    # Can be "request"
+    # Can be "request", "sql" or "redis"
     interaction_type: str
-    # Name holds the URL if interaction_type is "request"
+    # Name holds the URL if interaction_type is "request", the normalized statement for "sql" and
+    # the command for "redis"
     name: str
     elapsed: float
     extra: dict
@@ -32,8 +34,15 @@ class Interaction:
         }
 
 
+# Interaction being recorded by a hooked function, that the hooks of http.client add details to
+current_interaction: ContextVar[Optional[Interaction]] = ContextVar('howfast_apm_current_interaction', default=None)
+
+
 def install_hooks(record_interaction: Callable[[Interaction], Any]) -> None:
-    """ Install the HTTP hooks """
+    """
+    Install the HTTP hooks of the requests module. The requests made with urllib.request and
+    requests sessions are recorded by the hooks of http.client (see hook_http).
+    """
     patch_requests_module = True
     try:
         # Try to import the module to see if it's available
@@ -42,27 +51,29 @@ def install_hooks(record_interaction: Callable[[Interaction], Any]) -> None:
         # Maybe requests is not installed / available in the instrumented code
         patch_requests_module = False
 
-    tmp_urllib = sys.modules['urllib']
     if patch_requests_module:
         tmp_requests = sys.modules['requests']
 
     def get_patched(func, meta_extractor: Callable):
 
         def patched_request(*args, **kwargs):
+            if current_interaction.get() is not None:
+                # Called by another hooked function (requests.get calls requests.request), or
+                # hooked several times: the outermost call records the interaction
+                return func(*args, **kwargs)
+            interaction = Interaction(interaction_type="request", name=None, elapsed=None)
+            token = current_interaction.set(interaction)
             start = timer()
-            resp = func(*args, **kwargs)
-            elapsed = timer() - start
+            try:
+                resp = func(*args, **kwargs)
+            finally:
+                current_interaction.reset(token)
+            interaction.elapsed = timer() - start
 
             try:
-                method, name = meta_extractor(*args, **kwargs)
-
-                record_interaction(
-                    Interaction(
-                        interaction_type="request",
-                        name=name,
-                        elapsed=elapsed,
-                        extra={'method': method.lower()},
-                    ))
+                method, interaction.name = meta_extractor(*args, **kwargs)
+                interaction.extra['method'] = method.lower()
+                record_interaction(interaction)
             # Catch any exception because we don't want it to bubble up to the real app
             except Exception:
                 logger.error("Unable to record interaction", exc_info=True)  # pragma: nocover
@@ -71,13 +82,6 @@ def install_hooks(record_interaction: Callable[[Interaction], Any]) -> None:
 
         return patched_request
 
-    # TODO: build method extractor for urlopen
-    tmp_urllib.request.urlopen = get_patched(
-        tmp_urllib.request.urlopen,
-        lambda *args, **kwargs: [None, None],
-    )
-    sys.modules['urllib'] = tmp_urllib
-
     if patch_requests_module:
         tmp_requests.request = get_patched(
             tmp_requests.request,
@@ -0,0 +1,101 @@
+"""
+Bounded storage of the interactions of a request.
+
+The first interactions are kept individually. Past `max_size`, the other interactions are rolled up
+per (type, normalized name, method): only their count, total and maximum elapsed time are kept,
+with the slowest of them as an example. The memory used per request is therefore bounded, however
+many calls the request makes.
+"""
+import re
+from typing import Dict, List, Optional, Tuple
+
+from .hook_requests import Interaction
+
+# Maximum number of rollups per request: the other interactions are rolled up per type only
+MAX_ROLLUPS = 50
+
+# Path segments that identify a resource: numbers, hexadecimal hashes, UUIDs
+ID_SEGMENT = re.compile(r'/(?:\d+|[0-9a-f]{16,}|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(?=/|$)', re.IGNORECASE)
+
+RollupKey = Tuple[str, Optional[str], Optional[str]]
+
+
+def normalize_url(url: Optional[str]) -> Optional[str]:
+    """
+    URL without its query string, and with the identifiers of its path replaced by "?"
+
+    >>> normalize_url('https://api.example.org/v1/pets/1234/photos?size=large')
+    'https://api.example.org/v1/pets/?/photos'
+    """
+    if not url:
+        return url
+    url = url.split('?', 1)[0].split('#', 1)[0]
+    return ID_SEGMENT.sub('/?', url)
+
+
+class Rollup:
+    """ Interactions with the same type, normalized name and method """
+
+    __slots__ = ('count', 'total', 'slowest')
+
+    def __init__(self, interaction: Interaction):
+        self.count = 1
+        self.total = interaction.elapsed
+        self.slowest = interaction
+
+    def add(self, interaction: Interaction) -> None:
+        self.count += 1
+        self.total += interaction.elapsed
+        if interaction.elapsed > self.slowest.elapsed:
+            self.slowest = interaction
+
+
+class InteractionBuffer(list):
+    """ Interactions of a request: a list of the first `max_size` interactions, and rollups """
+
+    def __init__(self, max_size: int):
+        super().__init__()
+        self.max_size = max_size
+        self.rollups: Dict[RollupKey, Rollup] = {}
+
+    def record(self, interaction: Interaction) -> None:
+        if len(self) < self.max_size:
+            self.append(interaction)
+            return
+        interaction_type = interaction.interaction_type
+        method = interaction.extra.get('method')
+        if interaction_type == 'request':
+            key = (interaction_type, normalize_url(interaction.name), method)
+        else:
+            # Statements and commands are already normalized by their hooks
+            key = (interaction_type, interaction.name, method)
+        rollup = self.rollups.get(key)
+        if rollup is None:
+            if len(self.rollups) >= MAX_ROLLUPS:
+                key = (interaction_type, None, None)
+                rollup = self.rollups.get(key)
+            if rollup is None:
+                self.rollups[key] = Rollup(interaction)
+                return
+        rollup.add(interaction)
+
+    def finish(self) -> List[Interaction]:
+        """
+        Interactions to report: the ones that were kept, followed by one interaction per rollup,
+        whose elapsed time is the total of the rollup
+        """
+        if not self.rollups:
+            return self
+        interactions = list(self)
+        for (interaction_type, name, method), rollup in self.rollups.items():
+            slowest = rollup.slowest
+            extra = {
+                'rollup': True,
+                'count': rollup.count,
+                'max_elapsed': slowest.elapsed,
+                'exemplar': slowest.serialize(),
+            }
+            if method is not None:
+                extra['method'] = method
+            interactions.append(Interaction(interaction_type, name, rollup.total, extra))
+        return interactions
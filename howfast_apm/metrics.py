@@ -0,0 +1,91 @@
+from bisect import bisect_left
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+# Upper bounds of the buckets, in nanoseconds (from 10µs to 10ms). Values above the last bound are
+# counted in an extra bucket.
+DEFAULT_BOUNDS = (
+    10_000,
+    25_000,
+    50_000,
+    100_000,
+    250_000,
+    500_000,
+    1_000_000,
+    2_500_000,
+    5_000_000,
+    10_000_000,
+)
+
+
+class HistogramSnapshot(NamedTuple):
+    """ Copy of the state of a Histogram at some point in time """
+    bounds: Tuple[int, ...]
+    counts: Tuple[int, ...]
+    # Sum of all the observed values, in nanoseconds
+    total: int
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    @property
+    def mean(self) -> Optional[float]:
+        """ Mean of the observed values, in nanoseconds """
+        count = self.count
+        return self.total / count if count else None
+
+    def percentile(self, percentile: float) -> Optional[int]:
+        """
+        Upper bound of the bucket containing the given percentile (between 0 and 100), or None if
+        the percentile falls in the last bucket (values above the last bound) or nothing was observed.
+        """
+        count = self.count
+        if not count:
+            return None
+        rank = count * percentile / 100
+        cumulated = 0
+        for bound, bucket_count in zip(self.bounds, self.counts):
+            cumulated += bucket_count
+            if cumulated >= rank:
+                return bound
+        return None
+
+    def as_dict(self) -> Dict[str, int]:
+        """ Number of observed values per bucket, labelled with the bucket's upper bound """
+        labels = [f'le_{bound}ns' for bound in self.bounds] + ['inf']
+        return dict(zip(labels, self.counts))
+
+    def __sub__(self, other: 'HistogramSnapshot') -> 'HistogramSnapshot':
+        """ Values observed between two snapshots """
+        return HistogramSnapshot(
+            bounds=self.bounds,
+            counts=tuple(count - previous for count, previous in zip(self.counts, other.counts)),
+            total=self.total - other.total,
+        )
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram of durations, in nanoseconds.
+
+    observe() is called on the request path, so it doesn't take any lock: the counters are plain
+    integers in a list. Under heavy contention an increment may very rarely be lost, which is
+    acceptable for statistics.
+    """
+
+    bounds: Tuple[int, ...]
+    counts: List[int]
+    total: int
+
+    def __init__(self, bounds: Tuple[int, ...] = DEFAULT_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0
+
+    def observe(self, value: int) -> None:
+        """ Count a duration, in nanoseconds """
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+
+    def snapshot(self) -> HistogramSnapshot:
+        return HistogramSnapshot(bounds=self.bounds, counts=tuple(self.counts), total=self.total)
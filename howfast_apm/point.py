@@ -0,0 +1,103 @@
+import sys
+from typing import List, Optional
+
+from .hook_requests import Interaction
+from .spans import SpanRecord
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    """ Intern strings that repeat across requests, so that queued points share the same object """
+    return sys.intern(value) if value is not None else None
+
+
+class Point:
+    """
+    Performance information of one request/response, as stored in the queue.
+
+    Points are built on the request path, so they stay as cheap as possible: the values are stored
+    raw, and only converted to their API representation by the Runner (see Runner.serialize_point).
+    """
+
+    __slots__ = (
+        'time_request_started_ns',
+        'time_elapsed_ns',
+        'method',
+        'uri',
+        'interactions',
+        'response_status',
+        'endpoint_name',
+        'url_rule',
+        'is_not_found',
+        'time_to_first_byte_ns',
+        'response_bytes',
+        'spans',
+        'profile',
+        'gc_pause_ns',
+        'stall_ns',
+    )
+
+    # When the request started, in nanoseconds since the epoch (time.time_ns())
+    time_request_started_ns: int
+    # Measured with a monotonic timer (time.perf_counter_ns()), in nanoseconds
+    time_elapsed_ns: int
+    method: str
+    uri: str
+    interactions: List[Interaction]
+    # HTTP response status (200 OK, etc)
+    response_status: Optional[str]
+    # Function name handling the request
+    endpoint_name: Optional[str]
+    # Route pattern matched for this endpoint (/pet/<int:id>)
+    url_rule: Optional[str]
+    # If the request did not match any route
+    is_not_found: Optional[bool]
+    # Time until the first byte of the body was produced, in nanoseconds (time_elapsed_ns being the
+    # time until the last byte was sent)
+    time_to_first_byte_ns: Optional[int]
+    # Size of the response body, in bytes
+    response_bytes: Optional[int]
+    # Segments of the request timed by the application (see spans.Span)
+    spans: List[SpanRecord]
+    # Stacks sampled while the request was slow, in the folded format (see profiler.Profiler)
+    profile: Optional[str]
+    # Time during which the request was paused by the garbage collector, and by stalls of the
+    # interpreter, in nanoseconds (None when not measured, see stalls.StallMonitor)
+    gc_pause_ns: Optional[int]
+    stall_ns: Optional[int]
+
+    def __init__(
+            self,
+            time_request_started_ns: int,
+            time_elapsed_ns: int,
+            method: str,
+            uri: str,
+            interactions: List[Interaction] = None,
+            response_status: str = None,
+            endpoint_name: str = None,
+            url_rule: str = None,
+            is_not_found: bool = None,
+            time_to_first_byte_ns: int = None,
+            response_bytes: int = None,
+            spans: List[SpanRecord] = None,
+            profile: str = None,
+            gc_pause_ns: int = None,
+            stall_ns: int = None,
+    ):
+        self.time_request_started_ns = time_request_started_ns
+        self.time_elapsed_ns = time_elapsed_ns
+        self.method = _intern(method)
+        self.uri = uri
+        self.interactions = interactions if interactions is not None else []
+        self.response_status = _intern(response_status)
+        self.endpoint_name = _intern(endpoint_name)
+        self.url_rule = _intern(url_rule)
+        self.is_not_found = is_not_found
+        self.time_to_first_byte_ns = time_to_first_byte_ns
+        self.response_bytes = response_bytes
+        self.spans = spans if spans is not None else []
+        self.profile = profile
+        self.gc_pause_ns = gc_pause_ns
+        self.stall_ns = stall_ns
+
+    def __repr__(self):
+        return f"<Point {self.method} {self.uri} {self.response_status} ({self.time_elapsed_ns / 1e6:.3f}ms)>"
@@ -0,0 +1,157 @@
+"""
+Sampling profiler for the slow requests.
+
+The middleware registers each request with the thread that handles it. A single thread, started
+with the first request and stopped when no request has been in flight for a while, sleeps until the
+oldest request crosses the threshold. It then samples the stacks of the threads handling slow
+requests with sys._current_frames(), until they finish. Fast requests are never sampled: they only
+cost an insert and a removal in a dict.
+
+The samples of a request are collapsed into folded stacks ("module:function;module:function 12",
+the format of flame graph tools), and attached to its point.
+"""
+import sys
+import time
+import logging
+import threading
+from time import perf_counter_ns
+from typing import Dict, Optional
+
+from .config import HOWFAST_APM_PROFILE_CPU_BUDGET, HOWFAST_APM_PROFILE_INTERVAL
+
+logger = logging.getLogger('howfast_apm')
+
+
+class ProfiledRequest:
+    """ A request in flight, and the stacks sampled while it was slow """
+
+    __slots__ = ('thread_id', 'start', 'samples')
+
+    def __init__(self, thread_id: int, start: int):
+        self.thread_id = thread_id
+        # perf_counter_ns() when the request started
+        self.start = start
+        # Number of samples per folded stack
+        self.samples: Dict[str, int] = {}
+
+
+class Profiler:
+    """ Sample the stacks of the requests that take longer than `threshold` seconds """
+
+    # Time between two samples, in seconds
+    interval = HOWFAST_APM_PROFILE_INTERVAL
+    # Share of a CPU that the sampling thread may use: the interval grows if sampling costs more
+    cpu_budget = HOWFAST_APM_PROFILE_CPU_BUDGET
+    # Stacks reported per request (the most frequent ones), and distinct stacks kept per request
+    max_stacks = 20
+    max_distinct_stacks = 100
+    # Frames kept per stack, from the innermost one
+    max_depth = 32
+    # The thread stops after this many seconds without any request in flight
+    idle_timeout = 10.0
+
+    # Labels of the functions, per code object
+    _labels: Dict[object, str]
+
+    def __init__(self, threshold: float):
+        self.threshold_ns = int(threshold * 1e9)
+        self._labels = {}
+        self.reset()
+
+    def reset(self) -> None:
+        """ Forget the requests in flight and the thread (after a fork, the thread doesn't exist) """
+        self._requests: Dict[int, ProfiledRequest] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def begin(self) -> ProfiledRequest:
+        """ Register the request handled by the current thread """
+        request = ProfiledRequest(threading.get_ident(), perf_counter_ns())
+        # Registered before checking the thread: a thread that is about to stop will see it
+        self._requests[request.thread_id] = request
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self.run, name='howfast-apm-profiler', daemon=True)
+                    self._thread.start()
+        return request
+
+    def end(self, request: ProfiledRequest) -> Optional[str]:
+        """ Unregister the request, and return its profile if it was sampled """
+        if self._requests.get(request.thread_id) is request:
+            del self._requests[request.thread_id]
+        if not request.samples:
+            return None
+        return self.summarize(request.samples)
+
+    def run(self) -> None:
+        idle_since = None
+        while True:
+            now = perf_counter_ns()
+            requests = list(self._requests.copy().values())
+            if not requests:
+                if idle_since is None:
+                    idle_since = now
+                elif now - idle_since >= self.idle_timeout * 1e9:
+                    with self._lock:
+                        if not self._requests:
+                            self._thread = None
+                            return
+                time.sleep(max(self.threshold_ns / 1e9, self.interval))
+                continue
+            idle_since = None
+
+            slow = [request for request in requests if now - request.start >= self.threshold_ns]
+            if not slow:
+                # Until the oldest request becomes slow
+                oldest = min(request.start for request in requests)
+                time.sleep(max((oldest + self.threshold_ns - now) / 1e9, self.interval))
+                continue
+
+            cpu_start = time.thread_time()
+            try:
+                self.sample(slow)
+            except Exception:
+                logger.error("Unable to sample the slow requests", exc_info=True)  # pragma: nocover
+            cost = time.thread_time() - cpu_start
+            time.sleep(max(self.interval, cost / self.cpu_budget if self.cpu_budget > 0 else 0))
+
+    def sample(self, requests) -> None:
+        """ Add the current stack of each request to its samples """
+        frames = sys._current_frames()
+        for request in requests:
+            frame = frames.get(request.thread_id)
+            if frame is None:
+                continue
+            stack = self.fold(frame)
+            samples = request.samples
+            if stack not in samples and len(samples) >= self.max_distinct_stacks:
+                stack = '(other)'
+            samples[stack] = samples.get(stack, 0) + 1
+
+    def fold(self, frame) -> str:
+        """ Stack of the frame, from the outermost function to the innermost one """
+        labels = []
+        while frame is not None and len(labels) < self.max_depth:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                if len(self._labels) >= 10000:
+                    self._labels.clear()
+                name = getattr(code, 'co_qualname', code.co_name)
+                label = self._labels[code] = f"{frame.f_globals.get('__name__', '?')}:{name}"
+            labels.append(label)
+            frame = frame.f_back
+        labels.reverse()
+        return ';'.join(labels)
+
+    def summarize(self, samples: Dict[str, int]) -> str:
+        """ The most frequent stacks, in the folded format, the other ones being counted together """
+        samples = dict(samples)
+        other = samples.pop('(other)', 0)
+        stacks = sorted(samples.items(), key=lambda item: item[1], reverse=True)
+        lines = [f'{stack} {count}' for stack, count in stacks[:self.max_stacks]]
+        other += sum(count for _, count in stacks[self.max_stacks:])
+        if other:
+            lines.append(f'(other) {other}')
+        return '\n'.join(lines)
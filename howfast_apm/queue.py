@@ -1,4 +1,67 @@
-from queue import Queue
+from collections import deque
+from typing import Any, List, Optional
+
+
+class RingBuffer:
+    """
+    Bounded buffer of points, shared by the request threads (producers) and the Runner (consumer).
+
+    When the buffer is full, pushing a new point silently evicts the oldest one. Pushing and
+    draining never take a lock: deque.append() and deque.popleft() are atomic, so the request
+    threads never wait on the Runner (or on each other).
+    """
+
+    maxsize: int
+
+    # Number of points evicted because the buffer was full. This counter is only informative: it is
+    # incremented without a lock, so concurrent evictions may very rarely be counted once.
+    dropped: int
+
+    def __init__(self, maxsize: int = 1000):
+        self.maxsize = maxsize
+        self.dropped = 0
+        # A deque with a maxlen discards the element at the other end when it is full
+        self._items: deque = deque(maxlen=maxsize)
+
+    def push(self, item: Any) -> None:
+        """ Add an item to the buffer, discarding the oldest one if the buffer is full """
+        if len(self._items) >= self.maxsize:
+            self.dropped += 1
+        self._items.append(item)
+
+    def drain(self, max_items: Optional[int] = None) -> List[Any]:
+        """ Remove and return up to max_items items (all of them by default), oldest first """
+        items = []
+        count = len(self._items) if max_items is None else min(max_items, len(self._items))
+        try:
+            for _ in range(count):
+                items.append(self._items.popleft())
+        except IndexError:
+            # Another consumer emptied the buffer in the meantime
+            pass
+        return items
+
+    def clear(self) -> None:
+        """ Discard all the items in the buffer """
+        self._items.clear()
+
+    def reset(self) -> None:
+        """ Discard all the items in the buffer and reset the counters """
+        self._items.clear()
+        self.dropped = 0
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def empty(self) -> bool:
+        return not self._items
+
+    def full(self) -> bool:
+        return len(self._items) >= self.maxsize
+
+    def __len__(self) -> int:
+        return len(self._items)
+
 
 # Define the queue
-queue: Queue = Queue(maxsize=1000)
+queue: RingBuffer = RingBuffer(maxsize=1000)
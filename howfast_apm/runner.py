@@ -1,65 +1,377 @@
+import gzip
+import json
+import time
 import requests
+from functools import partial
+from itertools import count
 from logging import getLogger
-from threading import Thread
-from typing import List, Dict, Any
+from threading import Event, Thread
+from typing import Callable, List, Dict, Any, Optional, Union
 
-from queue import Queue, Empty
-from .config import HOWFAST_APM_COLLECTOR_URL
+from .aggregation import Aggregate, Aggregator
+from .config import (
+    HOWFAST_APM_AGGREGATE,
+    HOWFAST_APM_AGGREGATION_WINDOW,
+    HOWFAST_APM_COLLECTOR_URL,
+    HOWFAST_APM_COMPRESSION,
+    HOWFAST_APM_OVERHEAD_SUMMARY_INTERVAL,
+    HOWFAST_APM_SPOOL_DIR,
+    HOWFAST_APM_SPOOL_MAX_BYTES,
+    HOWFAST_APM_WIRE_FORMAT,
+)
+from .columnar import CONTENT_TYPE as COLUMNAR_CONTENT_TYPE, decode_columnar, encode_columnar, is_columnar
+from .hook_http import without_interactions
+from .metrics import Histogram, HistogramSnapshot
+from .point import Point
+from .queue import RingBuffer
+from .spool import Backoff, DiskSpool, MemorySpool
+from .utils import format_timestamps
 
 logger = getLogger("howfast_apm")
 
+# Supported values for the Content-Encoding header of the batches, and how to compress the body
+COMPRESSORS: Dict[str, Callable[[bytes], bytes]] = {
+    'identity': lambda body: body,
+    # The default level (9) is noticeably slower for a marginal gain on this kind of payload
+    'gzip': partial(gzip.compress, compresslevel=6),
+}
+try:
+    import zstandard
+    COMPRESSORS['zstd'] = lambda body: zstandard.ZstdCompressor().compress(body)
+except ModuleNotFoundError:
+    # zstandard is an optional dependency
+    pass
+
+
+class UploadError(Exception):
+    """ The API did not store the batch, but it may if the batch is sent again later """
+
+
+def estimate_size(point: Point) -> int:
+    """ Rough size of the point once serialized in the batch, in bytes """
+    size = 250 + len(point.uri or '') + len(point.url_rule or '') + len(point.endpoint_name or '')
+    for interaction in point.interactions:
+        size += 100 + len(interaction.name or '')
+    for span in point.spans:
+        size += 70 + len(span[0] or '')
+    if point.profile:
+        size += len(point.profile)
+    return size
 
-class Runner(Thread):
-    """ Thread dedicated to sending performance events stored in the queue to the API """
+
+class BaseRunner:
+    """
+    Batching, serialization and retry logic shared by the Runner thread and the asyncio uploader
+    (see async_runner.AsyncRunner). Subclasses implement the loop and the I/O.
+    """
 
     # The DSN of the application
     app_id: str
 
-    # If the queue is empty, wait up to X seconds before checking if the thread has to stop.
-    # Whatever this value, an incoming element in the queue will be picked up as soon as it arrives.
+    # If the queue is empty, wait X seconds before checking the queue again
     sleep_delay = 0.5
 
-    # Group points before sending them to the API
+    # Group points before sending them to the API. A batch is sent as soon as one of these limits is
+    # reached: number of points, estimated size of the serialized batch (in bytes), or time since
+    # the first point of the batch was taken from the queue (in seconds).
     batch_size = 100
+    max_batch_bytes = 1024 * 1024
+    max_linger = 5.0
+
+    # Where the batches are sent
+    collector_url = HOWFAST_APM_COLLECTOR_URL
+
+    # Give up on a request to the API after X seconds
+    request_timeout = 10
+
+    # Maximum number of failed batches sent again at each iteration, once the API is reachable
+    max_replayed_batches = 50
+
+    # Local list of the points (or aggregates) to be sent to the API
+    current_batch: List[Union[Point, Aggregate]]
 
-    # Local list of the points to be sent to the API
-    current_batch: List[Dict[str, Any]]
+    # When aggregating, points are folded in the aggregator, and the aggregates are sent every
+    # aggregation_window seconds
+    aggregator: Optional[Aggregator]
+    aggregation_window: float
 
-    def __init__(self, queue: Queue, app_id: str):
+    # Content-Encoding of the batches sent to the API (a key of COMPRESSORS)
+    compression: str
+
+    # Encoding of the batches: "json" or "columnar"
+    wire_format: str
+
+    # Overhead of the middleware, summarized in the logs every summary_interval seconds (if > 0)
+    overhead: Optional[Histogram]
+    summary_interval: float
+    _last_summary: Optional[HistogramSnapshot]
+    _last_summary_time: float
+
+    def __init__(
+            self,
+            queue: RingBuffer,
+            app_id: str,
+            compression: str = HOWFAST_APM_COMPRESSION,
+            wire_format: str = HOWFAST_APM_WIRE_FORMAT,
+            overhead: Histogram = None,
+            summary_interval: float = HOWFAST_APM_OVERHEAD_SUMMARY_INTERVAL,
+            aggregate: bool = HOWFAST_APM_AGGREGATE,
+            aggregation_window: float = HOWFAST_APM_AGGREGATION_WINDOW,
+            spool_dir: str = HOWFAST_APM_SPOOL_DIR,
+            spool_max_bytes: int = HOWFAST_APM_SPOOL_MAX_BYTES,
+    ):
         self.queue = queue
         self.app_id = app_id
         self.current_batch = []
-        # TODO: stop mechanism?
-        self.stop = False
+        # Points taken from the queue that didn't fit in the current batch
+        self._overflow: List[Point] = []
+        self.aggregator = Aggregator() if aggregate else None
+        self.aggregation_window = aggregation_window
+        # Batches that could not be sent, and when to try again
+        self.spool = DiskSpool(spool_dir, max_bytes=spool_max_bytes) if spool_dir else MemorySpool()
+        self.backoff = Backoff()
+        self.compression = self._validate_compression(compression)
+        self.wire_format = 'columnar' if (wire_format or '').lower() == 'columnar' else 'json'
+        self.overhead = overhead
+        self.summary_interval = summary_interval
+        self._last_summary = overhead.snapshot() if overhead is not None else None
+        self._last_summary_time = time.monotonic()
+        # Time (monotonic) before which the final flush must be done
+        self.deadline: Optional[float] = None
+
+    def _add_to_batch(self, points: List[Point], batch_bytes: int) -> int:
+        """ Add the points to the current batch, up to max_batch_bytes, and return the new size """
+        for index, point in enumerate(points):
+            if batch_bytes >= self.max_batch_bytes and self.current_batch:
+                # Keep the rest for the next batch
+                self._overflow.extend(points[index:])
+                break
+            self.current_batch.append(point)
+            batch_bytes += estimate_size(point)
+        return batch_bytes
+
+    def _batch_remaining_points(self) -> None:
+        """ Add all the points left (and the aggregates of the current window) to the current batch """
+        points, self._overflow = self._overflow + self.queue.drain(), []
+        if self.aggregator is not None:
+            for point in points:
+                self.aggregator.add(point)
+            self.current_batch.extend(self.aggregator.flush())
+        else:
+            self.current_batch.extend(points)
+
+    def log_overhead_summary(self) -> None:
+        """ Log the overhead of the middleware since the last summary """
+        snapshot = self.overhead.snapshot()
+        window = snapshot - self._last_summary
+        self._last_summary = snapshot
+        self._last_summary_time = time.monotonic()
+        if not window.count:
+            return
+
+        def to_ms(value: Optional[float]) -> str:
+            return f"{value / 1e6:.3f}ms" if value is not None else f">{window.bounds[-1] / 1e6:.3f}ms"
+
+        logger.info(
+            "overhead when saving the points: %d points, mean %s, p50 <= %s, p99 <= %s",
+            window.count,
+            to_ms(window.mean),
+            to_ms(window.percentile(50)),
+            to_ms(window.percentile(99)),
+        )
+
+    @classmethod
+    def serialize_batch(cls, points: List[Point]) -> List[Dict[str, Any]]:
+        """ Prepare a list of points to be sent to the API """
+        # Timestamps are converted all at once, which is faster than converting them one by one
+        timestamps = format_timestamps(point.time_request_started_ns for point in points)
+        return list(map(cls.serialize_point, points, timestamps))
+
+    @staticmethod
+    def serialize_point(point: Point, time_request_started: str = None) -> Dict[str, Any]:
+        """ Prepare the point to be sent to the API """
+        if time_request_started is None:
+            [time_request_started] = format_timestamps([point.time_request_started_ns])
+        serialized_point = {
+            'method': point.method,
+            'uri': point.uri,
+            'time_request_started': time_request_started,
+            # The API expects seconds
+            'time_elapsed': point.time_elapsed_ns / 1e9,
+            'interactions': [interaction.serialize() for interaction in point.interactions],
+            'response_status': point.response_status,
+            'endpoint_name': point.endpoint_name,
+        }
+        # Save some space in the request body if we don't have interesting information
+        if point.url_rule:
+            serialized_point['url_rule'] = point.url_rule
+        if point.is_not_found is not None:
+            serialized_point['is_not_found'] = point.is_not_found
+        if point.time_to_first_byte_ns is not None:
+            serialized_point['time_to_first_byte'] = point.time_to_first_byte_ns / 1e9
+        if point.response_bytes is not None:
+            serialized_point['response_bytes'] = point.response_bytes
+        if point.spans:
+            serialized_point['spans'] = [
+                {
+                    'name': name,
+                    'start': start / 1e9,
+                    'elapsed': duration / 1e9,
+                    'parent': parent if parent >= 0 else None,
+                }
+                for name, start, duration, parent in point.spans
+            ]
+        if point.profile:
+            serialized_point['profile'] = point.profile
+        if point.gc_pause_ns is not None:
+            serialized_point['gc_pause'] = point.gc_pause_ns / 1e9
+        if point.stall_ns is not None:
+            serialized_point['stall'] = point.stall_ns / 1e9
+
+        return serialized_point
+
+    @staticmethod
+    def _validate_compression(compression: str) -> str:
+        """ Return the Content-Encoding to use, falling back to a supported one if needed """
+        compression = (compression or 'identity').lower()
+        if compression in COMPRESSORS:
+            return compression
+        fallback = 'gzip' if compression == 'zstd' else 'identity'
+        logger.warning("Compression %r is not available, using %r instead", compression, fallback)
+        return fallback
+
+    def _spool_current_batch(self) -> None:
+        """ Keep the current batch to send it again later """
+        try:
+            self.spool.append(self.encode_batch())
+        except Exception:
+            logger.error("Unable to keep the batch, dropping %d points", len(self.current_batch), exc_info=True)
+        self.current_batch = []
+
+    def encode_batch(self) -> bytes:
+        """ Serialize the current batch, as sent to the API (before compression) """
+        if self.wire_format == 'columnar':
+            if self.aggregator is not None:
+                return encode_columnar(
+                    self.app_id,
+                    [item for item in self.current_batch if isinstance(item, Point)],
+                    [item.serialize() for item in self.current_batch if isinstance(item, Aggregate)],
+                )
+            return encode_columnar(self.app_id, self.current_batch)
+        payload = {'dsn': self.app_id}
+        if self.aggregator is not None:
+            # In aggregation mode, the batch contains the aggregates and a few exemplar points
+            payload['aggregates'] = [item.serialize() for item in self.current_batch if isinstance(item, Aggregate)]
+            payload['perf'] = self.serialize_batch([item for item in self.current_batch if isinstance(item, Point)])
+        else:
+            payload['perf'] = self.serialize_batch(self.current_batch)
+        return json.dumps(payload).encode('utf-8')
+
+    def _request_headers(self, body: bytes) -> Dict[str, str]:
+        # Spooled batches may have been encoded with another wire format
+        headers = {'Content-Type': COLUMNAR_CONTENT_TYPE if is_columnar(body) else 'application/json'}
+        if self.compression != 'identity':
+            headers['Content-Encoding'] = self.compression
+        return headers
+
+    def _request_timeout(self) -> float:
+        if self.deadline is not None:
+            # Shutting down: don't wait for the API past the deadline
+            return max(0.001, min(self.request_timeout, self.deadline - time.monotonic()))
+        return self.request_timeout
+
+    def _fallback_encoding(self, body: bytes) -> Optional[bytes]:
+        """
+        Called when the API rejects the batch as unsupported (415): return the batch to send again,
+        with a simpler encoding, or None if there is no simpler encoding
+        """
+        if is_columnar(body):
+            # The collector does not understand the columnar format: go back to JSON
+            logger.warning("The server does not accept columnar batches, using JSON")
+            self.wire_format = 'json'
+            return json.dumps(decode_columnar(body)).encode('utf-8')
+        if self.compression != 'identity':
+            # The collector does not understand this encoding: stop compressing and send again
+            logger.warning("The server does not accept %s-encoded batches, disabling compression", self.compression)
+            self.compression = 'identity'
+            return body
+        return None
+
+    @staticmethod
+    def _check_response(status_code: Optional[int], content: bytes) -> None:
+        """ Raise UploadError if the API did not store the batch but may store it later """
+        if status_code is None or status_code in (408, 429) or status_code >= 500:
+            raise UploadError(f"The server could not store the batch ({status_code})")
+        if status_code != 200:
+            # Sending the same batch again would fail the same way
+            logger.warning(
+                "Unable to send a point to the server (%s), data was dropped! %s",
+                status_code,
+                content,
+            )
+
+
+class Runner(BaseRunner, Thread):
+    """ Thread dedicated to sending performance events stored in the queue to the API """
+
+    # HTTP session reused between batches, to keep the connection to the API alive
+    session: requests.Session
+
+    def __init__(self, queue: RingBuffer, app_id: str, **kwargs):
+        super().__init__(queue, app_id, **kwargs)
+        self.session = requests.Session()
+        # Set by shutdown(): the thread flushes the remaining points and exits
+        self.stopping = Event()
         logger.debug("APM thread starting...")
-        super(Runner, self).__init__(
+        Thread.__init__(
+            self,
             name="HowFast APM",
             # The entire Python program exits when no alive non-daemon threads are left, and we
-            # don't want this thread to block the program from exiting.
-            # TODO: block until the queue is empty?
-            # TODO: don't abruptly kill this thread when the process stops, but instead set the
-            # `stop` property
+            # don't want this thread to block the program from exiting. The remaining points are
+            # sent by shutdown(), which is called when the process exits.
             daemon=True,
         )
 
     def run(self):
-        while self.stop is False:
+        while not self.stopping.is_set():
             self.run_once()
+        self.flush()
+
+    def shutdown(self, timeout: float) -> None:
+        """
+        Stop the thread: wake it up, send all the points left in the queue in one last batch and
+        wait for the thread to exit, for up to `timeout` seconds.
+        """
+        self.deadline = time.monotonic() + timeout
+        self.stopping.set()
+        if self.is_alive():
+            self.join(timeout)
+            if self.is_alive():
+                logger.warning("APM thread did not stop within %.1fs, some points may be lost", timeout)
+
+    def flush(self) -> None:
+        """ Send everything that is left in the queue, in a single batch and without retrying """
+        try:
+            self._batch_remaining_points()
+            if self.current_batch:
+                self.send_batch()
+                # The API is reachable: don't wait for the end of the backoff delay
+                self.backoff.reset()
+            # The batches that failed before would be lost with the memory spool
+            self._send_spooled_batches(until_deadline=True)
+        except Exception:
+            # With a disk spool, the batch will be sent when the process starts again
+            logger.error("Runner was unable to send the last batch", exc_info=True)
+            self._spool_current_batch()
+        finally:
+            self.spool.close()
 
     def run_once(self):
         try:
-            for _ in range(self.batch_size):
-                # Try to get N=100 points from the queue. As soon as the queue is empty, queue.get
-                # will block up to self.sleep_delay (0.5s). Once the queue is empty after the sleep
-                # delay OR 10 points have been retrieved from the queue, we proceed to sending the
-                # batch. This strategy means that the thread will wait up to N=100 * 0.5s = 50s
-                # before sending points to the API, if 100 points arrive with slightly less than
-                # 0.5s between them.
-                point = self.queue.get(timeout=self.sleep_delay)
-                self.current_batch.append(point)
-
-        except Empty:
-            pass
+            if self.aggregator is not None:
+                self._aggregate_points()
+            else:
+                self._collect_points()
         except Exception:
             logger.error("Runner crashed:", exc_info=True)
             return
@@ -68,74 +380,126 @@ class Runner(Thread):
             # If the queue was empty, the current batch will be empty and we don't need to send the batch
             self._send_batch_robust()
 
-        # Exit now if should stop
-        if self.stop:
-            return
+        self._send_spooled_batches()
 
-    @staticmethod
-    def serialize_point(point: dict) -> dict:
-        """ Prepare the point to be sent to the API """
-        serialized_point = {
-            'method': point['method'],
-            'uri': point['uri'],
-            'time_request_started': point['time_request_started'].isoformat(),
-            'time_elapsed': point['time_elapsed'],
-            'interactions': point['interactions'],
-            'response_status': point['response_status'],
-            'endpoint_name': point['endpoint_name'],
-        }
-        # Save some space in the request body if we don't have interesting information
-        if 'url_rule' in point and point['url_rule']:
-            serialized_point['url_rule'] = point['url_rule']
-        if 'is_not_found' in point and point['is_not_found'] is not None:
-            serialized_point['is_not_found'] = point['is_not_found']
+        if self.overhead is not None and self.summary_interval > 0:
+            if time.monotonic() - self._last_summary_time >= self.summary_interval:
+                self.log_overhead_summary()
 
-        return serialized_point
+    def _collect_points(self) -> None:
+        """
+        Fill the current batch with points from the queue, until the batch is full or its first
+        point has waited for max_linger seconds.
+        """
+        batch_bytes = sum(map(estimate_size, self.current_batch))
+        batch_started = time.monotonic()
+        # Start with the points that didn't fit in the previous batch
+        points, self._overflow = self._overflow, []
+        while True:
+            if points:
+                if not self.current_batch:
+                    batch_started = time.monotonic()
+                batch_bytes = self._add_to_batch(points, batch_bytes)
+            if self._overflow or len(self.current_batch) >= self.batch_size or batch_bytes >= self.max_batch_bytes:
+                break
+
+            # Take all the available points at once
+            points = self.queue.drain(self.batch_size - len(self.current_batch))
+            if points:
+                continue
+
+            if self.stopping.is_set():
+                break
+            if not self.current_batch:
+                # Nothing to send yet: wait for new points, and give run() a chance to do its work
+                self.stopping.wait(self.sleep_delay)
+                if self.queue.empty():
+                    break
+                continue
+
+            lingered = time.monotonic() - batch_started
+            if lingered >= self.max_linger:
+                break
+            # Wait for more points, but don't make the first point of the batch wait too long
+            self.stopping.wait(min(self.sleep_delay, self.max_linger - lingered))
+
+    def _aggregate_points(self) -> None:
+        """ Fold the points from the queue in the aggregates, and batch them at the end of the window """
+        points = self.queue.drain()
+        for point in points:
+            self.aggregator.add(point)
+        if not points:
+            self.stopping.wait(self.sleep_delay)
+        if self.aggregator.window_elapsed >= self.aggregation_window:
+            self.current_batch.extend(self.aggregator.flush())
+
+    def _send_batch_robust(self) -> None:
+        """ Send the batch, or keep it to send it again later if the API can't be reached """
+        if self.backoff.failures and not self.backoff.ready():
+            # The API is down: don't even try until the backoff delay is over
+            self._spool_current_batch()
+            return
 
-    def _send_batch_robust(self, attempts=1, max_attempts=3) -> None:
-        """ Retry sending the batch up to max_retry times """
         try:
             self.send_batch()
+            self.backoff.reset()
         except Exception:
             # Print an error, and don't die
+            delay = self.backoff.failure()
             logger.error(
-                "Runner was unable to send performance data (try %d/%d)",
-                attempts,
-                max_attempts,
+                "Runner was unable to send performance data, trying again in %.1fs",
+                delay,
                 exc_info=True,
             )
-            if attempts < max_attempts:
-                # Retry sending the batch
-                self._send_batch_robust(
-                    attempts=attempts + 1,
-                    max_attempts=max_attempts,
-                )
-            else:
-                # We've retried enough times, let's just drop the batch :(
-                logger.warning(
-                    "Unable to send the batch after %d attemps, dropping %d points",
-                    max_attempts,
-                    len(self.current_batch),
-                )
-                # Drop the points
-                self.current_batch = []
+            self._spool_current_batch()
+
+    def _send_spooled_batches(self, until_deadline: bool = False) -> None:
+        """
+        Send the batches that previously failed, oldest first, if the backoff delay is over: up to
+        max_replayed_batches, or as many as possible before the shutdown deadline (`until_deadline`)
+        """
+        if not self.backoff.ready():
+            return
+        unbounded = until_deadline and self.deadline is not None
+        for _ in count() if unbounded else range(self.max_replayed_batches):
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                return
+            body = self.spool.peek()
+            if body is None:
+                return
+            try:
+                self.send_payload(body)
+            except Exception:
+                delay = self.backoff.failure()
+                logger.error("Runner was unable to send a previous batch, trying again in %.1fs", delay, exc_info=True)
+                return
+            self.spool.pop()
+            self.backoff.reset()
 
     def send_batch(self) -> None:
-        """ Process one performance point """
+        """ Send the current batch to the API, and empty it if it was sent """
         logger.debug("Posting %d point(s) to the server", len(self.current_batch))
-        response = requests.post(
-            HOWFAST_APM_COLLECTOR_URL,
-            json={
-                'dsn': self.app_id,
-                'perf': list(map(self.serialize_point, self.current_batch)),
-            },
-        )
+        self.send_payload(self.encode_batch())
         # Batch is now empty
         self.current_batch = []
 
-        if response.status_code != 200:
-            logger.warning(
-                "Unable to send a point to the server (%s), data was dropped! %s",
-                response.status_code,
-                response.content,
+    def send_payload(self, body: bytes) -> None:
+        """ Send a serialized batch to the API. Raises UploadError if it should be sent again later. """
+        response = self._post(body)
+        while response.status_code == 415:
+            body = self._fallback_encoding(body)
+            if body is None:
+                break
+            response = self._post(body)
+        self._check_response(response.status_code, response.content)
+
+    def _post(self, body: bytes) -> requests.Response:
+        """ Compress the serialized batch and post it to the API """
+        # The batches must not be recorded as interactions of the application
+        with without_interactions():
+            return self.session.post(
+                self.collector_url,
+                data=COMPRESSORS[self.compression](body),
+                headers=self._request_headers(body),
+                timeout=self._request_timeout(),
             )
@@ -0,0 +1,96 @@
+import random
+import time
+import threading
+from typing import Dict, List, Optional
+
+from .queue import RingBuffer
+
+
+class Sampler:
+    """
+    Decide which requests are reported.
+
+    The decision is taken in two steps:
+    * sample() is called when the request starts, so that the middleware can skip recording
+      anything about requests that are not sampled;
+    * keep() is called once the request is timed: slow requests and server errors are always kept
+      (tail-based retention), and sampled requests are rate-limited per endpoint.
+    """
+
+    # Probability for a request to be sampled
+    rate: float
+    # Maximum number of points per second and per endpoint (None for no limit)
+    endpoint_rate_limit: Optional[float]
+    # Lower the sampling rate as the queue fills up
+    adaptive: bool
+    # Requests slower than this (in nanoseconds) are always kept
+    slow_threshold_ns: Optional[int]
+
+    # Fill ratio of the queue above which adaptive sampling starts to drop requests
+    adaptive_watermark = 0.5
+
+    # Token buckets per endpoint: [tokens, time of the last refill]
+    _buckets: Dict[Optional[str], List[float]]
+
+    def __init__(
+            self,
+            rate: float = 1.0,
+            endpoint_rate_limit: float = None,
+            adaptive: bool = False,
+            slow_threshold: float = None,  # seconds
+            queue: RingBuffer = None,
+    ):
+        self.rate = rate
+        self.endpoint_rate_limit = endpoint_rate_limit or None
+        self.adaptive = adaptive and queue is not None
+        self.slow_threshold_ns = int(slow_threshold * 1e9) if slow_threshold else None
+        self.queue = queue
+        self._buckets = {}
+        self.reset()
+
+    def reset(self) -> None:
+        """ Forget the lock (after a fork, it may have been held by another thread) """
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """ False if every request is kept, in which case the middleware can skip the sampler """
+        return self.rate < 1 or self.endpoint_rate_limit is not None or self.adaptive
+
+    def sample(self) -> bool:
+        """ Decide if the request that starts should be recorded """
+        rate = self.rate
+        if self.adaptive:
+            fill = len(self.queue) / self.queue.maxsize
+            if fill > self.adaptive_watermark:
+                # Linearly go down to 0 when the queue is full
+                rate *= (1 - fill) / (1 - self.adaptive_watermark)
+        return rate >= 1 or random.random() < rate
+
+    def keep(self, sampled: bool, endpoint: Optional[str], elapsed_ns: int, response_status: Optional[str]) -> bool:
+        """ Decide if a point should be saved for the request that just finished """
+        if self.slow_threshold_ns is not None and elapsed_ns >= self.slow_threshold_ns:
+            return True
+        if response_status is not None and response_status.startswith('5'):
+            return True
+        if not sampled:
+            return False
+        if self.endpoint_rate_limit is not None:
+            return self._take_token(endpoint)
+        return True
+
+    def _take_token(self, endpoint: Optional[str]) -> bool:
+        """ Token bucket per endpoint, allowing bursts of up to one second worth of points """
+        # The requests of the other threads refill and take tokens from the same buckets
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._buckets.get(endpoint)
+            if bucket is None:
+                bucket = self._buckets[endpoint] = [self.endpoint_rate_limit, now]
+            tokens = min(self.endpoint_rate_limit, bucket[0] + (now - bucket[1]) * self.endpoint_rate_limit)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return True
+            bucket[0] = tokens
+            return False
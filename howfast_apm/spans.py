@@ -0,0 +1,116 @@
+"""
+Spans: named segments of a request, timed by the application itself.
+
+    with middleware.span('render_pdf'):
+        ...
+
+    @middleware.span()
+    def render_pdf():
+        ...
+
+The spans are reported with the point of the request, as their start (relative to the start of the
+request), their duration and their parent span. Outside of a request, or if the request is not
+sampled, entering a span only costs a lookup of a context variable.
+"""
+import inspect
+from contextvars import ContextVar
+from functools import wraps
+from time import perf_counter_ns
+from typing import Callable, List, Optional, Tuple
+
+# Maximum number of spans per request, the other ones are ignored
+MAX_SPANS = 200
+
+# Name, start (since the start of the request) and duration in nanoseconds, index of the parent span
+# in the list of spans of the request (-1 for none)
+SpanRecord = Tuple[str, int, int, int]
+
+
+class SpanRecorder:
+    """ Spans of a request """
+
+    __slots__ = ('start', 'spans', 'current', 'dropped')
+
+    def __init__(self, start: int):
+        # perf_counter_ns() when the request started
+        self.start = start
+        # [name, start, duration (None until the span ends), parent]
+        self.spans: List[list] = []
+        # Index of the innermost span that is running (-1 for none)
+        self.current = -1
+        self.dropped = 0
+
+    def add(self, name: str, start: int, end: int) -> None:
+        """ Add a span that was timed by the caller (perf_counter_ns() values) """
+        if len(self.spans) >= MAX_SPANS:
+            self.dropped += 1
+            return
+        self.spans.append([name, start - self.start, end - start, self.current])
+
+    def finish(self, end: int) -> List[SpanRecord]:
+        """ Spans to report. The spans that are still running are reported until `end`. """
+        return [
+            (name, start, duration if duration is not None else end - self.start - start, parent)
+            for name, start, duration, parent in self.spans
+        ]
+
+
+class Span:
+    """
+    Context manager timing a span of the current request, which can also decorate a function.
+
+    The span that is running is kept on the instance: a Span is entered once at a time, so a new one
+    is needed for each `with` block. As a decorator, each call of the function uses its own Span.
+    """
+
+    __slots__ = ('spans', 'name', '_recorder', '_span', '_parent')
+
+    def __init__(self, spans: ContextVar, name: Optional[str] = None):
+        # Context variable holding the SpanRecorder of the current request
+        self.spans = spans
+        self.name = name
+        self._recorder: Optional[SpanRecorder] = None
+
+    def __enter__(self) -> 'Span':
+        recorder = self.spans.get()
+        if recorder is None:
+            return self
+        if len(recorder.spans) >= MAX_SPANS:
+            recorder.dropped += 1
+            return self
+        self._recorder = recorder
+        self._parent = recorder.current
+        self._span = [self.name, perf_counter_ns() - recorder.start, None, self._parent]
+        recorder.current = len(recorder.spans)
+        recorder.spans.append(self._span)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        recorder = self._recorder
+        if recorder is None:
+            return
+        span = self._span
+        span[2] = perf_counter_ns() - recorder.start - span[1]
+        recorder.current = self._parent
+        self._recorder = None
+
+    def __call__(self, func: Callable) -> Callable:
+        """ Time each call of the function, in a span named after it by default """
+        name = self.name or func.__qualname__
+        spans = self.spans
+
+        if inspect.iscoroutinefunction(func):
+            # Time the execution of the coroutine, not its creation
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with Span(spans, name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(spans, name):
+                return func(*args, **kwargs)
+
+        return wrapper
@@ -0,0 +1,276 @@
+import os
+import mmap
+import random
+import struct
+import time
+import logging
+from collections import deque
+from typing import Deque, List, Optional
+
+try:
+    import fcntl
+except ModuleNotFoundError:  # pragma: nocover
+    # Not available on Windows: segments are not locked
+    fcntl = None
+
+logger = logging.getLogger('howfast_apm')
+
+# Each record of a segment is prefixed by its length
+RECORD_HEADER = struct.Struct('>I')
+SEGMENT_SUFFIX = '.spool'
+# Segments being created
+TEMPORARY_SUFFIX = '.tmp'
+# Position of the next batch to replay in a segment, kept next to it so that the batches already
+# sent are not sent again after a restart
+OFFSET_SUFFIX = '.offset'
+OFFSET = struct.Struct('>Q')
+
+
+class Backoff:
+    """ Exponential backoff with jitter between the attempts to reach the API """
+
+    # Delay after the first failure, and maximum delay, in seconds
+    base_delay: float
+    max_delay: float
+
+    failures: int
+    # Time (monotonic) before which the API should not be called again
+    retry_at: float
+
+    def __init__(self, base_delay: float = 1.0, max_delay: float = 300.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.reset()
+
+    def reset(self) -> None:
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def failure(self) -> float:
+        """ Register a failure and return the delay before the next attempt """
+        self.failures += 1
+        delay = min(self.max_delay, self.base_delay * 2 ** (self.failures - 1))
+        # "Equal jitter": wait at least half of the delay, so that agents don't retry in lockstep
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        self.retry_at = time.monotonic() + delay
+        return delay
+
+    def ready(self) -> bool:
+        return time.monotonic() >= self.retry_at
+
+
+class MemorySpool:
+    """ Keep the last few failed batches in memory, to send them again later """
+
+    def __init__(self, max_batches: int = 10):
+        self._batches: Deque[bytes] = deque(maxlen=max_batches)
+
+    def append(self, body: bytes) -> None:
+        if len(self._batches) == self._batches.maxlen:
+            logger.warning("Too many batches waiting to be sent, dropping the oldest one")
+        self._batches.append(body)
+
+    def peek(self) -> Optional[bytes]:
+        """ Oldest batch, or None if there is nothing to send """
+        return self._batches[0] if self._batches else None
+
+    def pop(self) -> None:
+        """ Forget the oldest batch, once it was sent """
+        self._batches.popleft()
+
+    def close(self) -> None:
+        pass
+
+    def __len__(self) -> int:
+        return len(self._batches)
+
+
+class DiskSpool:
+    """
+    Keep the failed batches on disk, so that they survive API outages and process restarts.
+
+    Batches are appended to segment files in `directory`. The oldest segment is replayed (memory-
+    mapped) once the API is reachable again, and deleted once all its batches were sent. When the
+    segments grow over `max_bytes`, the oldest ones are deleted.
+
+    Segments are locked while they are used, so that several processes can share the same directory:
+    a process only replays the segments that are not used by another process, including the
+    segments left behind by processes that are gone.
+
+    The position of the next batch to replay is saved after each batch sent, so that a restarted
+    process resumes where the previous one stopped. Delivery is at-least-once: if the process dies
+    between sending a batch and saving the position, that batch is sent again.
+    """
+
+    directory: str
+    max_bytes: int
+    segment_bytes: int
+
+    def __init__(self, directory: str, max_bytes: int = 64 * 1024 * 1024, segment_bytes: int = 4 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = min(segment_bytes, max_bytes)
+        os.makedirs(directory, exist_ok=True)
+        self._sequence = 0
+        # Segment batches are appended to
+        self._writer = None
+        self._writer_path: Optional[str] = None
+        # Segment being replayed, and position of the next batch in that segment
+        self._reader = None
+        self._reader_path: Optional[str] = None
+        self._reader_map: Optional[mmap.mmap] = None
+        self._reader_offset = 0
+        # File descriptor of the saved position of the segment being replayed
+        self._offset_fd: Optional[int] = None
+
+    def _segments(self) -> List[str]:
+        """ Paths of all the segments in the directory, oldest first """
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def _new_segment_path(self) -> str:
+        # Time first, so that segments are sorted by age; the PID avoids conflicts between processes
+        self._sequence += 1
+        return os.path.join(self.directory, f'{time.time_ns():020d}-{os.getpid()}-{self._sequence}{SEGMENT_SUFFIX}')
+
+    @staticmethod
+    def _lock(file) -> bool:
+        """ Try to lock the file for this process, without blocking """
+        if fcntl is None:  # pragma: nocover
+            return True
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def _open_writer(self) -> None:
+        """
+        Start a new segment. It is created and locked under a temporary name, then renamed: other
+        processes never see it unlocked (they would replay it, or delete it while it is empty).
+        """
+        path = self._new_segment_path()
+        temporary_path = path + TEMPORARY_SUFFIX
+        writer = open(temporary_path, 'ab')
+        if not self._lock(writer):
+            writer.close()
+            os.remove(temporary_path)
+            raise OSError(f"Unable to lock the spool segment {temporary_path}")
+        os.rename(temporary_path, path)
+        self._writer = writer
+        self._writer_path = path
+
+    def append(self, body: bytes) -> None:
+        if self._writer is None or self._writer.tell() >= self.segment_bytes:
+            self._close_writer()
+            self._open_writer()
+        self._writer.write(RECORD_HEADER.pack(len(body)) + body)
+        self._writer.flush()
+        self._evict()
+
+    def _close_writer(self) -> None:
+        if self._writer is not None:
+            # Closing the file releases the lock: the segment can now be replayed
+            self._writer.close()
+            self._writer = None
+            self._writer_path = None
+
+    def _evict(self) -> None:
+        """ Delete the oldest segments while the spool is too big """
+        segments = self._segments()
+        total = sum(os.path.getsize(path) for path in segments)
+        for path in segments:
+            if total <= self.max_bytes:
+                break
+            if path == self._writer_path:
+                continue
+            size = os.path.getsize(path)
+            if path == self._reader_path:
+                self._close_reader()
+            elif not self._can_delete(path):
+                continue
+            self._remove_segment(path)
+            total -= size
+            logger.warning("Spool of failed batches is full, dropped the oldest %d bytes", size)
+
+    @staticmethod
+    def _remove_segment(path: str) -> None:
+        """ Delete the segment and its saved position """
+        os.remove(path)
+        try:
+            os.remove(path + OFFSET_SUFFIX)
+        except FileNotFoundError:
+            pass
+
+    def _can_delete(self, path: str) -> bool:
+        """ Segments locked by another process can't be deleted """
+        with open(path, 'rb') as file:
+            return self._lock(file)
+
+    def _open_reader(self) -> bool:
+        """ Open the oldest segment that is not used by another process """
+        for path in self._segments():
+            if path == self._writer_path:
+                continue
+            file = open(path, 'rb')
+            if not self._lock(file):
+                file.close()
+                continue
+            if os.path.getsize(path) == 0:
+                file.close()
+                self._remove_segment(path)
+                continue
+            self._reader = file
+            self._reader_path = path
+            self._reader_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            # Resume after the batches already sent
+            self._offset_fd = os.open(path + OFFSET_SUFFIX, os.O_RDWR | os.O_CREAT, 0o644)
+            saved = os.pread(self._offset_fd, OFFSET.size, 0)
+            self._reader_offset = OFFSET.unpack(saved)[0] if len(saved) == OFFSET.size else 0
+            return True
+        return False
+
+    def _close_reader(self, delete: bool = False) -> None:
+        if self._reader is None:
+            return
+        self._reader_map.close()
+        os.close(self._offset_fd)
+        if delete:
+            self._remove_segment(self._reader_path)
+        self._reader.close()
+        self._reader = self._reader_map = self._reader_path = self._offset_fd = None
+        self._reader_offset = 0
+
+    def peek(self) -> Optional[bytes]:
+        """ Oldest batch, or None if there is nothing to send """
+        while True:
+            if self._reader is None and not self._open_reader():
+                if self._writer is None or self._writer.tell() == 0:
+                    return None
+                # Only the current segment is left: close it so that it can be replayed
+                self._close_writer()
+                continue
+            offset = self._reader_offset
+            if offset + RECORD_HEADER.size <= len(self._reader_map):
+                (length, ) = RECORD_HEADER.unpack_from(self._reader_map, offset)
+                start = offset + RECORD_HEADER.size
+                if start + length <= len(self._reader_map):
+                    return self._reader_map[start:start + length]
+                # Truncated record (the process died while writing it)
+            # Segment fully replayed
+            self._close_reader(delete=True)
+
+    def pop(self) -> None:
+        """ Forget the oldest batch, once it was sent """
+        (length, ) = RECORD_HEADER.unpack_from(self._reader_map, self._reader_offset)
+        self._reader_offset += RECORD_HEADER.size + length
+        # A single write of 8 bytes: the saved position is never half-written
+        os.pwrite(self._offset_fd, OFFSET.pack(self._reader_offset), 0)
+
+    def close(self) -> None:
+        self._close_writer()
+        self._close_reader()
+
+    def __len__(self) -> int:
+        """ Approximate: number of segments waiting to be replayed """
+        return len(self._segments())
@@ -0,0 +1,129 @@
+"""
+Time during which the interpreter didn't run the requests: garbage collections and stalls.
+
+A garbage collection stops every thread, since it holds the GIL: its pause delays all the requests
+in flight. The collections are timed with gc.callbacks, per generation. The optional watchdog
+thread sleeps for a short interval and measures how late it wakes up: past the GC pauses, the
+overshoot is the time the thread waited for the GIL (CPU-bound threads, C extensions holding it)
+or for a CPU.
+
+Both are kept as process-wide totals: a request reads them when it starts and when it ends, so that
+it is charged with everything that happened while it was in flight, without any registry of the
+requests in flight. A stall is only counted once the watchdog measured it, so a request ending in
+the middle of a stall is not charged with it.
+"""
+import gc
+import os
+import time
+import threading
+from time import perf_counter_ns
+from typing import Dict, Optional, Tuple
+
+from .metrics import Histogram, HistogramSnapshot
+
+# Totals of the GC pauses and of the stalls, in nanoseconds
+StallSnapshot = Tuple[int, int]
+
+
+class StallMonitor:
+    """ Time the garbage collections and, optionally, the stalls of the interpreter """
+
+    # Overshoots of the watchdog below this (in seconds) are the usual timer slack, not stalls
+    tolerance = 0.001
+    # The watchdog stops after this many seconds without any request
+    idle_timeout = 10.0
+
+    # Totals since the monitor was installed, in nanoseconds
+    gc_pause_ns: int
+    stall_ns: int
+    # Pauses per generation (0, 1 and 2)
+    gc_pauses: Tuple[Histogram, ...]
+    # Time between two wake-ups of the watchdog, in seconds (0 when disabled)
+    watchdog_interval: float
+
+    def __init__(self):
+        self.gc_pause_ns = 0
+        self.stall_ns = 0
+        self.gc_pauses = (Histogram(), Histogram(), Histogram())
+        self.watchdog_interval = 0
+        self.installed = False
+        self._gc_start: Optional[int] = None
+        self._last_request = 0
+        self.reset()
+
+    def reset(self) -> None:
+        """ Forget the watchdog (after a fork, the thread doesn't exist) """
+        self._watchdog: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def install(self, watchdog_interval: float = 0) -> 'StallMonitor':
+        """ Start timing the garbage collections, and the stalls if watchdog_interval is set """
+        if watchdog_interval:
+            self.watchdog_interval = watchdog_interval
+        if not self.installed:
+            self.installed = True
+            gc.callbacks.append(self._on_gc)
+            os.register_at_fork(after_in_child=self.reset)
+        return self
+
+    def uninstall(self) -> None:
+        if self._on_gc in gc.callbacks:
+            gc.callbacks.remove(self._on_gc)
+        self.installed = False
+        self.watchdog_interval = 0
+
+    def _on_gc(self, phase: str, info: Dict[str, int]) -> None:
+        # Collections never overlap: they run with the GIL held
+        if phase == 'start':
+            self._gc_start = perf_counter_ns()
+            return
+        if self._gc_start is None:
+            # Installed during a collection
+            return
+        elapsed = perf_counter_ns() - self._gc_start
+        self._gc_start = None
+        self.gc_pause_ns += elapsed
+        self.gc_pauses[min(info.get('generation', 2), 2)].observe(elapsed)
+
+    def snapshot(self) -> StallSnapshot:
+        """ Totals when a request starts, starting the watchdog if needed """
+        if self.watchdog_interval:
+            self._last_request = perf_counter_ns()
+            if self._watchdog is None:
+                with self._lock:
+                    if self._watchdog is None:
+                        self._watchdog = threading.Thread(target=self.watch, name='howfast-apm-watchdog', daemon=True)
+                        self._watchdog.start()
+        return self.gc_pause_ns, self.stall_ns
+
+    def since(self, snapshot: StallSnapshot) -> Tuple[int, Optional[int]]:
+        """ Time spent in GC pauses and in stalls (None without the watchdog) since the snapshot """
+        gc_pause_ns, stall_ns = snapshot
+        return self.gc_pause_ns - gc_pause_ns, self.stall_ns - stall_ns if self.watchdog_interval else None
+
+    def get_gc_pauses(self) -> Dict[int, HistogramSnapshot]:
+        """ Distribution of the GC pauses, per generation """
+        return {generation: histogram.snapshot() for generation, histogram in enumerate(self.gc_pauses)}
+
+    def watch(self) -> None:
+        """ Loop of the watchdog thread """
+        tolerance_ns = int(self.tolerance * 1e9)
+        while True:
+            interval = self.watchdog_interval
+            if not interval or perf_counter_ns() - self._last_request >= self.idle_timeout * 1e9:
+                with self._lock:
+                    if not self.watchdog_interval or perf_counter_ns() - self._last_request >= self.idle_timeout * 1e9:
+                        self._watchdog = None
+                        return
+            gc_pause_ns = self.gc_pause_ns
+            start = perf_counter_ns()
+            time.sleep(interval)
+            # The GC pauses are already counted
+            overshoot = perf_counter_ns() - start - int(interval * 1e9) - (self.gc_pause_ns - gc_pause_ns)
+            if overshoot > tolerance_ns:
+                # Only this thread updates the total
+                self.stall_ns += overshoot
+
+
+# Garbage collections and stalls are process-wide: all the middlewares share the same monitor
+stall_monitor = StallMonitor()
@@ -1,15 +1,77 @@
 import fnmatch
 import re
 
-from typing import List
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Pattern, Set
 
+# Characters with a special meaning in fnmatch patterns
+WILDCARDS = re.compile(r'[*?\[]')
 
-def compile_endpoints(*blacklist):
-    """Compiles a list endpoints to a list of regexes"""
-    return [re.compile(fnmatch.translate(x)) for x in blacklist]
 
+class EndpointMatcher:
+    """
+    Match URIs against a list of shell-like patterns (see fnmatch), in a time that doesn't depend
+    on the number of patterns for the most common patterns:
+    * exact URIs are looked up in a set;
+    * prefixes ("/static/*") are looked up in a set per prefix length;
+    * the other patterns are combined in a single regex.
+
+    The most recent decisions are cached, since the same URIs are usually requested again and again.
+    """
+
+    patterns: List[str]
+    _exact: Set[str]
+    _prefixes: Dict[int, Set[str]]
+    _regex: Optional[Pattern]
+
+    def __init__(self, *patterns: str, cache_size: int = 1024):
+        self.patterns = list(patterns)
+        self._exact = set()
+        self._prefixes = {}
+        others = []
+        for pattern in patterns:
+            if not WILDCARDS.search(pattern):
+                self._exact.add(pattern)
+            elif pattern.endswith('*') and not WILDCARDS.search(pattern[:-1]):
+                prefix = pattern.rstrip('*')
+                self._prefixes.setdefault(len(prefix), set()).add(prefix)
+            else:
+                others.append(fnmatch.translate(pattern))
+        self._prefix_lengths = sorted(self._prefixes)
+        self._regex = re.compile('|'.join(others)) if others else None
+
+        if cache_size:
+            self.match = lru_cache(maxsize=cache_size)(self._match)
+        else:
+            self.match = self._match
+
+    def _match(self, uri: str) -> bool:
+        """ Return True if the URI matches one of the patterns """
+        if uri in self._exact:
+            return True
+        for length in self._prefix_lengths:
+            if length > len(uri):
+                break
+            if uri[:length] in self._prefixes[length]:
+                return True
+        if self._regex is not None and self._regex.match(uri):
+            return True
+        return False
+
+    def __bool__(self) -> bool:
+        return bool(self.patterns)
+
+    def __len__(self) -> int:
+        return len(self.patterns)
 
-def is_in_blacklist(uri: str, blacklist: List[str]) -> bool:
+
+def compile_endpoints(*blacklist: str) -> EndpointMatcher:
+    """ Compiles a list of endpoints patterns to a matcher """
+    return EndpointMatcher(*blacklist)
+
+
+def is_in_blacklist(uri: str, blacklist: EndpointMatcher) -> bool:
     """
     Return True if the URI is blacklisted.
 
@@ -21,10 +83,32 @@ def is_in_blacklist(uri: str, blacklist: List[str]) -> bool:
       True
 
     """
-    for pattern in blacklist:
-        if pattern.match(uri):
-            return True
-    return False
+    if not blacklist or uri is None:
+        return False
+    return blacklist.match(uri)
+
+
+def format_timestamps(timestamps_ns: Iterable[int]) -> List[str]:
+    """
+    Convert nanosecond timestamps (since the epoch) to ISO 8601 strings, in UTC.
+
+    Points of a batch are usually close in time: the date part is computed once per second and
+    shared by all the timestamps of that second.
+
+      >>> format_timestamps([1577836800123456789, 1577836800999999999, 1577836801000000000])
+      ['2020-01-01T00:00:00.123456+00:00', '2020-01-01T00:00:00.999999+00:00', '2020-01-01T00:00:01.000000+00:00']
+
+    """
+    prefixes: Dict[int, str] = {}
+    formatted = []
+    for timestamp_ns in timestamps_ns:
+        seconds, nanoseconds = divmod(timestamp_ns, 1_000_000_000)
+        prefix = prefixes.get(seconds)
+        if prefix is None:
+            prefix = datetime.fromtimestamp(seconds, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+            prefixes[seconds] = prefix
+        formatted.append(f'{prefix}.{nanoseconds // 1000:06d}+00:00')
+    return formatted
 
 
 if __name__ == "__main__":
@@ -0,0 +1,230 @@
+import time
+import logging
+from time import perf_counter_ns
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from .core import CoreAPM
+from .profiler import ProfiledRequest
+from .stalls import StallSnapshot
+from .utils import is_in_blacklist, compile_endpoints
+
+logger = logging.getLogger('howfast_apm')
+
+# Key of the WSGI environ where frameworks store the metadata of the request: a dict with the
+# endpoint_name, url_rule and is_not_found keys (see HowFastFlaskMiddleware)
+METADATA_ENVIRON_KEY = 'howfast_apm.metadata'
+
+
+class TimedResponse:
+    """
+    Wrap the response iterable of the application, to time the response until the server closes it.
+
+    Streamed responses (generators, files) do most of their work while the server iterates over
+    them: the point is only saved when the server calls close(), after the last byte was sent.
+    """
+
+    __slots__ = (
+        'middleware',
+        'environ',
+        'sampled',
+        'time_request_started_ns',
+        'start',
+        'response_status',
+        'first_byte',
+        'response_bytes',
+        'failed',
+        'profiled',
+        'stalls',
+        'iterable',
+        '_iterator',
+        '_close',
+        '_start_response',
+        '_finished',
+    )
+
+    def __init__(
+            self,
+            middleware: 'HowFastWSGIMiddleware',
+            environ: dict,
+            start_response: Callable,
+            sampled: bool,
+            profiled: Optional[ProfiledRequest] = None,
+            stalls: Optional[StallSnapshot] = None,
+    ):
+        self.middleware = middleware
+        self.environ = environ
+        self.sampled = sampled
+        self.response_status: Optional[str] = None
+        # perf_counter_ns() when the first non-empty chunk of the body was produced
+        self.first_byte: Optional[int] = None
+        # Size of the body, unknown if the server sends a file wrapper itself
+        self.response_bytes: Optional[int] = 0
+        # If the application raised an exception
+        self.failed = False
+        # Registration of the request with the profiler
+        self.profiled = profiled
+        # GC pauses and stalls when the request started
+        self.stalls = stalls
+        self.iterable: Optional[Iterable[bytes]] = None
+        self._iterator: Optional[Iterator[bytes]] = None
+        self._close: Optional[Callable[[], None]] = None
+        self._start_response = start_response
+        self._finished = False
+        # Timestamps are kept as integers (nanoseconds), they are only converted by the Runner
+        self.time_request_started_ns = time.time_ns()
+        self.start = perf_counter_ns()
+
+    def start_response(self, status, headers, exc_info=None):
+        """ Passed to the application instead of the server's start_response, to get the status """
+        self.response_status = status
+        return self._start_response(status, headers, exc_info)
+
+    def wrap(self, iterable: Iterable[bytes]):
+        """ Return the iterable to give to the server in place of the application's """
+        self.iterable = iterable
+        self._close = getattr(iterable, 'close', None)
+        file_wrapper = self.environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and isinstance(iterable, file_wrapper):
+            # Give the server its own file wrapper back, so that it can still send the file
+            # efficiently (sendfile): only the close() method is hooked
+            try:
+                iterable.close = self.close
+                self.response_bytes = None
+                return iterable
+            except AttributeError:
+                pass
+        self._iterator = iter(iterable)
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        try:
+            chunk = next(self._iterator)
+        except StopIteration:
+            raise
+        except BaseException:
+            self.failed = True
+            raise
+        if chunk:
+            if self.first_byte is None:
+                self.first_byte = perf_counter_ns()
+            self.response_bytes += len(chunk)
+        return chunk
+
+    def close(self) -> None:
+        try:
+            if self._close is not None:
+                self._close()
+        finally:
+            self.finish()
+
+    def finish(self) -> None:
+        """ Save the point, once """
+        end = perf_counter_ns()
+        if self._finished:
+            return
+        self._finished = True
+        self.middleware.save_response(self, end)
+
+
+class HowFastWSGIMiddleware(CoreAPM):
+    """
+    WSGI middleware to measure how much time is spent per request, for any WSGI framework.
+
+    The time is measured until the server has sent the last byte of the response, with the time to
+    the first byte and the size of the response. Frameworks can provide the endpoint and route that
+    handled the request by storing them in the WSGI environ (see METADATA_ENVIRON_KEY).
+    """
+
+    def __init__(
+            self,
+            # The WSGI application to analyze
+            wsgi_app: Callable[[dict, Callable], Iterable[bytes]],
+            # The HowFast app ID to use
+            app_id: str = None,
+            # Endpoints not to monitor
+            endpoints_blacklist: List[str] = None,
+            # Only monitor these endpoints (all of them by default)
+            endpoints_allowlist: List[str] = None,
+            # Other configuration parameters passed to the CoreAPM constructor
+            **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.wsgi_app = wsgi_app
+        self.endpoints_blacklist = compile_endpoints(*(endpoints_blacklist or []))
+        self.endpoints_allowlist = compile_endpoints(*endpoints_allowlist) if endpoints_allowlist is not None else None
+
+        # Setup the queue and the background thread
+        self.setup(app_id)
+
+    def __call__(self, environ, start_response):
+        if not self.app_id:
+            # HF APM not configured, return early to save some time
+            return self.wsgi_app(environ, start_response)
+
+        uri = environ.get('PATH_INFO')
+
+        if is_in_blacklist(uri, self.endpoints_blacklist):
+            # Endpoint blacklist, return now
+            return self.wsgi_app(environ, start_response)
+
+        if self.endpoints_allowlist is not None and not is_in_blacklist(uri, self.endpoints_allowlist):
+            # Endpoint not in the allowlist, return now
+            return self.wsgi_app(environ, start_response)
+
+        # Requests that are not sampled are still timed, in case they have to be kept because they
+        # are slow or failed, but nothing else is recorded
+        sampled = self.sampler.sample() if self.sampler.enabled else True
+
+        # Start with an empty list of interactions, in case something was recorded in this context
+        # outside of a request
+        self.reset_interactions(record=sampled)
+
+        profiled = self.profiler.begin() if self.profiler is not None else None
+        stalls = self.stall_monitor.snapshot() if self.stall_monitor is not None else None
+        response = TimedResponse(self, environ, start_response, sampled, profiled, stalls)
+        try:
+            iterable = self.wsgi_app(environ, response.start_response)
+        except BaseException:
+            # The WSGI app raised an exception, let's still save the point before raising the
+            # exception again
+            response.failed = True
+            response.finish()
+            raise
+        return response.wrap(iterable)
+
+    def save_response(self, response: TimedResponse, end: int) -> None:
+        """ Save the point of a response, once it was sent """
+        environ = response.environ
+        response_status = response.response_status
+        if response.failed:
+            # The real response status will actually be set by the server that interacts with the
+            # WSGI app, but we cannot instrument it from here, so we just assume a common string.
+            response_status = "500 INTERNAL SERVER ERROR"
+        metadata = environ.get(METADATA_ENVIRON_KEY) or {}
+        url_rule = metadata.get('url_rule')
+        endpoint_name = metadata.get('endpoint_name')
+        elapsed = end - response.start
+        profile = self.profiler.end(response.profiled) if response.profiled is not None else None
+        if self.sampler.enabled and not self.sampler.keep(response.sampled, url_rule or endpoint_name, elapsed, response_status):
+            return
+        gc_pause_ns, stall_ns = self.stall_monitor.since(response.stalls) if response.stalls is not None else (None, None)
+        self.save_point(
+            time_request_started_ns=response.time_request_started_ns,
+            time_elapsed_ns=elapsed,
+            method=environ.get('REQUEST_METHOD'),
+            uri=environ.get('PATH_INFO'),
+            response_status=response_status,
+            endpoint_name=endpoint_name,
+            url_rule=url_rule,
+            is_not_found=metadata.get('is_not_found'),
+            time_to_first_byte_ns=response.first_byte - response.start if response.first_byte is not None else None,
+            response_bytes=response.response_bytes,
+            profile=profile,
+            gc_pause_ns=gc_pause_ns,
+            stall_ns=stall_ns,
+        )
+        self.overhead.observe(perf_counter_ns() - end)
+
@@ -0,0 +1,97 @@
+"""
+Local stand-in for the HowFast collector: it decodes the batches like the API does (compressed or
+not, JSON or columnar), and keeps them for the tests to inspect. It can also answer slowly or with
+errors, to see how the agent behaves when the API is degraded (see benchmarks/).
+"""
+import gzip
+import json
+import random
+import threading
+import time
+from typing import Any, Dict, List
+
+from werkzeug.serving import make_server
+from werkzeug.wrappers import Request, Response
+
+from howfast_apm.columnar import CONTENT_TYPE as COLUMNAR_CONTENT_TYPE, decode_columnar
+
+try:
+    import zstandard
+except ModuleNotFoundError:
+    zstandard = None
+
+
+class FakeCollector:
+    """ Collector API served by a local werkzeug server, in a thread """
+
+    # Whether batches with the columnar encoding are accepted (415 otherwise)
+    accept_columnar: bool
+
+    # Time to wait before answering, in seconds
+    latency: float
+    # Probability to answer with a 503 error, without keeping the batch
+    error_rate: float
+
+    # Decoded payloads received, and size of the bodies as received (compressed)
+    batches: List[Dict[str, Any]]
+    bytes_received: int
+    errors: int
+
+    def __init__(self, accept_columnar: bool = True, latency: float = 0, error_rate: float = 0):
+        self.accept_columnar = accept_columnar
+        self.latency = latency
+        self.error_rate = error_rate
+        self.batches = []
+        self.bytes_received = 0
+        self.errors = 0
+        self._server = make_server('127.0.0.1', 0, self.wsgi_app, threaded=True)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self._server.server_port}/v1.1/apm-collector/store'
+
+    @property
+    def points(self) -> List[Dict[str, Any]]:
+        return [point for batch in self.batches for point in batch['perf']]
+
+    def start(self) -> 'FakeCollector':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def decode(self, request: Request) -> Dict[str, Any]:
+        body = request.get_data()
+        self.bytes_received += len(body)
+        encoding = request.headers.get('Content-Encoding', 'identity')
+        if encoding == 'gzip':
+            body = gzip.decompress(body)
+        elif encoding == 'zstd' and zstandard is not None:
+            body = zstandard.ZstdDecompressor().decompress(body)
+        elif encoding != 'identity':
+            raise ValueError(encoding)
+        if request.mimetype == COLUMNAR_CONTENT_TYPE:
+            if not self.accept_columnar:
+                raise ValueError(request.mimetype)
+            return decode_columnar(body)
+        return json.loads(body)
+
+    def wsgi_app(self, environ, start_response):
+        request = Request(environ)
+        if request.method == 'GET':
+            # Stands for any other service called by the application
+            return Response('ok')(environ, start_response)
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return Response('Service Unavailable', status=503)(environ, start_response)
+        try:
+            payload = self.decode(request)
+        except ValueError:
+            return Response('Unsupported Media Type', status=415)(environ, start_response)
+        self.batches.append(payload)
+        return Response('ok')(environ, start_response)
@@ -0,0 +1,138 @@
+import os
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from howfast_apm import core
+from howfast_apm.agent import Agent, AgentSink, decode_point, encode_point, main
+from howfast_apm.point import Point
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    return str(tmp_path / 'agent.sock')
+
+
+@pytest.fixture
+def agent(socket_path):
+    agent = Agent(socket_path=socket_path)
+    agent.poll_interval = 0.1
+    agent.start_runner = MagicMock()
+    agent.bind()
+    yield agent
+    agent.close(timeout=0.1)
+
+
+def test_encode_point(example_queue_item):
+    """ Records should decode to the same point """
+    example_queue_item.url_rule = '/look/<string:where>'
+    example_queue_item.is_not_found = False
+    example_queue_item.interactions[0].extra = {'method': 'get'}
+    example_queue_item.spans = [('render', 1_000, 2_000_000, -1), (None, 5_000, 1_000_000, 0)]
+    example_queue_item.profile = 'app:view;app:render 4'
+    example_queue_item.gc_pause_ns = 250_000
+    example_queue_item.stall_ns = 0
+    app_id, point = decode_point(encode_point('some-dsn', example_queue_item))
+
+    assert app_id == 'some-dsn'
+    for field in Point.__slots__:
+        if field != 'interactions':
+            assert getattr(point, field) == getattr(example_queue_item, field)
+    assert [interaction.serialize() for interaction in point.interactions] == \
+        [interaction.serialize() for interaction in example_queue_item.interactions]
+
+
+def test_encode_point_none():
+    """ Missing values should be preserved, not turned into empty strings """
+    point = Point(time_request_started_ns=time.time_ns(), time_elapsed_ns=1, method='GET', uri='/')
+    _, decoded = decode_point(encode_point('some-dsn', point))
+    assert decoded.response_status is None
+    assert decoded.endpoint_name is None
+    assert decoded.is_not_found is None
+    assert decoded.interactions == []
+    assert decoded.spans == []
+    assert decoded.gc_pause_ns is None
+
+
+def test_sink_to_agent(agent, socket_path, example_queue_item):
+    """ Points sent by the workers should be queued by the agent, one queue per DSN """
+    sink_a = AgentSink(socket_path, 'dsn-a')
+    sink_b = AgentSink(socket_path, 'dsn-b')
+    sink_a.push(example_queue_item)
+    sink_a.push(example_queue_item)
+    sink_b.push(example_queue_item)
+
+    for data in agent.receive():
+        agent.handle(data)
+    assert len(agent.queues['dsn-a']) == 2
+    assert len(agent.queues['dsn-b']) == 1
+    assert agent.start_runner.call_count == 2
+    [point] = agent.queues['dsn-b'].drain()
+    assert point.uri == example_queue_item.uri
+    assert sink_a.dropped == 0
+
+
+def test_receive_steady_traffic(agent, socket_path, example_queue_item):
+    """ receive() should return after max_records_per_receive records, even if more are waiting """
+    sink = AgentSink(socket_path, 'dsn-a')
+    agent.max_records_per_receive = 2
+    for _ in range(5):
+        sink.push(example_queue_item)
+
+    # The datagrams still waiting are returned by the next calls
+    assert len(agent.receive()) == 2
+    assert len(agent.receive()) == 2
+    assert len(agent.receive()) == 1
+
+    # Without any datagram, it waits for poll_interval
+    assert agent.receive() == []
+
+
+def test_agent_invalid_record(agent):
+    """ Invalid datagrams should be ignored """
+    agent.handle(b'\x02garbage')
+    agent.handle(b'')
+    assert agent.queues == {}
+
+
+def test_sink_without_agent(socket_path, example_queue_item):
+    """ Points should be dropped, without raising, when the agent is not running """
+    sink = AgentSink(socket_path, 'dsn-a')
+    sink.push(example_queue_item)
+    sink.push(example_queue_item)
+    assert sink.dropped == 2
+
+
+def test_core_with_agent(agent, socket_path):
+    """ With an agent socket, the points should go to the agent and no thread should be started """
+    apm = core.CoreAPM(agent_socket=socket_path)
+    apm.start_background_thread = MagicMock()
+    apm.setup('some-dsn')
+    apm.save_point(time_request_started_ns=time.time_ns(), time_elapsed_ns=20_000_000, method='GET', uri='/')
+
+    apm.start_background_thread.assert_not_called()
+    [data] = agent.receive()
+    app_id, point = decode_point(data)
+    assert app_id == 'some-dsn'
+    assert point.uri == '/'
+
+
+def test_agent_close(socket_path):
+    """ Closing the agent should flush the runners and remove the socket """
+    agent = Agent(socket_path=socket_path)
+    agent.bind()
+    runner = agent.runners['some-dsn'] = MagicMock()
+    agent.close(timeout=1)
+    assert runner.stopping.set.called
+    assert 0 <= runner.shutdown.call_args[0][0] <= 1
+    assert not os.path.exists(socket_path)
+
+
+def test_main(socket_path):
+    """ The entry point should serve until it is stopped """
+    with patch.object(Agent, 'serve_forever') as serve_forever, patch('signal.signal'):
+        main(['--socket', socket_path, '--log-level', 'warning'])
+    serve_forever.assert_called_once_with()
+    assert not os.path.exists(socket_path)
+
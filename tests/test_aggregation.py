@@ -0,0 +1,95 @@
+import time
+
+from howfast_apm.aggregation import Aggregator, LatencySketch
+from howfast_apm.point import Point
+
+
+def make_point(elapsed_ms, method='GET', url_rule='/name/<string:name>', response_status='200 OK',
+               uri='/name/test', endpoint_name='names'):
+    return Point(
+        time_request_started_ns=time.time_ns(),
+        time_elapsed_ns=int(elapsed_ms * 1e6),
+        method=method,
+        uri=uri,
+        endpoint_name=endpoint_name,
+        url_rule=url_rule,
+        response_status=response_status,
+    )
+
+
+def test_sketch_accuracy():
+    """ Quantiles should be estimated within the relative accuracy of the sketch """
+    sketch = LatencySketch(relative_accuracy=0.01)
+    values = list(range(1, 10001))
+    for value in values:
+        sketch.add(value)
+    for quantile in (0.5, 0.9, 0.99):
+        expected = values[int(quantile * (len(values) - 1))]
+        assert abs(sketch.quantile(quantile) - expected) <= expected * 0.01
+    # Only a few hundred buckets for 10k values
+    assert len(sketch.bins) < 1000
+
+    serialized = sketch.serialize()
+    assert sum(serialized['counts']) == 10000
+    assert serialized['keys'] == sorted(serialized['keys'])
+
+
+def test_sketch_empty():
+    sketch = LatencySketch()
+    assert sketch.quantile(0.5) is None
+    sketch.add(0)
+    assert sketch.quantile(0.5) == 0
+
+
+def test_aggregator():
+    """ Points should be folded per method, endpoint and status """
+    aggregator = Aggregator(max_exemplars=2)
+    for elapsed in (10, 30, 20):
+        aggregator.add(make_point(elapsed))
+    aggregator.add(make_point(5, method='POST'))
+    aggregator.add(make_point(50, response_status='500 INTERNAL SERVER ERROR'))
+    assert len(aggregator) == 3
+
+    batch = aggregator.flush()
+    assert len(aggregator) == 0, "flush() should start a new window"
+    aggregates = [item for item in batch if not isinstance(item, Point)]
+    exemplars = [item for item in batch if isinstance(item, Point)]
+    assert len(aggregates) == 3
+
+    aggregate = aggregates[0].serialize()
+    assert aggregate['method'] == 'GET'
+    assert aggregate['url_rule'] == '/name/<string:name>'
+    assert aggregate['endpoint_name'] == 'names'
+    assert aggregate['response_status'] == '200 OK'
+    assert 'uri' not in aggregate
+    assert aggregate['count'] == 3
+    assert abs(aggregate['time_elapsed_sum'] - 0.06) < 1e-9
+    assert aggregate['time_elapsed_min'] == 0.01
+    assert aggregate['time_elapsed_max'] == 0.03
+    assert aggregate['time_window_started'] <= aggregate['time_window_ended']
+
+    # The two slowest points of the first aggregate, and the only point of the others
+    assert [point.time_elapsed_ns for point in exemplars] == [20_000_000, 30_000_000, 5_000_000, 50_000_000]
+
+
+def test_aggregator_without_exemplars():
+    aggregator = Aggregator(max_exemplars=0)
+    aggregator.add(make_point(10))
+    [aggregate] = aggregator.flush()
+    assert aggregate.count == 1
+
+
+def test_aggregator_without_route():
+    """ Requests of plain WSGI applications, without url_rule nor endpoint_name, are grouped by URI """
+    aggregator = Aggregator(max_exemplars=0)
+    for uri in ('/pets/1?size=large', '/pets/2', '/owners/1'):
+        aggregator.add(make_point(10, url_rule=None, endpoint_name=None, uri=uri))
+    assert len(aggregator) == 2
+
+    pets, owners = [aggregate.serialize() for aggregate in aggregator.flush()]
+    assert pets['uri'] == '/pets/?'
+    assert pets['count'] == 2
+    assert pets['endpoint_name'] is None
+    assert 'url_rule' not in pets
+    assert owners['uri'] == '/owners/?'
+    assert owners['count'] == 1
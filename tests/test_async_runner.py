@@ -0,0 +1,89 @@
+import asyncio
+import gzip
+import json
+from unittest.mock import patch
+
+import pytest
+import requests
+
+from howfast_apm.async_runner import AsyncRunner
+
+
+@pytest.fixture(autouse=True)
+def short_delays(monkeypatch):
+    monkeypatch.setattr(AsyncRunner, 'max_linger', 0.05)
+    monkeypatch.setattr(AsyncRunner, 'sleep_delay', 0.05)
+
+
+@patch.object(requests.Session, 'post')
+def test_send_batch(mocked_post, queue_full):
+    """ The task should send the points of the queue, without blocking the event loop """
+    mocked_post.return_value.status_code = 200
+    runner = AsyncRunner(queue=queue_full, app_id='test-dsn')
+    asyncio.run(runner.run_once())
+
+    assert mocked_post.call_count == 1
+    payload = json.loads(gzip.decompress(mocked_post.call_args[1]['data']))
+    assert payload['dsn'] == 'test-dsn'
+    assert len(payload['perf']) == 10
+    assert runner.current_batch == []
+
+
+@patch.object(requests.Session, 'post')
+def test_send_batch_failure(mocked_post, queue, example_queue_item):
+    """ Failed batches should be kept and sent again after the backoff delay """
+    mocked_post.return_value.status_code = 503
+    runner = AsyncRunner(queue=queue, app_id='test-dsn')
+    queue.push(example_queue_item)
+
+    async def main():
+        await runner.run_once()
+        assert len(runner.spool) == 1
+        assert runner.backoff.failures == 1
+
+        mocked_post.return_value.status_code = 200
+        runner.backoff.retry_at = 0
+        await runner.run_once()
+
+    asyncio.run(main())
+    assert len(runner.spool) == 0
+    assert mocked_post.call_count == 2
+
+
+@patch.object(requests.Session, 'post')
+def test_stop(mocked_post, queue, example_queue_item):
+    """ stop() should wake up the task, which sends the remaining points and exits """
+    mocked_post.return_value.status_code = 200
+    runner = AsyncRunner(queue=queue, app_id='test-dsn')
+    runner.sleep_delay = 10
+
+    async def main():
+        runner.start()
+        # Let the task wait for points
+        await asyncio.sleep(0.01)
+        queue.push(example_queue_item)
+        await runner.stop(1)
+
+    asyncio.run(main())
+    assert runner._task.done()
+    assert mocked_post.call_count == 1
+
+
+@patch.object(requests.Session, 'post')
+def test_shutdown_after_loop(mocked_post, queue, example_queue_item):
+    """ shutdown() should send the remaining points when the event loop is gone """
+    mocked_post.return_value.status_code = 200
+    runner = AsyncRunner(queue=queue, app_id='test-dsn')
+    runner.sleep_delay = 10
+    loop = asyncio.new_event_loop()
+
+    async def main():
+        runner.start()
+        await asyncio.sleep(0.01)
+
+    loop.run_until_complete(main())
+    queue.push(example_queue_item)
+    runner.shutdown(1)
+    assert mocked_post.call_count == 1
+    assert queue.empty()
+    loop.close()
@@ -0,0 +1,93 @@
+import json
+import time
+
+from howfast_apm.aggregation import Aggregator
+from howfast_apm.columnar import decode_columnar, encode_columnar
+from howfast_apm.hook_requests import Interaction
+from howfast_apm.point import Point
+from howfast_apm.runner import Runner
+
+
+def make_points(count):
+    return [
+        Point(
+            time_request_started_ns=time.time_ns(),
+            time_elapsed_ns=40_000_000 + index,
+            method='GET',
+            uri=f'/records/{index}',
+            interactions=[Interaction('request', 'https://example.org/', 0.01, {'method': 'get'})] if index % 4 == 0 else [],
+            response_status='200 OK',
+            endpoint_name='records',
+            url_rule='/records/<int:id>',
+            is_not_found=False,
+            time_to_first_byte_ns=10_000_000 if index % 2 else None,
+            response_bytes=1234 if index % 2 else None,
+            spans=[('load', 1_000, 20_000_000, -1), ('query', 2_000, 5_000_000, 0)] if index % 3 == 0 else None,
+            profile='app:view;app:load 12\napp:view 3' if index == 5 else None,
+            gc_pause_ns=250_000 if index % 2 else None,
+            stall_ns=3_000_000 if index % 5 == 0 else None,
+        )
+        for index in range(count)
+    ]
+
+
+def test_decode_like_json(queue, example_queue_items_gen):
+    """ The columnar encoding should decode to the same payload as the JSON encoding """
+    runner = Runner(queue=queue, app_id='test-dsn', wire_format='columnar')
+    runner.current_batch = make_points(10) + [next(example_queue_items_gen) for _ in range(4)]
+    columnar = runner.encode_batch()
+    runner.wire_format = 'json'
+    assert decode_columnar(columnar) == json.loads(runner.encode_batch())
+
+    runner.current_batch = []
+    assert decode_columnar(encode_columnar('test-dsn', [])) == {'dsn': 'test-dsn', 'perf': []}
+
+
+def test_decode_aggregates(queue):
+    """ Aggregates are sent along with their exemplars """
+    runner = Runner(queue=queue, app_id='test-dsn', wire_format='columnar', aggregate=True)
+    runner.aggregator = Aggregator()
+    for point in make_points(10):
+        runner.aggregator.add(point)
+    runner.current_batch = runner.aggregator.flush()
+    columnar = runner.encode_batch()
+    runner.wire_format = 'json'
+    assert decode_columnar(columnar) == json.loads(runner.encode_batch())
+
+
+def test_columnar_size(queue):
+    """ The columnar encoding of a batch should be smaller than the JSON one """
+    # The time to build them is compared by benchmarks/encoding.py
+    runner = Runner(queue=queue, app_id='test-dsn')
+    runner.current_batch = make_points(1000)
+    json_size = len(runner.encode_batch())
+    runner.wire_format = 'columnar'
+    columnar_size = len(runner.encode_batch())
+    assert columnar_size * 3 < json_size
+
+
+def test_send_columnar(fake_collector, queue, example_queue_item):
+    """ The collector should receive the columnar batches, compressed """
+    runner = Runner(queue=queue, app_id='test-dsn', wire_format='columnar')
+    runner.collector_url = fake_collector.url
+    runner.max_linger = 0.01
+    queue.push(example_queue_item)
+    runner.run_once()
+    [batch] = fake_collector.batches
+    assert batch['dsn'] == 'test-dsn'
+    assert batch['perf'][0]['uri'] == '/look/here'
+    assert runner.wire_format == 'columnar'
+
+
+def test_columnar_not_supported(fake_collector, queue, example_queue_item):
+    """ The Runner should go back to JSON if the collector does not support the columnar encoding """
+    fake_collector.accept_columnar = False
+    runner = Runner(queue=queue, app_id='test-dsn', wire_format='columnar')
+    runner.collector_url = fake_collector.url
+    runner.max_linger = 0.01
+    queue.push(example_queue_item)
+    runner.run_once()
+    [batch] = fake_collector.batches
+    assert batch['perf'][0]['uri'] == '/look/here'
+    assert runner.wire_format == 'json'
+    assert runner.compression == 'gzip'
@@ -1,44 +1,191 @@
-from queue import Queue
+import os
+import time
+import signal
+from threading import Barrier, Thread
+from unittest.mock import MagicMock
+
 from howfast_apm import core
+from howfast_apm.hook_requests import Interaction
+from howfast_apm.point import Point
+from howfast_apm.queue import RingBuffer
 
 
 def test_capped_queue(example_queue_items_gen):
     """ CoreAPM.save_point should add items in the queue """
     # TODO: find a better way to replace this queue object
-    core.queue = Queue(maxsize=10)
+    core.queue = RingBuffer(maxsize=10)
     # Save one point
     assert core.queue.qsize() == 0
-    core.CoreAPM._save_point(**next(example_queue_items_gen))
+    core.CoreAPM._save_point(next(example_queue_items_gen))
     assert core.queue.qsize() == 1
 
     # Save a second point
-    core.CoreAPM._save_point(**next(example_queue_items_gen))
+    core.CoreAPM._save_point(next(example_queue_items_gen))
     assert core.queue.qsize() == 2
 
     # Fill the queue
     for i in range(8):
         item = next(example_queue_items_gen)
-        item['uri'] = f'/call/{i}'  # update the URL to keep track of points
-        core.CoreAPM._save_point(**item)
+        item.uri = f'/call/{i}'  # update the URL to keep track of points
+        core.CoreAPM._save_point(item)
     assert core.queue.qsize() == 10
     assert core.queue.full()
 
-    next_item = core.queue.get_nowait()
+    [next_item] = core.queue.drain(1)
     assert next_item
 
 
-def test_capped_queue_full(example_queue_item):
+def test_capped_queue_full(example_queue_items_gen):
     """ CoreAPM.save_point should discard old items should the queue be full """
     # TODO: find a better way to replace this queue object
-    core.queue = Queue(maxsize=10)
+    core.queue = RingBuffer(maxsize=10)
     # Fill the queue
     for i in range(10):
-        item = example_queue_item
-        item['uri'] = f'/call/{i}'  # update the URL to keep track of points
-        core.CoreAPM._save_point(**item)
+        item = next(example_queue_items_gen)
+        item.uri = f'/call/{i}'  # update the URL to keep track of points
+        core.CoreAPM._save_point(item)
     assert core.queue.full()
+    assert core.queue.dropped == 0
 
     # Add one more item to the full queue
-    core.CoreAPM._save_point(**example_queue_item)
+    item = next(example_queue_items_gen)
+    item.uri = '/call/10'
+    core.CoreAPM._save_point(item)
     assert core.queue.full(), 'queue should still be full'
     assert core.queue.qsize() == 10
+    assert core.queue.dropped == 1
+
+    # The oldest point was discarded
+    points = core.queue.drain()
+    assert [point.uri for point in points] == [f'/call/{i}' for i in range(1, 11)]
+    assert core.queue.empty()
+
+
+def test_interactions_per_context():
+    """ Interactions recorded in concurrent threads should not be mixed """
+    apm = core.CoreAPM()
+    barrier = Barrier(2)
+    recorded = {}
+
+    def handle_request(name):
+        apm.record_interaction(Interaction('request', name, 0.01))
+        # Make sure both threads recorded their interaction before reading the list
+        barrier.wait()
+        recorded[name] = [interaction.name for interaction in apm.interactions]
+
+    threads = [Thread(target=handle_request, args=(name, )) for name in ('first', 'second')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert recorded == {'first': ['first'], 'second': ['second']}
+    # Nothing was recorded in the main thread
+    assert len(apm.interactions) == 0
+
+
+def test_save_point_resets_interactions():
+    """ save_point() should forward the interactions of the request and start a new list """
+    apm = core.CoreAPM()
+    core.queue = RingBuffer(maxsize=10)
+    apm.record_interaction(Interaction('request', 'https://example.org/', 0.01))
+    apm.save_point(time_request_started_ns=time.time_ns(), time_elapsed_ns=20_000_000, method='GET', uri='/')
+
+    [point] = core.queue.drain()
+    assert [interaction.name for interaction in point.interactions] == ['https://example.org/']
+    assert len(apm.interactions) == 0
+
+
+def test_save_point_record(example_queue_item):
+    """ Points should be compact records with interned strings """
+    assert not hasattr(example_queue_item, '__dict__')
+    core.queue = RingBuffer(maxsize=10)
+    apm = core.CoreAPM()
+    status = ''.join(['200', ' OK'])
+    apm.save_point(time_request_started_ns=time.time_ns(), time_elapsed_ns=20_000_000, method='GET', uri='/', response_status=status)
+    [point] = core.queue.drain()
+    assert isinstance(point, Point)
+    assert point.response_status == '200 OK'
+    assert point.response_status is example_queue_item.response_status
+
+
+def test_shutdown():
+    """ shutdown() should stop the Runner, if it was started """
+    apm = core.CoreAPM(shutdown_timeout=3)
+    # Nothing to stop
+    apm.shutdown()
+
+    apm.runner = MagicMock()
+    apm.runner.stopping.is_set.return_value = False
+    apm.shutdown()
+    apm.runner.shutdown.assert_called_once_with(3)
+
+    # Already stopping
+    apm.runner.stopping.is_set.return_value = True
+    apm.shutdown(timeout=1)
+    assert apm.runner.shutdown.call_count == 1
+
+
+def test_sigterm_handler():
+    """ SIGTERM should stop the Runner, then call the previous handler """
+    received = []
+
+    def previous_handler(signum, frame):
+        received.append(signum)
+
+    original_handler = signal.signal(signal.SIGTERM, previous_handler)
+    try:
+        apm = core.CoreAPM(handle_sigterm=True)
+        apm.shutdown = MagicMock()
+        apm._install_sigterm_handler()
+        os.kill(os.getpid(), signal.SIGTERM)
+        apm.shutdown.assert_called_once_with()
+        assert received == [signal.SIGTERM]
+    finally:
+        signal.signal(signal.SIGTERM, original_handler)
+
+
+def test_runner_started_lazily():
+    """ The Runner should only be started by the first point, not by setup() """
+    core.queue = RingBuffer(maxsize=10)
+    apm = core.CoreAPM(handle_sigterm=False)
+    apm.start_background_thread = MagicMock(side_effect=lambda: setattr(apm, 'runner', MagicMock()))
+    apm.setup('some-dsn')
+    apm.start_background_thread.assert_not_called()
+
+    apm.save_point(time_request_started_ns=time.time_ns(), time_elapsed_ns=20_000_000, method='GET', uri='/')
+    apm.save_point(time_request_started_ns=time.time_ns(), time_elapsed_ns=20_000_000, method='GET', uri='/')
+    apm.start_background_thread.assert_called_once_with()
+
+
+def test_after_fork_in_child(example_queue_item):
+    """ A forked child should start its own Runner and forget the points of the parent """
+    apm = core.CoreAPM()
+    apm.runner = MagicMock()
+    core.queue.push(example_queue_item)
+    core.queue.dropped = 3
+    apm._after_fork_in_child()
+
+    assert apm.runner is None
+    assert core.queue.empty() and core.queue.dropped == 0
+    assert apm.overhead.snapshot().count == 0
+
+
+def test_fork(example_queue_item):
+    """ The fork hooks should be called in a real forked child """
+    core.queue = RingBuffer(maxsize=10)
+    apm = core.CoreAPM(handle_sigterm=False)
+    apm.start_background_thread = MagicMock()
+    apm.setup('some-dsn')
+    apm.runner = MagicMock()
+    core.queue.push(example_queue_item)
+
+    pid = os.fork()
+    if pid == 0:
+        # Child: never return into pytest
+        os._exit(0 if apm.runner is None and core.queue.empty() else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    # The parent is untouched
+    assert apm.runner is not None
+    assert len(core.queue) == 1
@@ -0,0 +1,126 @@
+import sqlite3
+from unittest.mock import patch
+
+import pytest
+
+from howfast_apm import hook_db
+from howfast_apm.core import CoreAPM
+from howfast_apm.hook_db import install_db_hooks, normalize_sql
+
+
+@pytest.mark.parametrize('statement, expected', [
+    ("SELECT * FROM pet WHERE id = 42", "SELECT * FROM pet WHERE id = ?"),
+    ("SELECT * FROM pet_2 WHERE name = 'Rex' AND weight > 12.5", "SELECT * FROM pet_2 WHERE name = ? AND weight > ?"),
+    ("SELECT * FROM pet WHERE id IN (1, 2,3)", "SELECT * FROM pet WHERE id IN (?)"),
+    ("SELECT * FROM pet WHERE id IN (%s, %s) AND owner = %(owner)s", "SELECT * FROM pet WHERE id IN (?) AND owner = ?"),
+    ("SELECT * FROM pet WHERE id = $1 AND age::int > :age", "SELECT * FROM pet WHERE id = ? AND age::int > ?"),
+    ("SELECT *\n  FROM pet -- comment\n  /* other\n comment */ LIMIT 10", "SELECT * FROM pet LIMIT ?"),
+])
+def test_normalize_sql(statement, expected):
+    assert normalize_sql(statement)[0] == expected
+
+
+def test_fingerprint():
+    """ Statements with the same shape have the same fingerprint """
+    _, fingerprint = normalize_sql("SELECT * FROM pet WHERE id = 1")
+    assert normalize_sql("SELECT  * FROM pet WHERE id = 2")[1] == fingerprint
+    assert normalize_sql("SELECT * FROM owner WHERE id = 1")[1] != fingerprint
+
+    # Computed once per statement
+    hits = normalize_sql.cache_info().hits
+    normalize_sql("SELECT * FROM pet WHERE id = 1")
+    assert normalize_sql.cache_info().hits == hits + 1
+
+
+def test_trace_connection():
+    """ The statements executed with a traced DB-API connection are recorded """
+    apm = CoreAPM()
+    connection = apm.trace_connection(sqlite3.connect(':memory:'))
+
+    with connection:
+        cursor = connection.cursor()
+        cursor.execute("CREATE TABLE pet (id INTEGER, name TEXT)")
+        cursor.executemany("INSERT INTO pet VALUES (?, ?)", [(i, f'pet {i}') for i in range(3)])
+        for i in range(3):
+            cursor.execute("SELECT name FROM pet WHERE id = ?", (i, ))
+            assert cursor.fetchone() == (f'pet {i}', )
+
+    assert [interaction.name for interaction in apm.interactions] == [
+        "CREATE TABLE pet (id INTEGER, name TEXT)",
+        "INSERT INTO pet VALUES (?)",
+    ] + ["SELECT name FROM pet WHERE id = ?"] * 3
+    assert all(interaction.interaction_type == 'sql' for interaction in apm.interactions)
+    assert apm.interactions[1].extra['rows'] == 3
+    # The same query executed in a loop (N+1 queries) has the same fingerprint
+    assert len({interaction.extra['fingerprint'] for interaction in apm.interactions[2:]}) == 1
+
+
+def test_trace_connection_error():
+    """ The statements that fail are recorded as well """
+    apm = CoreAPM()
+    connection = apm.trace_connection(sqlite3.connect(':memory:'))
+
+    with pytest.raises(sqlite3.OperationalError):
+        connection.cursor().execute("SELECT * FROM missing")
+    assert len(apm.interactions) == 1
+    assert apm.interactions[0].name == "SELECT * FROM missing"
+
+
+def test_trace_connection_shortcuts():
+    """ The execute() shortcuts of the connection are recorded too """
+    apm = CoreAPM()
+    connection = apm.trace_connection(sqlite3.connect(':memory:'))
+    connection.execute("CREATE TABLE pet (id INTEGER)")
+    connection.executemany("INSERT INTO pet VALUES (?)", ((i, ) for i in range(3)))
+    assert connection.execute("SELECT COUNT(*) FROM pet").fetchone() == (3, )
+    connection.executemany("INSERT INTO pet VALUES (?)", [(3, ), (4, )])
+
+    assert [interaction.name for interaction in apm.interactions] == [
+        "CREATE TABLE pet (id INTEGER)",
+        "INSERT INTO pet VALUES (?)",
+        "SELECT COUNT(*) FROM pet",
+        "INSERT INTO pet VALUES (?)",
+    ]
+    # The generator is given to the driver as is: its rows are not counted
+    assert apm.interactions[1].extra['rows'] is None
+    assert apm.interactions[3].extra['rows'] == 2
+
+
+def test_setup_hooks_db():
+    """ The database hooks are only installed when enabled, and only for the installed libraries """
+    with patch('howfast_apm.core.install_db_hooks') as install:
+        CoreAPM(record_db_interactions=False).setup_hooks()
+    install.assert_not_called()
+
+    apm = CoreAPM(record_db_interactions=True)
+    apm.setup_hooks()
+    assert hook_db._installed is True
+    assert hook_db._record_interaction == apm.record_interaction
+
+    try:
+        import redis.client
+    except ModuleNotFoundError:
+        redis = None
+    if redis is not None:
+        assert '_install_redis_hooks' in redis.client.Redis.execute_command.__qualname__
+        assert '_install_redis_hooks' in redis.client.Pipeline.execute.__qualname__
+
+    # The SQLAlchemy listeners are checked by test_hook_sqlalchemy
+
+    # Installed once: the next calls only change where the interactions go
+    other = CoreAPM(record_db_interactions=True)
+    install_db_hooks(other.record_interaction)
+    assert hook_db._record_interaction == other.record_interaction
+
+
+def test_hook_sqlalchemy():
+    sqlalchemy = pytest.importorskip('sqlalchemy')
+    apm = CoreAPM(record_db_interactions=True)
+    apm.setup_hooks()
+
+    engine = sqlalchemy.create_engine('sqlite://')
+    with engine.connect() as connection:
+        connection.execute(sqlalchemy.text("SELECT 1 WHERE 2 = :value"), {'value': 2})
+
+    assert [interaction.name for interaction in apm.interactions] == ["SELECT ? WHERE ? = ?"]
+    assert apm.interactions[0].interaction_type == 'sql'
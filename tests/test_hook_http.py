@@ -1,5 +1,13 @@
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import patch
+
+import pytest
+import requests
+
 from howfast_apm.core import CoreAPM
+from howfast_apm.hook_http import without_interactions
 
 
 @patch('requests.get')
@@ -78,5 +86,101 @@ def test_requests_request(request_mocked):
     assert interaction.extra.get('method') == 'get'
 
 
-# TODO: test requests made with urllib
-# TODO: test requests made by third-party dependencies - does the hook work?
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """ Answers "ok" to every request, keeping the connection open """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(404 if self.path == '/missing' else 200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+
+def test_hook_requests_session(server_url):
+    """ Requests made with a session are recorded, with the reuse of the pooled connection """
+    apm = CoreAPM()
+    apm.setup_hooks()
+    url = f'{server_url}/store'
+
+    with requests.Session() as session:
+        session.post(url, json={})
+        session.post(url, json={})
+
+    assert len(apm.interactions) == 2
+    first, second = apm.interactions
+    assert first.interaction_type == 'request'
+    assert first.name == url
+    assert first.extra['method'] == 'post'
+    assert first.extra['host'] == '127.0.0.1'
+    assert first.extra['status'] == 200
+    assert first.extra['response_bytes'] == 2
+    # The first request opened the connection, the second one reused it
+    assert first.extra['reused'] is False
+    assert first.extra['connect_time'] > 0
+    assert second.extra['reused'] is True
+    assert second.extra['connect_time'] == 0
+    assert second.elapsed == second.extra['response_time']
+    assert first.elapsed >= first.extra['connect_time']
+
+
+def test_hook_urlopen(server_url):
+    """ Requests made with urllib are recorded """
+    apm = CoreAPM()
+    apm.setup_hooks()
+
+    url = f'{server_url}/store'
+    with urllib.request.urlopen(url, data=b'{}') as response:
+        assert response.read() == b'ok'
+
+    assert len(apm.interactions) == 1
+    interaction = apm.interactions[0]
+    assert interaction.name == url
+    assert interaction.extra['method'] == 'post'
+    assert interaction.extra['status'] == 200
+    assert interaction.extra['reused'] is False
+
+
+def test_hook_requests_details(server_url):
+    """ The hooked requests functions are recorded once, with the details of the connection """
+    apm = CoreAPM()
+    apm.setup_hooks()
+
+    url = f'{server_url}/missing'
+    requests.get(url)
+
+    assert len(apm.interactions) == 1
+    interaction = apm.interactions[0]
+    assert interaction.name == url
+    assert interaction.extra['method'] == 'get'
+    assert interaction.extra['status'] == 404
+    assert interaction.extra['reused'] is False
+    assert interaction.extra['connect_time'] > 0
+
+
+def test_hook_disabled(server_url):
+    """ The requests of the Runner are not recorded """
+    apm = CoreAPM()
+    apm.setup_hooks()
+
+    with without_interactions(), requests.Session() as session:
+        session.get(server_url)
+
+    assert len(apm.interactions) == 0
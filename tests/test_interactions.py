@@ -0,0 +1,91 @@
+import json
+
+from howfast_apm.columnar import decode_columnar, encode_columnar
+from howfast_apm.core import CoreAPM
+from howfast_apm.hook_requests import Interaction
+from howfast_apm.interactions import MAX_ROLLUPS, InteractionBuffer, normalize_url
+from howfast_apm.point import Point
+
+
+def make_interaction(name, elapsed=0.01, method='get', interaction_type='request'):
+    return Interaction(interaction_type, name, elapsed, {'method': method})
+
+
+def test_normalize_url():
+    assert normalize_url('https://example.org/pets/12/photos/34?size=large') == 'https://example.org/pets/?/photos/?'
+    assert normalize_url('https://example.org/pets/0cc175b9c0f1b6a831c399e269772661') == 'https://example.org/pets/?'
+    assert normalize_url('https://example.org/pets/9b2d4f6e-1c3a-4e5b-8f7a-0d1e2f3a4b5c#top') == 'https://example.org/pets/?'
+    assert normalize_url('https://example.org/v2/pets') == 'https://example.org/v2/pets'
+    assert normalize_url(None) is None
+
+
+def test_buffer_under_the_cap():
+    """ The interactions are reported as is while there are fewer than max_size """
+    buffer = InteractionBuffer(max_size=3)
+    for i in range(3):
+        buffer.record(make_interaction(f'https://example.org/pets/{i}'))
+    assert buffer.finish() is buffer
+    assert len(buffer) == 3
+
+
+def test_buffer_rollup():
+    """ Past max_size, the interactions are rolled up per type, normalized name and method """
+    buffer = InteractionBuffer(max_size=2)
+    for i in range(10):
+        buffer.record(make_interaction(f'https://example.org/pets/{i}', elapsed=0.01 * (i + 1)))
+    buffer.record(make_interaction('https://example.org/pets/1', method='post'))
+    buffer.record(Interaction('sql', 'SELECT * FROM pet WHERE id = ?', 0.5, {'fingerprint': 'abc'}))
+
+    assert len(buffer) == 2
+    interactions = buffer.finish()
+    assert [interaction.name for interaction in interactions[:2]] == ['https://example.org/pets/0', 'https://example.org/pets/1']
+
+    rollups = interactions[2:]
+    assert [(rollup.interaction_type, rollup.name, rollup.extra.get('method')) for rollup in rollups] == [
+        ('request', 'https://example.org/pets/?', 'get'),
+        ('request', 'https://example.org/pets/?', 'post'),
+        ('sql', 'SELECT * FROM pet WHERE id = ?', None),
+    ]
+    rollup = rollups[0]
+    assert rollup.extra['rollup'] is True
+    assert rollup.extra['count'] == 8
+    assert abs(rollup.elapsed - sum(0.01 * (i + 1) for i in range(2, 10))) < 1e-9
+    assert rollup.extra['max_elapsed'] == 0.1
+    # The slowest interaction is kept as an example
+    assert rollup.extra['exemplar']['name'] == 'https://example.org/pets/9'
+    assert rollups[2].extra['exemplar']['extra'] == {'fingerprint': 'abc'}
+
+
+def test_buffer_bounded():
+    """ The memory used by a request doesn't depend on the number of interactions """
+    buffer = InteractionBuffer(max_size=100)
+    for i in range(3000):
+        buffer.record(make_interaction(f'https://service-{i}.example.org/'))
+    assert len(buffer) == 100
+    assert len(buffer.rollups) == MAX_ROLLUPS + 1
+    # Past MAX_ROLLUPS, the interactions are rolled up per type
+    other = buffer.rollups[('request', None, None)]
+    assert other.count == 3000 - 100 - MAX_ROLLUPS
+
+
+def test_save_point_rollups():
+    """ The rollups are reported with the point, and can be encoded """
+    apm = CoreAPM(max_interactions=1)
+    saved = []
+    apm._save_point = saved.append
+    for _ in range(5):
+        apm.record_interaction(make_interaction('https://example.org/pets/1'))
+    apm.save_point(
+        time_request_started_ns=1_600_000_000_000_000_000,
+        time_elapsed_ns=1_000_000,
+        method='GET',
+        uri='/',
+    )
+
+    [point] = saved
+    assert isinstance(point, Point)
+    assert len(point.interactions) == 2
+    assert point.interactions[1].extra['count'] == 4
+
+    payload = decode_columnar(encode_columnar('dsn', [point]))
+    assert payload['perf'][0]['interactions'][1]['extra'] == json.loads(json.dumps(point.interactions[1].extra))
@@ -0,0 +1,42 @@
+from howfast_apm.metrics import Histogram
+
+
+def test_histogram_buckets():
+    """ Values should be counted in the bucket of their upper bound """
+    histogram = Histogram(bounds=(10, 100, 1000))
+    for value in (1, 10, 11, 500, 1000, 5000):
+        histogram.observe(value)
+    snapshot = histogram.snapshot()
+    assert snapshot.counts == (2, 1, 2, 1)
+    assert snapshot.count == 6
+    assert snapshot.total == 6522
+    assert snapshot.as_dict() == {'le_10ns': 2, 'le_100ns': 1, 'le_1000ns': 2, 'inf': 1}
+
+
+def test_histogram_percentiles():
+    """ Percentiles should be approximated by the bucket bounds """
+    histogram = Histogram(bounds=(10, 100, 1000))
+    assert histogram.snapshot().percentile(50) is None
+    assert histogram.snapshot().mean is None
+    for _ in range(98):
+        histogram.observe(5)
+    histogram.observe(50)
+    histogram.observe(50000)
+    snapshot = histogram.snapshot()
+    assert snapshot.percentile(50) == 10
+    assert snapshot.percentile(99) == 100
+    # The last value is above the last bound
+    assert snapshot.percentile(100) is None
+    assert snapshot.mean == (98 * 5 + 50 + 50000) / 100
+
+
+def test_histogram_difference():
+    """ Subtracting snapshots should give the values observed in between """
+    histogram = Histogram(bounds=(10, 100))
+    histogram.observe(5)
+    before = histogram.snapshot()
+    histogram.observe(50)
+    histogram.observe(500)
+    window = histogram.snapshot() - before
+    assert window.counts == (0, 1, 1)
+    assert window.total == 550
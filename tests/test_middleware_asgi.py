@@ -0,0 +1,134 @@
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+
+from howfast_apm.asgi import status_line
+
+
+async def ok_app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    # What the router of Starlette stores in the scope
+    scope['route'] = MagicMock(path='/records/{id}')
+    scope['endpoint'] = records
+    await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b'ok', 'more_body': True})
+    await asyncio.sleep(0.01)
+    await send({'type': 'http.response.body', 'body': b'!'})
+
+
+def records():
+    pass  # pragma: nocover
+
+
+async def not_found_app(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 404, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b'not found'})
+
+
+async def failing_app(scope, receive, send):
+    raise Exception("Unhandled exception, kaboom!")
+
+
+def call(middleware, path='/records/42', method='GET', scope_type='http', messages=None):
+    """ Run the middleware like an ASGI server, and return what the application sent """
+    sent = []
+    messages = list(messages or [{'type': 'http.request', 'body': b''}])
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': scope_type, 'path': path, 'method': method}
+    asyncio.run(middleware(scope, receive, send))
+    return sent
+
+
+@pytest.fixture()
+def HowFastASGIMiddleware():
+    """ Patch the save_point() method """
+    from howfast_apm import HowFastASGIMiddleware
+    HowFastASGIMiddleware._save_point = MagicMock()
+    # Prevent the uploader task to actually start
+    HowFastASGIMiddleware.start_background_thread = MagicMock()
+    return HowFastASGIMiddleware
+
+
+def test_ok_without_dsn(HowFastASGIMiddleware):
+    """ The middleware should pass the requests through when there is no DSN """
+    middleware = HowFastASGIMiddleware(ok_app)
+    sent = call(middleware)
+    assert sent[0]['status'] == 200
+    assert middleware._save_point.called is False
+
+
+def test_ok_with_dsn(HowFastASGIMiddleware):
+    """ The point should be timed until the last part of the body, with the route metadata """
+    middleware = HowFastASGIMiddleware(ok_app, app_id='some-dsn')
+    sent = call(middleware)
+    assert [message['type'] for message in sent] == ['http.response.start'] + ['http.response.body'] * 2
+
+    point = middleware._save_point.call_args[0][0]
+    assert point.method == 'GET'
+    assert point.uri == '/records/42'
+    assert point.response_status == '200 OK'
+    assert point.url_rule == '/records/{id}'
+    assert point.endpoint_name == 'records'
+    assert point.is_not_found is False
+    assert point.time_elapsed_ns >= 10_000_000
+    assert point.time_to_first_byte_ns < 10_000_000
+    assert point.response_bytes == 3
+
+
+def test_not_found(HowFastASGIMiddleware):
+    middleware = HowFastASGIMiddleware(not_found_app, app_id='some-dsn')
+    call(middleware, path='/does-not-exist')
+    point = middleware._save_point.call_args[0][0]
+    assert point.response_status == '404 NOT FOUND'
+    assert point.is_not_found is True
+    assert point.url_rule is None
+
+
+def test_exception(HowFastASGIMiddleware):
+    """ Exceptions should be raised again, after the point is saved """
+    middleware = HowFastASGIMiddleware(failing_app, app_id='some-dsn')
+    with pytest.raises(Exception):
+        call(middleware)
+    point = middleware._save_point.call_args[0][0]
+    assert point.response_status == '500 INTERNAL SERVER ERROR'
+
+
+def test_blacklist_and_websockets(HowFastASGIMiddleware):
+    """ Blacklisted endpoints and other protocols should not be reported """
+    middleware = HowFastASGIMiddleware(not_found_app, app_id='some-dsn', endpoints_blacklist=['/health'])
+    call(middleware, path='/health')
+    call(middleware, scope_type='websocket')
+    assert middleware._save_point.called is False
+
+
+def test_lifespan_shutdown(HowFastASGIMiddleware):
+    """ The remaining points should be sent when the application shuts down """
+    middleware = HowFastASGIMiddleware(ok_app, app_id='some-dsn', shutdown_timeout=2)
+    runner = middleware.runner = MagicMock()
+
+    async def stop(timeout):
+        pass
+    runner.stop = MagicMock(side_effect=stop)
+    sent = call(middleware, scope_type='lifespan', messages=[{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+    assert [message['type'] for message in sent] == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    runner.stop.assert_called_once_with(2)
+
+
+def test_status_line():
+    assert status_line(200) == '200 OK'
+    assert status_line(503) == '503 SERVICE UNAVAILABLE'
+    assert status_line(599) == '599'
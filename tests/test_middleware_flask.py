@@ -1,13 +1,24 @@
+import time
+import asyncio
+import inspect
 import pytest
 import requests
 
-from flask import Flask
+from flask import Blueprint, Flask, Response, render_template_string
+from flask.testing import FlaskClient
 from unittest.mock import MagicMock, patch
-from datetime import datetime, timezone
+
+
+class ClosingClient(FlaskClient):
+    """ Like a WSGI server, send the whole response and close it: the middleware saves the point then """
+
+    def open(self, *args, buffered=True, **kwargs):
+        return super().open(*args, buffered=buffered, **kwargs)
 
 
 def create_app():
     app = Flask("test")
+    app.test_client_class = ClosingClient
 
     @app.route('/')
     def index():
@@ -37,6 +48,14 @@ def create_app():
         # Return a 404 status code
         return 'not found', 404
 
+    @app.route('/stream')
+    def stream():
+        def generate():
+            yield 'a,b\n'
+            time.sleep(0.02)
+            yield '1,2\n'
+        return Response(generate(), mimetype='text/csv')
+
     return app
 
 
@@ -72,20 +91,235 @@ def test_ok_with_dsn(HowFastFlaskMiddleware):
     assert response.status_code == 200
     assert middleware._save_point.called is True
     assert middleware._save_point.call_count == 1
-    point = middleware._save_point.call_args[1]
-    assert point.get('time_elapsed') > 0
-    assert point.get('time_request_started') < datetime.now(timezone.utc)
-    assert point.get('method') == "GET"
-    assert point.get('response_status') == "200 OK"
-    assert point.get('uri') == "/"
+    point = middleware._save_point.call_args[0][0]
+    assert point.time_elapsed_ns > 0
+    assert point.time_request_started_ns < time.time_ns()
+    assert point.method == "GET"
+    assert point.response_status == "200 OK"
+    assert point.uri == "/"
 
     response = tester.post('/does-not-exist')
     assert response.status_code == 404
     assert middleware._save_point.call_count == 2
-    point = middleware._save_point.call_args[1]
-    assert point.get('method') == "POST"
-    assert point.get('response_status') == "404 NOT FOUND"
-    assert point.get('uri') == "/does-not-exist"
+    point = middleware._save_point.call_args[0][0]
+    assert point.method == "POST"
+    assert point.response_status == "404 NOT FOUND"
+    assert point.uri == "/does-not-exist"
+
+
+def test_streaming_response(HowFastFlaskMiddleware):
+    """ Streamed responses should be timed until their last byte, with the Flask metadata """
+    app = create_app()
+    middleware = HowFastFlaskMiddleware(app, app_id='some-dsn')
+
+    tester = app.test_client()
+    response = tester.get('/stream')
+    assert response.data == b'a,b\n1,2\n'
+    point = middleware._save_point.call_args[0][0]
+    assert point.time_elapsed_ns >= 20_000_000
+    assert point.time_to_first_byte_ns < 20_000_000
+    assert point.response_bytes == 8
+    assert point.endpoint_name == 'stream'
+
+
+def test_spans(HowFastFlaskMiddleware):
+    """ Spans of the view should be reported with the point """
+    app = create_app()
+    middleware = HowFastFlaskMiddleware(app, app_id='some-dsn', record_phases=False)
+
+    @app.route('/report')
+    @middleware.span()
+    def report():
+        with middleware.span('render'):
+            time.sleep(0.01)
+        return 'ok'
+
+    tester = app.test_client()
+    tester.get('/report')
+    point = middleware._save_point.call_args[0][0]
+    [(view, _, view_duration, view_parent), (render, render_start, render_duration, render_parent)] = point.spans
+    assert (view, view_parent) == ('test_spans.<locals>.report', -1)
+    assert (render, render_parent) == ('render', 0)
+    assert render_duration >= 10_000_000
+    assert view_duration >= render_duration
+    assert render_start + render_duration <= point.time_elapsed_ns
+
+
+def test_phases(HowFastFlaskMiddleware):
+    """ The phases of the request should be reported as spans """
+    app = create_app()
+    blueprint = Blueprint('admin', __name__)
+
+    def authenticate():
+        time.sleep(0.005)
+
+    @blueprint.before_request
+    def check_admin():
+        pass
+
+    @blueprint.route('/admin/<name>')
+    def page(name):
+        return render_template_string('Hello {{ name }}', name=name)
+
+    app.before_request(authenticate)
+    app.after_request(lambda response: response)
+    app.teardown_request(lambda exception: None)
+    app.register_blueprint(blueprint)
+    middleware = HowFastFlaskMiddleware(app, app_id='some-dsn')
+
+    tester = app.test_client()
+    for _ in range(2):
+        response = tester.get('/admin/world')
+        assert response.data == b'Hello world'
+        point = middleware._save_point.call_args[0][0]
+        names = [name for name, _, _, _ in point.spans]
+        assert names == [
+            'routing',
+            'before_request:test_phases.<locals>.authenticate',
+            'before_request:test_phases.<locals>.check_admin',
+            'view:admin.page',
+            'render_template:<string>',
+            'after_request:test_phases.<locals>.<lambda>',
+            'teardown_request:test_phases.<locals>.<lambda>',
+        ]
+        spans = dict((name, (start, duration, parent)) for name, start, duration, parent in point.spans)
+        assert spans['before_request:test_phases.<locals>.authenticate'][1] >= 5_000_000
+        # The template is rendered by the view
+        assert spans['render_template:<string>'][2] == names.index('view:admin.page')
+        assert all(parent == -1 for name, (_, _, parent) in spans.items() if not name.startswith('render_template'))
+
+    # The functions were only wrapped once
+    assert app.view_functions['admin.page'].__wrapped__ is page
+
+
+def test_phases_async(HowFastFlaskMiddleware):
+    """ Async views and hooks should still be run by Flask, and reported as spans """
+    pytest.importorskip('asgiref')
+    app = create_app()
+
+    @app.before_request
+    async def authenticate():
+        await asyncio.sleep(0.005)
+
+    @app.route('/async')
+    async def async_view():
+        await asyncio.sleep(0)
+        return 'async ok'
+
+    middleware = HowFastFlaskMiddleware(app, app_id='some-dsn')
+    tester = app.test_client()
+    response = tester.get('/async')
+    assert response.status_code == 200
+    assert response.data == b'async ok'
+    assert inspect.iscoroutinefunction(app.view_functions['async_view'])
+
+    point = middleware._save_point.call_args[0][0]
+    spans = dict((name, (start, duration, parent)) for name, start, duration, parent in point.spans)
+    assert list(spans) == [
+        'routing',
+        'before_request:test_phases_async.<locals>.authenticate',
+        'view:async_view',
+    ]
+    # The span lasts until the coroutine is done, not only until it is created
+    assert spans['before_request:test_phases_async.<locals>.authenticate'][1] >= 5_000_000
+
+
+def test_phases_template_error(HowFastFlaskMiddleware):
+    """ A template that fails to render should not become the parent of the next spans """
+    app = create_app()
+
+    @app.route('/broken')
+    def broken():
+        return render_template_string('{{ 1 / 0 }}')
+
+    @app.errorhandler(ZeroDivisionError)
+    def division_error(exception):
+        return 'oops', 500
+
+    app.after_request(lambda response: response)
+    app.teardown_request(lambda exception: None)
+    middleware = HowFastFlaskMiddleware(app, app_id='some-dsn')
+
+    tester = app.test_client()
+    response = tester.get('/broken')
+    assert response.status_code == 500
+    point = middleware._save_point.call_args[0][0]
+    names = [name for name, _, _, _ in point.spans]
+    assert names == [
+        'routing',
+        'view:broken',
+        'render_template:<string>',
+        'errorhandler:test_phases_template_error.<locals>.division_error',
+        'after_request:test_phases_template_error.<locals>.<lambda>',
+        'teardown_request:test_phases_template_error.<locals>.<lambda>',
+    ]
+    spans = dict((name, (start, duration, parent)) for name, start, duration, parent in point.spans)
+    assert spans['render_template:<string>'][2] == names.index('view:broken')
+    assert all(parent == -1 for name, (_, _, parent) in spans.items() if name != 'render_template:<string>')
+    # The template span ends before the error handler starts
+    render_start, render_duration, _ = spans['render_template:<string>']
+    assert render_start + render_duration <= spans[names[3]][0]
+
+    # Without an error handler, the span is closed when the exception is handled
+    app.error_handler_spec[None].clear()
+    response = tester.get('/broken')
+    assert response.status_code == 500
+    point = middleware._save_point.call_args[0][0]
+    spans = [(name, parent) for name, _, _, parent in point.spans]
+    assert ('after_request:test_phases_template_error.<locals>.<lambda>', -1) in spans
+
+
+def test_overhead(HowFastFlaskMiddleware, caplog):
+    """ The overhead of the middleware should be measured, without logging on every request """
+    app = create_app()
+    middleware = HowFastFlaskMiddleware(app, app_id='some-dsn')
+
+    tester = app.test_client()
+    with caplog.at_level('INFO', logger='howfast_apm'):
+        for _ in range(3):
+            tester.get('/')
+    assert caplog.records == []
+    overhead = middleware.get_overhead()
+    assert overhead.count == 3
+    assert overhead.total > 0
+
+
+def test_sampling(HowFastFlaskMiddleware):
+    """ Requests that are not sampled should only be saved if they are slow or failed """
+    app = create_app()
+    middleware = HowFastFlaskMiddleware(app, app_id='some-dsn', sample_rate=0, slow_threshold=10)
+
+    tester = app.test_client()
+    response = tester.get('/')
+    assert response.status_code == 200
+    assert middleware._save_point.called is False
+
+    response = tester.get('/exception')
+    assert response.status_code == 500
+    assert middleware._save_point.call_count == 1
+    point = middleware._save_point.call_args[0][0]
+    assert point.response_status == "500 INTERNAL SERVER ERROR"
+
+    middleware.sampler.slow_threshold_ns = 0
+    response = tester.get('/name/slow')
+    assert middleware._save_point.call_count == 2
+    point = middleware._save_point.call_args[0][0]
+    assert point.url_rule == "/name/<string:name>"
+
+
+@patch('requests.put')
+def test_sampling_interactions(put_mocked, HowFastFlaskMiddleware):
+    """ Interactions of the requests that are not sampled should not be recorded """
+    app = create_app()
+    middleware = HowFastFlaskMiddleware(app, app_id='some-dsn', record_interactions=True, sample_rate=0, slow_threshold=0.000001)
+
+    tester = app.test_client()
+    response = tester.get('/external-call')
+    assert response.status_code == 200
+    assert put_mocked.called is True
+    # The request is kept because it is "slow", but its interactions were not recorded
+    point = middleware._save_point.call_args[0][0]
+    assert len(point.interactions) == 0
 
 
 def test_with_exception(HowFastFlaskMiddleware):
@@ -98,12 +332,12 @@ def test_with_exception(HowFastFlaskMiddleware):
     assert response.status_code == 500
     assert middleware._save_point.called is True
     assert middleware._save_point.call_count == 1
-    point = middleware._save_point.call_args[1]
-    assert point.get('time_elapsed') > 0
-    assert point.get('time_request_started') < datetime.now(timezone.utc)
-    assert point.get('method') == "GET"
-    assert point.get('response_status') == "500 INTERNAL SERVER ERROR"
-    assert point.get('uri') == "/exception"
+    point = middleware._save_point.call_args[0][0]
+    assert point.time_elapsed_ns > 0
+    assert point.time_request_started_ns < time.time_ns()
+    assert point.method == "GET"
+    assert point.response_status == "500 INTERNAL SERVER ERROR"
+    assert point.uri == "/exception"
 
 
 def test_with_error(HowFastFlaskMiddleware):
@@ -118,12 +352,12 @@ def test_with_error(HowFastFlaskMiddleware):
     # However, the failure should still be logged by the middleware
     assert middleware._save_point.called is True
     assert middleware._save_point.call_count == 1
-    point = middleware._save_point.call_args[1]
-    assert point.get('time_elapsed') > 0
-    assert point.get('time_request_started') < datetime.now(timezone.utc)
-    assert point.get('method') == "GET"
-    assert point.get('response_status') == "500 INTERNAL SERVER ERROR"
-    assert point.get('uri') == "/error"
+    point = middleware._save_point.call_args[0][0]
+    assert point.time_elapsed_ns > 0
+    assert point.time_request_started_ns < time.time_ns()
+    assert point.method == "GET"
+    assert point.response_status == "500 INTERNAL SERVER ERROR"
+    assert point.uri == "/error"
 
 
 def test_with_path_parameter(HowFastFlaskMiddleware):
@@ -135,9 +369,9 @@ def test_with_path_parameter(HowFastFlaskMiddleware):
     response = tester.get('/name/donald')
     assert response.status_code == 200
     assert middleware._save_point.call_count == 1
-    point = middleware._save_point.call_args[1]
-    assert point.get('endpoint_name') == "names"
-    assert point.get('url_rule') == "/name/<string:name>"
+    point = middleware._save_point.call_args[0][0]
+    assert point.endpoint_name == "names"
+    assert point.url_rule == "/name/<string:name>"
 
 
 def test_not_found(HowFastFlaskMiddleware):
@@ -149,22 +383,22 @@ def test_not_found(HowFastFlaskMiddleware):
     response = tester.get('/record/12')
     assert response.status_code == 200
     assert middleware._save_point.call_count == 1
-    point = middleware._save_point.call_args[1]
-    assert point.get('is_not_found') is False
+    point = middleware._save_point.call_args[0][0]
+    assert point.is_not_found is False
     middleware._save_point.reset_mock()
 
     response = tester.get('/record/100')
     assert response.status_code == 404
     assert middleware._save_point.call_count == 1
-    point = middleware._save_point.call_args[1]
-    assert point.get('is_not_found') is False
+    point = middleware._save_point.call_args[0][0]
+    assert point.is_not_found is False
     middleware._save_point.reset_mock()
 
     response = tester.get('/does-not-exist')
     assert response.status_code == 404
     assert middleware._save_point.call_count == 1
-    point = middleware._save_point.call_args[1]
-    assert point.get('is_not_found') is True
+    point = middleware._save_point.call_args[0][0]
+    assert point.is_not_found is True
 
 
 def test_blacklist_option(HowFastFlaskMiddleware):
@@ -187,6 +421,25 @@ def test_blacklist_option(HowFastFlaskMiddleware):
     assert middleware._save_point.called is False
 
 
+def test_allowlist_option(HowFastFlaskMiddleware):
+    """ Only URLs in the allowlist should be tracked """
+    app = create_app()
+    middleware = HowFastFlaskMiddleware(
+        app,
+        app_id='some-dsn',
+        endpoints_allowlist=['/name/*'],
+    )
+
+    tester = app.test_client()
+    response = tester.get('/')
+    assert response.status_code == 200
+    assert middleware._save_point.called is False
+
+    response = tester.get('/name/test')
+    assert response.status_code == 200
+    assert middleware._save_point.call_count == 1
+
+
 @patch('requests.put')
 def test_interactions_option(put_mocked, HowFastFlaskMiddleware):
     """ The record_interactions parameter should be accepted """
@@ -209,8 +462,8 @@ def test_interactions_option(put_mocked, HowFastFlaskMiddleware):
     assert len(middleware.interactions) == 0, \
         "after the point is saved, the interaction list should be empty for the next point"
 
-    point = middleware._save_point.call_args[1]
-    assert len(point.get('interactions')) == 1
-    [interaction] = point['interactions']
+    point = middleware._save_point.call_args[0][0]
+    assert len(point.interactions) == 1
+    [interaction] = point.interactions
     assert interaction.interaction_type == 'request'
     assert interaction.name == 'https://does-not-exist/'
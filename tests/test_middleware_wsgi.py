@@ -0,0 +1,154 @@
+import gc
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from howfast_apm.wsgi import METADATA_ENVIRON_KEY
+
+
+class FileWrapper:
+    """ What servers provide as wsgi.file_wrapper, to send files with sendfile() """
+
+    def __init__(self, filelike, block_size=8192):
+        self.filelike = filelike
+
+    def __iter__(self):  # pragma: nocover
+        return iter(())
+
+    def close(self):
+        self.filelike.close()
+
+
+def streaming_app(environ, start_response):
+    environ[METADATA_ENVIRON_KEY] = {'endpoint_name': 'export', 'url_rule': '/export', 'is_not_found': False}
+    start_response('200 OK', [('Content-Type', 'text/csv')])
+
+    def generate():
+        yield b''
+        yield b'a,b\n'
+        time.sleep(0.02)
+        yield b'1,2\n'
+    return generate()
+
+
+def failing_stream_app(environ, start_response):
+    start_response('200 OK', [])
+
+    def generate():
+        yield b'a,b\n'
+        raise Exception("Unhandled exception, kaboom!")
+    return generate()
+
+
+def file_app(environ, start_response):
+    start_response('200 OK', [])
+    return environ['wsgi.file_wrapper'](MagicMock())
+
+
+def make_environ(path='/export'):
+    return {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'wsgi.file_wrapper': FileWrapper}
+
+
+@pytest.fixture()
+def HowFastWSGIMiddleware():
+    """ Patch the save_point() method """
+    from howfast_apm.wsgi import HowFastWSGIMiddleware
+    HowFastWSGIMiddleware._save_point = MagicMock()
+    # Prevent the background thread to actually start
+    HowFastWSGIMiddleware.start_background_thread = MagicMock()
+    return HowFastWSGIMiddleware
+
+
+def test_streaming_response(HowFastWSGIMiddleware):
+    """ Streamed responses should be timed until they are closed by the server """
+    middleware = HowFastWSGIMiddleware(streaming_app, app_id='some-dsn')
+    start_response = MagicMock()
+    response = middleware(make_environ(), start_response)
+    start_response.assert_called_once_with('200 OK', [('Content-Type', 'text/csv')], None)
+    assert list(response) == [b'', b'a,b\n', b'1,2\n']
+    # The point is saved when the server closes the response
+    assert middleware._save_point.called is False
+    response.close()
+    response.close()
+
+    point = middleware._save_point.call_args[0][0]
+    assert middleware._save_point.call_count == 1
+    assert point.time_elapsed_ns >= 20_000_000
+    assert point.time_to_first_byte_ns < 20_000_000
+    assert point.response_bytes == 8
+    assert point.response_status == '200 OK'
+    assert point.endpoint_name == 'export'
+    assert point.url_rule == '/export'
+    assert point.is_not_found is False
+
+
+def test_streaming_exception(HowFastWSGIMiddleware):
+    """ Exceptions raised while streaming should be reported as errors """
+    middleware = HowFastWSGIMiddleware(failing_stream_app, app_id='some-dsn')
+    response = middleware(make_environ(), MagicMock())
+    with pytest.raises(Exception):
+        list(response)
+    response.close()
+    point = middleware._save_point.call_args[0][0]
+    assert point.response_status == '500 INTERNAL SERVER ERROR'
+    assert point.response_bytes == 4
+
+
+def test_profile(HowFastWSGIMiddleware):
+    """ Slow requests are reported with their profile """
+    def slow_app(environ, start_response):
+        start_response('200 OK', [])
+        time.sleep(0.1)
+        return [b'ok']
+
+    middleware = HowFastWSGIMiddleware(slow_app, app_id='some-dsn', profile_threshold=0.02)
+    response = middleware(make_environ(), MagicMock())
+    list(response)
+    response.close()
+    point = middleware._save_point.call_args[0][0]
+    assert 'slow_app' in point.profile
+
+    # Fast requests don't have a profile
+    middleware = HowFastWSGIMiddleware(streaming_app, app_id='some-dsn', profile_threshold=1)
+    response = middleware(make_environ(), MagicMock())
+    response.close()
+    assert middleware._save_point.call_args[0][0].profile is None
+
+
+def test_stalls(HowFastWSGIMiddleware):
+    """ Requests are reported with the time they were paused by the garbage collector """
+    def collecting_app(environ, start_response):
+        start_response('200 OK', [])
+        gc.collect()
+        return [b'ok']
+
+    middleware = HowFastWSGIMiddleware(collecting_app, app_id='some-dsn', record_stalls=True)
+    try:
+        response = middleware(make_environ(), MagicMock())
+        response.close()
+        point = middleware._save_point.call_args[0][0]
+        assert point.gc_pause_ns > 0
+        assert point.stall_ns is None
+        assert middleware.get_gc_pauses()[2].count >= 1
+    finally:
+        middleware.stall_monitor.uninstall()
+
+    # Not measured by default
+    middleware = HowFastWSGIMiddleware(streaming_app, app_id='some-dsn')
+    response = middleware(make_environ(), MagicMock())
+    response.close()
+    assert middleware._save_point.call_args[0][0].gc_pause_ns is None
+    assert middleware.get_gc_pauses() is None
+
+
+def test_file_wrapper(HowFastWSGIMiddleware):
+    """ The file wrapper of the server should be given back, so that it can still use sendfile() """
+    middleware = HowFastWSGIMiddleware(file_app, app_id='some-dsn')
+    response = middleware(make_environ(), MagicMock())
+    assert isinstance(response, FileWrapper)
+    response.close()
+    assert response.filelike.close.called
+    point = middleware._save_point.call_args[0][0]
+    assert point.response_status == '200 OK'
+    assert point.response_bytes is None
@@ -0,0 +1,81 @@
+import time
+import threading
+
+from howfast_apm.profiler import Profiler
+
+
+def wait_for_the_database(delay):
+    time.sleep(delay)
+
+
+def make_profiler(threshold=0.01):
+    profiler = Profiler(threshold)
+    profiler.interval = 0.005
+    profiler.idle_timeout = 0.05
+    return profiler
+
+
+def test_profile_slow_request():
+    """ The stacks of a slow request are sampled and folded """
+    profiler = make_profiler()
+    request = profiler.begin()
+    wait_for_the_database(0.1)
+    profile = profiler.end(request)
+
+    stacks = dict(line.rsplit(' ', 1) for line in profile.splitlines())
+    [stack] = [stack for stack in stacks if 'wait_for_the_database' in stack]
+    assert stack.endswith(f'{__name__}:test_profile_slow_request;{__name__}:wait_for_the_database')
+    assert int(stacks[stack]) >= 2
+
+
+def test_fast_request():
+    """ Fast requests are not sampled """
+    profiler = make_profiler(threshold=1)
+    request = profiler.begin()
+    assert profiler.end(request) is None
+    assert profiler._requests == {}
+
+
+def test_profiler_thread_stops():
+    """ The thread only runs while there are requests in flight """
+    profiler = make_profiler()
+    assert profiler._thread is None
+    profiler.end(profiler.begin())
+    thread = profiler._thread
+    assert thread.is_alive()
+    thread.join(1)
+    assert not thread.is_alive()
+    assert profiler._thread is None
+
+    # Started again by the next request
+    profiler.end(profiler.begin())
+    assert profiler._thread is not None
+
+
+def test_only_slow_threads_sampled():
+    """ Only the threads handling slow requests are sampled """
+    profiler = make_profiler(threshold=0.05)
+    profiles = {}
+
+    def handle(name, delay):
+        request = profiler.begin()
+        wait_for_the_database(delay)
+        profiles[name] = profiler.end(request)
+
+    threads = [threading.Thread(target=handle, args=('slow', 0.15)), threading.Thread(target=handle, args=('fast', 0.01))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert profiles['fast'] is None
+    assert 'wait_for_the_database' in profiles['slow']
+
+
+def test_summarize_bounded():
+    profiler = make_profiler()
+    samples = {f'app:view;app:step_{i}': i + 1 for i in range(30)}
+    samples['(other)'] = 5
+    lines = profiler.summarize(samples).splitlines()
+    assert len(lines) == profiler.max_stacks + 1
+    assert lines[0] == 'app:view;app:step_29 30'
+    assert lines[-1] == f'(other) {sum(range(1, 11)) + 5}'
@@ -0,0 +1,43 @@
+from threading import Thread
+
+from howfast_apm.queue import RingBuffer
+
+
+def test_drain():
+    """ drain() should return the items in the order they were pushed """
+    buffer = RingBuffer(maxsize=5)
+    assert buffer.drain() == []
+    for i in range(3):
+        buffer.push(i)
+    assert len(buffer) == 3
+    assert buffer.drain(2) == [0, 1]
+    assert buffer.drain(10) == [2]
+    assert buffer.empty()
+
+
+def test_drop_oldest():
+    """ Pushing to a full buffer should discard the oldest items and count them """
+    buffer = RingBuffer(maxsize=5)
+    for i in range(12):
+        buffer.push(i)
+    assert buffer.full()
+    assert buffer.dropped == 7
+    assert buffer.drain() == [7, 8, 9, 10, 11]
+
+
+def test_concurrent_producers():
+    """ Items pushed from several threads should all be retrieved """
+    buffer = RingBuffer(maxsize=10000)
+
+    def produce(offset):
+        for i in range(1000):
+            buffer.push(offset + i)
+
+    threads = [Thread(target=produce, args=(offset, )) for offset in range(0, 8000, 1000)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(buffer.drain()) == list(range(8000))
+    assert buffer.dropped == 0
@@ -1,13 +1,28 @@
+import gzip
+import json
+import time
+from threading import Thread
+import pytest
+import requests
+from datetime import datetime, timezone
 from unittest.mock import patch
 
-from howfast_apm.runner import Runner
+from howfast_apm.metrics import Histogram
+from howfast_apm.point import Point
+from howfast_apm.runner import Runner, estimate_size
+
+
+@pytest.fixture(autouse=True)
+def short_linger(monkeypatch):
+    """ Don't wait for 5 seconds before sending incomplete batches in the tests """
+    monkeypatch.setattr(Runner, 'max_linger', 0.1)
 
 
 @patch.object(Runner, 'send_batch')
 def test_queue_normal(send_mocked, queue, example_queue_item):
     """ The Runner should call send_batch as soon as a point gets added to the queue """
     runner = Runner(queue=queue, app_id="test")
-    queue.put_nowait(example_queue_item)
+    queue.push(example_queue_item)
     runner.run_once()
     assert send_mocked.called is True
     assert send_mocked.call_count == 1
@@ -65,21 +80,82 @@ def test_queue_full(send_mocked, queue_full):
 
 @patch.object(Runner, 'send_batch')
 def test_runner_robustness(send_mocked, queue, example_queue_item):
-    """ The Runner should not die after an exception """
+    """ The Runner should not die after an exception, and keep the batch for later """
     send_mocked.side_effect = Exception('Random error when sending the batch')
     runner = Runner(queue=queue, app_id="test")
-    queue.put_nowait(example_queue_item)
+    queue.push(example_queue_item)
     assert queue.qsize() == 1
     # This should not die
     runner.run_once()
     assert send_mocked.called is True
-    # Items should have been dropped
     assert queue.qsize() == 0
-    # send_batch should have been called three times (3 attempts) before dropping the points
-    assert send_mocked.call_count == 3
+    # The batch is kept to be sent later, instead of retrying right away
+    assert send_mocked.call_count == 1
+    assert len(runner.spool) == 1
+    assert runner.current_batch == []
+    assert runner.backoff.failures == 1
+    assert runner.backoff.ready() is False
+
+
+@patch.object(requests.Session, 'post')
+def test_runner_backoff(mocked_post, queue, example_queue_item):
+    """ The Runner should not call the API during the backoff delay, then send the failed batches """
+    mocked_post.return_value.status_code = 503
+    runner = Runner(queue=queue, app_id="test")
+    queue.push(example_queue_item)
+    runner.run_once()
+    assert mocked_post.call_count == 1
+    assert len(runner.spool) == 1
+
+    # The API is still considered down: the new batch is kept without calling the API
+    queue.push(example_queue_item)
+    runner.run_once()
+    assert mocked_post.call_count == 1
+    assert len(runner.spool) == 2
+
+    # The API is back up
+    mocked_post.return_value.status_code = 200
+    runner.backoff.retry_at = 0
+    runner.run_once()
+    assert mocked_post.call_count == 3
+    assert len(runner.spool) == 0
+    assert runner.backoff.failures == 0
+
+
+@patch.object(requests.Session, 'post')
+def test_runner_client_error(mocked_post, queue, example_queue_item):
+    """ Batches rejected by the API should not be sent again """
+    mocked_post.return_value.status_code = 400
+    runner = Runner(queue=queue, app_id="test")
+    queue.push(example_queue_item)
+    runner.run_once()
+    assert mocked_post.call_count == 1
+    assert len(runner.spool) == 0
+    assert runner.backoff.failures == 0
+
+
+@patch.object(requests.Session, 'post')
+def test_runner_disk_spool(mocked_post, queue, example_queue_item, tmp_path):
+    """ With a disk spool, failed batches should be sent by the next process """
+    mocked_post.return_value.status_code = 503
+    runner = Runner(queue=queue, app_id="test", spool_dir=str(tmp_path))
+    queue.push(example_queue_item)
+    runner.run_once()
+    runner.spool.close()
+    assert len(list(tmp_path.iterdir())) == 1
+
+    mocked_post.reset_mock()
+    mocked_post.return_value.status_code = 200
+    # A new Runner, as if the process restarted
+    runner = Runner(queue=queue, app_id="test", spool_dir=str(tmp_path))
+    runner.run_once()
+    assert mocked_post.call_count == 1
+    payload = json.loads(gzip.decompress(mocked_post.call_args[1].get('data')))
+    assert payload['perf'][0]['uri'] == '/look/here'
+    assert list(tmp_path.iterdir()) == []
 
 
-@patch('requests.post')
+@patch.object(requests.Session, 'post')
 def test_send_batch(mocked_post, queue_full):
     """ send_batch should serialize all batched points and send them to the API """
     runner = Runner(queue=queue_full, app_id="test-dsn")
@@ -89,7 +165,8 @@ def test_send_batch(mocked_post, queue_full):
     assert mocked_post.called is True
     assert mocked_post.call_count == 1
     kwargs = mocked_post.call_args[1]
-    json_payload = kwargs.get('json')
+    assert kwargs['headers'].get('Content-Encoding') == 'gzip'
+    json_payload = json.loads(gzip.decompress(kwargs.get('data')))
     assert json_payload.get('dsn') == 'test-dsn'
     assert isinstance(json_payload.get('perf'), list)
     points = json_payload.get('perf')
@@ -104,11 +181,62 @@ def test_send_batch(mocked_post, queue_full):
     assert points[0].get('method') == 'PUT'
     assert points[0].get('uri') == '/call/1'
     assert len(points[0].get('interactions')) == 1
-    assert points[0].get('interactions')[0].interaction_type == 'request'
-    assert points[0].get('interactions')[0].name == 'https://www.example.org/req1'
+    assert points[0].get('interactions')[0]['interaction_type'] == 'request'
+    assert points[0].get('interactions')[0]['name'] == 'https://www.example.org/req1'
+    assert points[0].get('time_elapsed') == 0.04
+    assert datetime.fromisoformat(points[0].get('time_request_started')) <= datetime.now(timezone.utc)
 
 
-@patch('requests.post')
+@patch.object(requests.Session, 'post')
+def test_send_batch_session(mocked_post, queue, example_queue_item):
+    """ The Runner should reuse the same HTTP session for every batch """
+    runner = Runner(queue=queue, app_id="test-dsn")
+    mocked_post.return_value.status_code = 200
+    session = runner.session
+    for _ in range(2):
+        queue.push(example_queue_item)
+        runner.run_once()
+    assert mocked_post.call_count == 2
+    assert runner.session is session
+
+
+@patch.object(requests.Session, 'post')
+def test_send_batch_identity(mocked_post, queue, example_queue_item):
+    """ Compression can be disabled """
+    runner = Runner(queue=queue, app_id="test-dsn", compression='identity')
+    mocked_post.return_value.status_code = 200
+    queue.push(example_queue_item)
+    runner.run_once()
+
+    kwargs = mocked_post.call_args[1]
+    assert 'Content-Encoding' not in kwargs['headers']
+    assert json.loads(kwargs.get('data')).get('dsn') == 'test-dsn'
+
+
+@patch.object(requests.Session, 'post')
+def test_send_batch_unsupported_encoding(mocked_post, queue, example_queue_item):
+    """ The Runner should stop compressing batches if the API rejects the encoding """
+    runner = Runner(queue=queue, app_id="test-dsn")
+    mocked_post.return_value.status_code = 415
+    queue.push(example_queue_item)
+    runner.run_once()
+
+    # The batch is sent a second time, uncompressed
+    assert mocked_post.call_count == 2
+    assert runner.compression == 'identity'
+    kwargs = mocked_post.call_args[1]
+    assert 'Content-Encoding' not in kwargs['headers']
+    assert len(json.loads(kwargs.get('data')).get('perf')) == 1
+
+
+def test_unknown_compression(queue):
+    """ Unknown or unavailable encodings should fall back to a supported one """
+    assert Runner(queue=queue, app_id="test", compression='brotli').compression == 'identity'
+    assert Runner(queue=queue, app_id="test", compression=None).compression == 'identity'
+    assert Runner(queue=queue, app_id="test", compression='GZIP').compression == 'gzip'
+
+
+@patch.object(requests.Session, 'post')
 def test_send_batch_api_issue(mocked_post, queue_full):
     """ send_batch should be robust if the API isn't available """
     runner = Runner(queue=queue_full, app_id="test-dsn")
@@ -117,3 +245,206 @@ def test_send_batch_api_issue(mocked_post, queue_full):
     runner.run_once()
 
     assert mocked_post.called is True
+
+
+def test_serialize_batch(example_queue_items_gen):
+    """ Batched timestamps should be formatted like datetime.isoformat() """
+    points = [next(example_queue_items_gen) for _ in range(5)]
+    points[0].time_request_started_ns = 1577836800123456789
+    serialized = Runner.serialize_batch(points)
+    assert len(serialized) == 5
+    assert serialized[0]['time_request_started'] == '2020-01-01T00:00:00.123456+00:00'
+    for point, serialized_point in zip(points, serialized):
+        assert serialized_point == Runner.serialize_point(point)
+        started = datetime.fromtimestamp(point.time_request_started_ns // 1000 / 1e6, timezone.utc)
+        assert serialized_point['time_request_started'] == started.isoformat(timespec='microseconds')
+
+
+def test_overhead_summary(queue, caplog):
+    """ The Runner should periodically log a summary of the overhead """
+    overhead = Histogram()
+    overhead.observe(1000)
+    runner = Runner(queue=queue, app_id="test", overhead=overhead, summary_interval=60)
+    runner.sleep_delay = 0
+    overhead.observe(20000)
+    overhead.observe(40000)
+
+    with caplog.at_level('INFO', logger='howfast_apm'):
+        # Not yet
+        runner.run_once()
+        assert caplog.records == []
+
+        runner._last_summary_time -= 60
+        runner.run_once()
+        [record] = caplog.records
+        # Only the values observed since the Runner started are summarized
+        assert '2 points' in record.getMessage()
+        assert 'mean 0.030ms' in record.getMessage()
+
+        # Nothing to summarize
+        runner._last_summary_time -= 60
+        runner.run_once()
+        assert len(caplog.records) == 1
+
+
+@patch.object(requests.Session, 'post')
+def test_send_aggregates(mocked_post, queue_full):
+    """ In aggregation mode, the Runner should only send aggregates and exemplars """
+    runner = Runner(queue=queue_full, app_id="test-dsn", aggregate=True, aggregation_window=60)
+    runner.sleep_delay = 0
+    mocked_post.return_value.status_code = 200
+    runner.run_once()
+    # The window isn't over yet
+    assert mocked_post.called is False
+    assert queue_full.empty()
+
+    runner.aggregator._window_started -= 60
+    runner.run_once()
+    assert mocked_post.call_count == 1
+    payload = json.loads(gzip.decompress(mocked_post.call_args[1].get('data')))
+    # queue_full has 5 PUT points with an endpoint and 5 GET points without one
+    assert sorted(aggregate['count'] for aggregate in payload['aggregates']) == [5, 5]
+    assert len(payload['perf']) == 2
+    assert runner.current_batch == []
+
+
+@patch.object(Runner, 'send_batch')
+def test_shutdown(send_mocked, queue):
+    """ shutdown() should wake the Runner up immediately """
+    runner = Runner(queue=queue, app_id="test")
+    # The thread would wait for a minute for new points if it was not woken up
+    runner.sleep_delay = 60
+    runner.start()
+    time.sleep(0.05)
+
+    start = time.monotonic()
+    runner.shutdown(timeout=5)
+    assert time.monotonic() - start < 1, "the Runner should not wait for sleep_delay"
+    assert runner.is_alive() is False
+    assert send_mocked.called is False
+
+
+@patch.object(Runner, 'send_batch')
+def test_shutdown_flush(send_mocked, queue_full):
+    """ The points left in the queue should be sent in one last batch """
+    runner = Runner(queue=queue_full, app_id="test")
+    runner.batch_size = 4
+    batches = []
+
+    def send_batch():
+        batches.append(len(runner.current_batch))
+        runner.current_batch = []
+
+    send_mocked.side_effect = send_batch
+    # Stop before the thread even starts to process the queue
+    runner.stopping.set()
+    runner.start()
+    runner.join(5)
+    assert queue_full.empty()
+    # All the points are sent at once, whatever the batch size
+    assert batches == [10]
+
+
+@patch.object(requests.Session, 'post')
+def test_shutdown_deadline(mocked_post, queue, example_queue_item):
+    """ The last batch should not wait for the API longer than the shutdown timeout """
+    mocked_post.return_value.status_code = 200
+    runner = Runner(queue=queue, app_id="test")
+    runner.start()
+    queue.push(example_queue_item)
+    runner.shutdown(timeout=2)
+    assert runner.is_alive() is False
+    assert mocked_post.called is True
+    assert mocked_post.call_args[1]['timeout'] <= 2
+
+
+def make_point(uri='/'):
+    return Point(time_request_started_ns=time.time_ns(), time_elapsed_ns=1000, method='GET', uri=uri)
+
+
+@patch.object(requests.Session, 'post')
+def test_shutdown_spooled_batches(mocked_post, queue, example_queue_item):
+    """ The batches that failed before should be sent at exit, not lost with the memory spool """
+    mocked_post.return_value.status_code = 200
+    runner = Runner(queue=queue, app_id="test")
+    for index in range(3):
+        runner.spool.append(f'{{"previous": {index}}}'.encode())
+    # The API was down a moment ago
+    runner.backoff.failure()
+    queue.push(example_queue_item)
+
+    runner.deadline = time.monotonic() + 5
+    runner.stopping.set()
+    runner.start()
+    runner.join(5)
+    assert mocked_post.call_count == 4
+    assert len(runner.spool) == 0
+    bodies = [json.loads(gzip.decompress(call[1]['data'])) for call in mocked_post.call_args_list]
+    assert bodies[1:] == [{'previous': index} for index in range(3)]
+
+    # Nothing is sent past the deadline
+    mocked_post.reset_mock()
+    runner = Runner(queue=queue, app_id="test")
+    runner.spool.append(b'{}')
+    runner.deadline = time.monotonic()
+    runner.flush()
+    assert mocked_post.called is False
+
+
+@patch.object(Runner, 'send_batch')
+def test_batch_linger(send_mocked, queue):
+    """ A trickle of points should not delay the batch for longer than max_linger """
+    runner = Runner(queue=queue, app_id="test")
+    runner.max_linger = 0.2
+    runner.sleep_delay = 0.02
+    batches = []
+
+    def send_batch():
+        batches.append(len(runner.current_batch))
+        runner.current_batch = []
+
+    send_mocked.side_effect = send_batch
+
+    # The trickle lasts much longer than max_linger
+    def trickle():
+        for _ in range(20):
+            queue.push(make_point())
+            time.sleep(0.05)
+
+    producer = Thread(target=trickle)
+    producer.start()
+    runner.run_once()
+    # The first batch waited for a few points, but not for the whole trickle
+    assert len(batches) == 1
+    assert 2 <= batches[0] < 20
+
+    # The next points are sent in other batches, none of them lost
+    while producer.is_alive():
+        runner.run_once()
+    producer.join()
+    runner.run_once()
+    assert len(batches) > 2
+    assert sum(batches) == 20
+
+
+@patch.object(Runner, 'send_batch')
+def test_batch_max_bytes(send_mocked, queue):
+    """ The batch should be sent as soon as it is big enough """
+    runner = Runner(queue=queue, app_id="test")
+    point_size = estimate_size(make_point('/' + 'x' * 1000))
+    runner.max_batch_bytes = point_size * 3
+    runner.max_linger = 60
+    for _ in range(5):
+        queue.push(make_point('/' + 'x' * 1000))
+    start = time.monotonic()
+    runner.run_once()
+    assert time.monotonic() - start < 1
+    assert send_mocked.call_count == 1
+    assert len(runner.current_batch) == 3
+
+    # The other points are sent in the next batch
+    runner.current_batch = []
+    runner.max_linger = 0.1
+    runner.run_once()
+    assert len(runner.current_batch) == 2
+    assert queue.empty()
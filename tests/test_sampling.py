@@ -0,0 +1,87 @@
+import sys
+import threading
+from unittest.mock import patch
+
+from howfast_apm.queue import RingBuffer
+from howfast_apm.sampling import Sampler
+
+
+def test_sampler_disabled():
+    """ By default, every request is kept """
+    sampler = Sampler()
+    assert sampler.enabled is False
+    assert sampler.sample() is True
+    assert sampler.keep(True, 'index', 1000, '200 OK') is True
+
+
+def test_sampler_rate():
+    """ Requests should be sampled with the given probability """
+    sampler = Sampler(rate=0.25)
+    assert sampler.enabled is True
+    with patch('random.random', side_effect=[0.1, 0.3, 0.24, 0.9]):
+        assert [sampler.sample() for _ in range(4)] == [True, False, True, False]
+    assert Sampler(rate=0).sample() is False
+
+
+def test_sampler_tail_retention():
+    """ Slow requests and server errors should be kept even if they were not sampled """
+    sampler = Sampler(rate=0, slow_threshold=0.5)
+    assert sampler.keep(False, 'index', 100_000_000, '200 OK') is False
+    assert sampler.keep(False, 'index', 600_000_000, '200 OK') is True
+    assert sampler.keep(False, 'index', 100_000_000, '503 SERVICE UNAVAILABLE') is True
+    assert sampler.keep(False, 'index', 100_000_000, '404 NOT FOUND') is False
+    assert sampler.keep(False, 'index', 100_000_000, None) is False
+
+
+def test_sampler_endpoint_rate_limit():
+    """ Sampled requests should be rate-limited per endpoint """
+    sampler = Sampler(endpoint_rate_limit=2)
+    with patch('time.monotonic', return_value=100.0):
+        assert [sampler.keep(True, 'index', 1000, '200 OK') for _ in range(3)] == [True, True, False]
+        # Other endpoints have their own budget
+        assert sampler.keep(True, 'other', 1000, '200 OK') is True
+    with patch('time.monotonic', return_value=100.5):
+        # Half a second later, one more token is available
+        assert [sampler.keep(True, 'index', 1000, '200 OK') for _ in range(2)] == [True, False]
+
+
+def test_sampler_endpoint_rate_limit_threads():
+    """ Requests of several threads should share the budget of the endpoint """
+    sampler = Sampler(endpoint_rate_limit=50)
+    kept = []
+
+    def keep():
+        kept.extend(sampler.keep(True, 'index', 1000, '200 OK') for _ in range(100))
+
+    switch_interval = sys.getswitchinterval()
+    # Switch threads as often as possible, in the middle of the refills
+    sys.setswitchinterval(1e-6)
+    try:
+        with patch('time.monotonic', return_value=100.0):
+            threads = [threading.Thread(target=keep) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert kept.count(True) == 50
+
+
+def test_sampler_adaptive():
+    """ The sampling rate should go down as the queue fills up """
+    queue = RingBuffer(maxsize=100)
+    sampler = Sampler(adaptive=True, queue=queue)
+    with patch('random.random', return_value=0.4):
+        assert sampler.sample() is True
+        for _ in range(70):
+            queue.push(None)
+        # 70% full: the rate is down to 60%
+        assert sampler.sample() is True
+        for _ in range(10):
+            queue.push(None)
+        # 80% full: the rate is down to 40%
+        assert sampler.sample() is False
+        for _ in range(20):
+            queue.push(None)
+        assert sampler.sample() is False
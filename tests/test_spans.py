@@ -0,0 +1,119 @@
+import asyncio
+
+from howfast_apm.core import CoreAPM
+from howfast_apm.runner import Runner
+from howfast_apm.spans import MAX_SPANS
+
+
+def make_apm():
+    apm = CoreAPM()
+    apm.saved = []
+    apm._save_point = apm.saved.append
+    return apm
+
+
+def save_point(apm):
+    apm.save_point(time_request_started_ns=1_600_000_000_000_000_000, time_elapsed_ns=50_000_000, method='GET', uri='/')
+    return apm.saved[-1]
+
+
+def test_spans_outside_of_a_request():
+    """ Spans are not recorded outside of a request """
+    apm = make_apm()
+    with apm.span('outside'):
+        pass
+    assert apm._spans.get() is None
+
+
+def test_nested_spans():
+    apm = make_apm()
+    apm.reset_interactions()
+
+    @apm.span()
+    def render():
+        with apm.span('template'):
+            pass
+
+    with apm.span('load'):
+        with apm.span('query'):
+            pass
+        with apm.span('query'):
+            pass
+    render()
+
+    point = save_point(apm)
+    assert [(name, parent) for name, _, _, parent in point.spans] == [
+        ('load', -1),
+        ('query', 0),
+        ('query', 0),
+        ('test_nested_spans.<locals>.render', -1),
+        ('template', 3),
+    ]
+    load, first_query, second_query, _, _ = point.spans
+    # Offsets from the start of the request
+    assert 0 <= load[1] <= first_query[1] <= first_query[1] + first_query[2] <= second_query[1]
+    assert load[1] + load[2] >= second_query[1] + second_query[2]
+
+    serialized = Runner.serialize_point(point)
+    assert serialized['spans'][0]['name'] == 'load'
+    assert serialized['spans'][0]['parent'] is None
+    assert serialized['spans'][1]['parent'] == 0
+    assert serialized['spans'][1]['elapsed'] == first_query[2] / 1e9
+
+    # Spans are reset with the request
+    assert apm._spans.get() is None
+    assert 'spans' not in Runner.serialize_point(save_point(apm))
+
+
+def test_async_spans():
+    """ Decorated coroutine functions are timed until they return, not when they are called """
+    apm = make_apm()
+
+    @apm.span()
+    async def fetch():
+        with apm.span('wait'):
+            await asyncio.sleep(0.005)
+        return 'result'
+
+    async def request():
+        apm.reset_interactions()
+        assert await fetch() == 'result'
+        return save_point(apm)
+
+    point = asyncio.run(request())
+    [fetch_span, wait_span] = point.spans
+    assert fetch_span[0].endswith('fetch')
+    assert fetch_span[2] >= 5_000_000
+    assert wait_span[:1] == ('wait',)
+    assert wait_span[3] == 0
+
+
+def test_span_not_finished():
+    """ Spans that are still running when the point is saved are reported until then """
+    apm = make_apm()
+    apm.reset_interactions()
+    span = apm.span('stream')
+    span.__enter__()
+    [(name, start, duration, parent)] = save_point(apm).spans
+    assert name == 'stream'
+    assert duration > 0
+
+
+def test_spans_not_sampled():
+    """ Spans are not recorded for requests that are not sampled """
+    apm = make_apm()
+    apm.reset_interactions(record=False)
+    with apm.span('load'):
+        pass
+    assert save_point(apm).spans == []
+
+
+def test_spans_capped():
+    apm = make_apm()
+    apm.reset_interactions()
+    for _ in range(MAX_SPANS + 10):
+        with apm.span('loop'):
+            pass
+    recorder = apm._spans.get()
+    assert recorder.dropped == 10
+    assert len(save_point(apm).spans) == MAX_SPANS
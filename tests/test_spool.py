@@ -0,0 +1,145 @@
+import fcntl
+import time
+from unittest.mock import patch
+
+import pytest
+
+from howfast_apm.spool import Backoff, DiskSpool, MemorySpool
+
+
+def drain(spool):
+    """ Read and forget all the batches of the spool """
+    batches = []
+    while (body := spool.peek()) is not None:
+        batches.append(bytes(body))
+        spool.pop()
+    return batches
+
+
+def test_backoff():
+    """ The delay should grow exponentially, with some jitter, up to the maximum """
+    backoff = Backoff(base_delay=1, max_delay=10)
+    assert backoff.ready() is True
+    delays = [backoff.failure() for _ in range(6)]
+    for delay, expected in zip(delays, [1, 2, 4, 8, 10, 10]):
+        assert expected / 2 <= delay <= expected
+    assert backoff.ready() is False
+    assert backoff.retry_at <= time.monotonic() + 10
+
+    backoff.reset()
+    assert backoff.failures == 0
+    assert backoff.ready() is True
+
+
+def test_memory_spool():
+    """ The memory spool should keep the most recent batches """
+    spool = MemorySpool(max_batches=2)
+    assert spool.peek() is None
+    for body in (b'1', b'2', b'3'):
+        spool.append(body)
+    assert len(spool) == 2
+    assert drain(spool) == [b'2', b'3']
+
+
+def test_disk_spool(tmp_path):
+    """ Batches should be replayed in order, and segments deleted once replayed """
+    spool = DiskSpool(str(tmp_path), segment_bytes=100)
+    assert spool.peek() is None
+    batches = [f'batch {i}'.encode() * 5 for i in range(5)]
+    for body in batches:
+        spool.append(body)
+    # Segments are rotated once they are bigger than segment_bytes
+    assert len(spool) > 1
+
+    # Peeking doesn't consume the batch
+    assert spool.peek() == batches[0]
+    assert spool.peek() == batches[0]
+    assert drain(spool) == batches
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_disk_spool_restart(tmp_path):
+    """ Batches should survive the process """
+    spool = DiskSpool(str(tmp_path))
+    spool.append(b'first')
+    spool.append(b'second')
+    spool.close()
+
+    spool = DiskSpool(str(tmp_path))
+    spool.append(b'third')
+    assert drain(spool) == [b'first', b'second', b'third']
+
+
+def test_disk_spool_resume(tmp_path):
+    """ After a restart, the batches already sent should not be replayed again """
+    spool = DiskSpool(str(tmp_path))
+    for body in (b'first', b'second', b'third'):
+        spool.append(body)
+    assert spool.peek() == b'first'
+    spool.pop()
+    # The process dies without closing the spool
+    del spool
+
+    spool = DiskSpool(str(tmp_path))
+    assert drain(spool) == [b'second', b'third']
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_disk_spool_eviction(tmp_path):
+    """ The oldest segments should be deleted when the spool is too big """
+    spool = DiskSpool(str(tmp_path), max_bytes=300, segment_bytes=100)
+    for i in range(10):
+        spool.append(bytes([i]) * 96)
+    assert sum(path.stat().st_size for path in tmp_path.iterdir()) <= 300
+    remaining = drain(spool)
+    assert remaining == [bytes([i]) * 96 for i in range(7, 10)]
+
+
+def test_disk_spool_truncated(tmp_path):
+    """ A batch partially written (the process died) should be skipped """
+    spool = DiskSpool(str(tmp_path))
+    spool.append(b'complete')
+    spool.close()
+    [segment] = tmp_path.iterdir()
+    with open(segment, 'ab') as file:
+        file.write(b'\x00\x00\x01\x00truncated')
+
+    assert drain(DiskSpool(str(tmp_path))) == [b'complete']
+
+
+def test_disk_spool_new_segment_locked(tmp_path):
+    """ A new segment should be locked as soon as other processes can see it """
+    spool = DiskSpool(str(tmp_path))
+    spool.append(b'mine')
+    [segment] = tmp_path.iterdir()
+    assert segment.name.endswith('.spool')
+    with open(segment, 'rb') as other_process:
+        with pytest.raises(BlockingIOError):
+            fcntl.flock(other_process.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    # Another process doesn't replay it, nor delete it
+    assert DiskSpool(str(tmp_path)).peek() is None
+    assert segment.exists()
+    assert drain(spool) == [b'mine']
+
+
+def test_disk_spool_lock_failure(tmp_path):
+    """ The batch should not be written to a segment that could not be locked """
+    spool = DiskSpool(str(tmp_path))
+    with patch.object(DiskSpool, '_lock', return_value=False), pytest.raises(OSError):
+        spool.append(b'unlocked')
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_disk_spool_locked_segment(tmp_path):
+    """ Segments used by another process should not be replayed """
+    spool = DiskSpool(str(tmp_path))
+    spool.append(b'mine')
+    spool.close()
+    [segment] = tmp_path.iterdir()
+
+    with open(segment, 'rb') as other_process:
+        fcntl.flock(other_process.fileno(), fcntl.LOCK_EX)
+        assert DiskSpool(str(tmp_path)).peek() is None
+
+    assert drain(DiskSpool(str(tmp_path))) == [b'mine']
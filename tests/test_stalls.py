@@ -0,0 +1,83 @@
+import gc
+import sys
+import time
+
+import pytest
+
+from howfast_apm.stalls import StallMonitor
+
+
+@pytest.fixture
+def monitor():
+    monitor = StallMonitor()
+    monitor.idle_timeout = 0.1
+    yield monitor
+    monitor.uninstall()
+
+
+def hold_the_gil(duration):
+    """ Keep the GIL for about `duration` seconds, without releasing it in between """
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        sum(range(100_000))
+
+
+def test_gc_pauses(monitor):
+    """ Collections are timed per generation, and charged to the requests in flight """
+    monitor.install()
+    snapshot = monitor.snapshot()
+    gc.collect(0)
+    gc.collect()
+    gc_pause_ns, stall_ns = monitor.since(snapshot)
+    assert gc_pause_ns > 0
+    # Without the watchdog, stalls are not measured
+    assert stall_ns is None
+
+    pauses = monitor.get_gc_pauses()
+    assert pauses[0].count >= 1
+    assert pauses[2].count >= 1
+    assert pauses[0].total + pauses[1].total + pauses[2].total == monitor.gc_pause_ns
+
+    # Collections after the request are not charged to it
+    later = monitor.snapshot()
+    assert monitor.since(later) == (0, None)
+
+
+def test_uninstall(monitor):
+    monitor.install()
+    monitor.uninstall()
+    snapshot = monitor.snapshot()
+    gc.collect()
+    assert monitor.since(snapshot) == (0, None)
+
+
+def test_watchdog_stalls(monitor):
+    """ The watchdog measures the time it waits for the GIL """
+    monitor.install(watchdog_interval=0.002)
+    snapshot = monitor.snapshot()
+    assert monitor._watchdog.is_alive()
+    # Make the watchdog wait for the GIL: without a thread switch, the busy thread keeps it
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(0.05)
+    try:
+        for _ in range(5):
+            hold_the_gil(0.05)
+            time.sleep(0.005)
+    finally:
+        sys.setswitchinterval(interval)
+    _, stall_ns = monitor.since(snapshot)
+    assert stall_ns > 10_000_000
+
+
+def test_watchdog_stops(monitor):
+    """ The watchdog only runs while there are requests """
+    monitor.install(watchdog_interval=0.005)
+    monitor.since(monitor.snapshot())
+    thread = monitor._watchdog
+    thread.join(1)
+    assert not thread.is_alive()
+    assert monitor._watchdog is None
+
+    # Started again by the next request
+    monitor.snapshot()
+    assert monitor._watchdog is not None
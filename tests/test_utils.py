@@ -1,4 +1,6 @@
-from howfast_apm.utils import compile_endpoints, is_in_blacklist
+from datetime import datetime, timezone
+
+from howfast_apm.utils import EndpointMatcher, compile_endpoints, is_in_blacklist, format_timestamps
 
 
 def test_is_blacklist_exact():
@@ -25,3 +27,70 @@ def test_is_blacklist_glob():
     assert is_in_blacklist('/support/tickets/23', blacklist) is True
     assert is_in_blacklist('/support/admin', blacklist) is True
     assert is_in_blacklist('/support', blacklist) is False
+
+
+def test_is_blacklist_mixed():
+    """ All kinds of patterns can be mixed in the same blacklist """
+    blacklist = compile_endpoints('/health', '/static/*', '/api/v?/metrics', '/files/*.css', '/[ab]dmin')
+    assert is_in_blacklist('/health', blacklist) is True
+    assert is_in_blacklist('/health/db', blacklist) is False
+    assert is_in_blacklist('/static/js/app.js', blacklist) is True
+    assert is_in_blacklist('/api/v1/metrics', blacklist) is True
+    assert is_in_blacklist('/api/v12/metrics', blacklist) is False
+    assert is_in_blacklist('/files/main.css', blacklist) is True
+    assert is_in_blacklist('/files/main.js', blacklist) is False
+    assert is_in_blacklist('/bdmin', blacklist) is True
+    assert is_in_blacklist('/cdmin', blacklist) is False
+
+
+def test_is_blacklist_empty():
+    """ An empty blacklist should not match anything """
+    blacklist = compile_endpoints()
+    assert is_in_blacklist('/', blacklist) is False
+    assert is_in_blacklist(None, blacklist) is False
+    assert is_in_blacklist('/anything', compile_endpoints('*')) is True
+
+
+def test_matcher_many_patterns():
+    """ Each kind of pattern is matched through its own path, even among hundreds of patterns """
+    patterns = []
+    for i in range(200):
+        patterns.append(f'/health/check-{i}')
+        patterns.append(f'/static/bundle-{i}/*')
+        patterns.append(f'/api/v?/metrics-{i}' if i % 2 else f'/files-{i}/*.css')
+    matcher = EndpointMatcher(*patterns, cache_size=0)
+    assert len(matcher._exact) == 200
+    assert sum(map(len, matcher._prefixes.values())) == 200
+    assert matcher._regex is not None
+
+    # Exact patterns
+    assert matcher.match('/health/check-0') is True
+    assert matcher.match('/health/check-199') is True
+    assert matcher.match('/health/check-200') is False
+    assert matcher.match('/health/check-1/db') is False
+    # Prefixes, of different lengths
+    assert matcher.match('/static/bundle-7/app.js') is True
+    assert matcher.match('/static/bundle-150/') is True
+    assert matcher.match('/static/bundle-150') is False
+    assert matcher.match('/static/bundle-999/app.js') is False
+    # Other patterns, combined in the regex
+    assert matcher.match('/api/v1/metrics-1') is True
+    assert matcher.match('/api/v2/metrics-199') is True
+    assert matcher.match('/api/v12/metrics-1') is False
+    assert matcher.match('/api/v1/metrics-2') is False
+    assert matcher.match('/files-0/main.css') is True
+    assert matcher.match('/files-198/theme/dark.css') is True
+    assert matcher.match('/files-0/main.js') is False
+    assert matcher.match('/files-1/main.css') is False
+    assert matcher.match('/users/42/profile') is False
+
+
+def test_format_timestamps():
+    """ Timestamps should be converted to the same strings as datetime.isoformat() """
+    timestamps = [1600000000000000000 + i * 123456789 for i in range(50)]
+    expected = [
+        datetime.fromtimestamp(timestamp // 1000 / 1e6, timezone.utc).isoformat(timespec='microseconds')
+        for timestamp in timestamps
+    ]
+    assert format_timestamps(timestamps) == expected
+    assert format_timestamps([]) == []